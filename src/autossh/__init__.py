@@ -1 +1,4 @@
-from autossh import ssh_shell
\ No newline at end of file
+from autossh import ssh_shell
+from autossh.known_hosts import KnownHosts
+from autossh.ssh_keys import SSHKeys
+from autossh.ssh_pool import SSHPool
\ No newline at end of file
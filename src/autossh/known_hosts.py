@@ -0,0 +1,73 @@
+from pathlib import Path
+import tempfile
+import base64
+import hashlib
+import hmac
+import os
+
+class KnownHosts(object):
+    """
+    Edits of the user's SSH known_hosts file, performed in-process.
+    """
+    path = Path().home() / ".ssh" / "known_hosts"
+
+    @staticmethod
+    def matches(field, addresses):
+        """
+        Return True if the host field of a known_hosts line names any of the
+        addresses, plain ("ip", "[ip]:port", comma separated) or hashed ("|1|salt|hash").
+        """
+        for name in field.split(","):
+            if name.startswith("|1|"):
+                try:
+                    salt, digest = [base64.b64decode(part) for part in name[3:].split("|", 1)]
+                except ValueError:
+                    continue
+                for address in addresses:
+                    if hmac.compare_digest(hmac.new(salt, address.encode(), hashlib.sha1).digest(), digest):
+                        return True
+            else:
+                if name.startswith("["):
+                    name = name[1:].split("]", 1)[0]
+                if name in addresses:
+                    return True
+        return False
+
+    @staticmethod
+    def remove(addresses, path=None):
+        """
+        Remove the entries of a set of addresses, rewriting the file once.
+        Options:
+            addresses (list): IP addresses or host names to remove
+            path       (str): known_hosts file, default ~/.ssh/known_hosts
+        Returns:
+            removed (int): number of lines removed
+        """
+        path = str(path or KnownHosts.path)
+        addresses = set(address for address in addresses if address)
+        if not addresses or not os.path.isfile(path):
+            return 0
+        with open(path) as f:
+            lines = f.readlines()
+        kept = []
+        for line in lines:
+            fields = line.split()
+            # Skip markers such as @cert-authority to reach the host field
+            if fields and fields[0].startswith("@") and len(fields) > 1:
+                fields = fields[1:]
+            if fields and not line.lstrip().startswith("#") and KnownHosts.matches(fields[0], addresses):
+                continue
+            kept.append(line)
+        if len(kept) == len(lines):
+            return 0
+        # Write a new file and swap it in, so a failure never truncates known_hosts
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".known_hosts.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.writelines(kept)
+            os.chmod(tmp, os.stat(path).st_mode & 0o777)
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        return len(lines) - len(kept)
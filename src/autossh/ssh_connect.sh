@@ -5,12 +5,17 @@ set hostname [lindex $argv 0]
 set hostaddr [lindex $argv 1]
 set password [lindex $argv 2]
 set hostport [lindex $argv 3]
+set gateway [lindex $argv 4]
 
 puts "Starting SSH session with $hostname@$hostaddr..."
 sleep 1
 
-# create SSH session with host 
-eval spawn ssh -oStrictHostKeyChecking=no -oCheckHostIP=no $hostname@$hostaddr -p $hostport
+# create SSH session with host, through AVN's SSH gateway if given
+if {$gateway ne ""} {
+    spawn ssh -oStrictHostKeyChecking=no -oCheckHostIP=no "-oProxyCommand=nc -X connect -x $gateway %h %p" $hostname@$hostaddr -p $hostport
+} else {
+    eval spawn ssh -oStrictHostKeyChecking=no -oCheckHostIP=no $hostname@$hostaddr -p $hostport
+}
 
 # Use the correct prompt
 set prompt ":|#|\\\$"
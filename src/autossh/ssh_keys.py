@@ -0,0 +1,92 @@
+from pathlib import Path
+import threading
+import stat
+import os
+
+import paramiko
+
+class SSHKeys(object):
+    """
+    Generation and distribution of AVN's SSH key pair. Public keys are
+    appended to the host's authorized_keys over SFTP, hosts that already
+    hold the key are left untouched.
+    """
+    key_dir = Path().home() / ".avn" / "keys"
+    keyname = "id_rsa_vb"
+    bits = 4096
+    _lock = threading.Lock()
+
+    @staticmethod
+    def key_path():
+        """Return the path of the private key."""
+        return SSHKeys.key_dir / SSHKeys.keyname
+
+    @staticmethod
+    def ensure_key_pair():
+        """
+        Create the RSA key pair, unless it already exists.
+        Returns:
+            public_key (str): OpenSSH formatted public key, e.g. "ssh-rsa AAAA... avn"
+        """
+        private = SSHKeys.key_path()
+        public = Path(str(private) + ".pub")
+        with SSHKeys._lock:
+            if not os.path.isdir(str(SSHKeys.key_dir)):
+                os.makedirs(str(SSHKeys.key_dir), mode=0o700)
+            if not os.path.isfile(str(private)):
+                key = paramiko.RSAKey.generate(SSHKeys.bits)
+                key.write_private_key_file(str(private))
+                os.chmod(str(private), 0o600)
+                with open(str(public), "w") as f:
+                    f.write(key.get_name() + " " + key.get_base64() + " avn\n")
+            elif not os.path.isfile(str(public)):
+                # Recreate a missing public key from the private key
+                key = paramiko.RSAKey.from_private_key_file(str(private))
+                with open(str(public), "w") as f:
+                    f.write(key.get_name() + " " + key.get_base64() + " avn\n")
+            with open(str(public)) as f:
+                public_key = f.read().strip()
+        if not public_key:
+            raise Exception("RSA key pair generation failed.")
+        return public_key
+
+    @staticmethod
+    def key_material(line):
+        """Return the (type, base64) fields of an authorized_keys line, None if it holds no key."""
+        fields = line.split()
+        # Skip any options preceding the key type
+        for i, field in enumerate(fields):
+            if field.startswith("ssh-") or field.startswith("ecdsa-"):
+                if i + 1 < len(fields):
+                    return (field, fields[i + 1])
+        return None
+
+    @staticmethod
+    def install(sftp, public_key):
+        """
+        Append a public key to a user's authorized_keys on a host.
+        Options:
+            sftp (SFTPClient): SFTP session logged in as the user
+            public_key  (str): OpenSSH formatted public key
+        Returns:
+            status (str): "installed" or "present" if the key was already authorised
+        """
+        material = SSHKeys.key_material(public_key)
+        # SFTP paths are relative to the user's home directory
+        try:
+            sftp.stat(".ssh")
+        except IOError:
+            sftp.mkdir(".ssh", mode=0o700)
+        try:
+            with sftp.open(".ssh/authorized_keys", "r") as f:
+                existing = f.read().decode(errors="replace")
+        except IOError:
+            existing = ""
+        if any(SSHKeys.key_material(line) == material for line in existing.splitlines()):
+            return "present"
+        with sftp.open(".ssh/authorized_keys", "a") as f:
+            if existing and not existing.endswith("\n"):
+                f.write("\n")
+            f.write(public_key + "\n")
+        sftp.chmod(".ssh/authorized_keys", stat.S_IRUSR | stat.S_IWUSR)
+        return "installed"
@@ -0,0 +1,239 @@
+import threading
+import logging
+import select
+import socket
+import time
+import os
+
+import paramiko
+
+from autossh.ssh_keys import SSHKeys
+
+class SSHPool(object):
+    """
+    Pool of persistent SSH transports to guest virtual machines, keyed by
+    (vmname, username). Commands and SFTP sessions open channels on the
+    pooled transport instead of making a new TCP and SSH handshake. Idle
+    transports are evicted, dead transports and changed addresses are
+    reconnected on next use.
+    """
+    idle_timeout = 300
+    keepalive = 30
+    timeout = 10
+    # {(vmname, username): {"client": , "address": , "last_used": , "lock": }}
+    _pool = {}
+    _lock = threading.Lock()
+    _reaper = None
+
+    @staticmethod
+    def connect(vmname, address, username, password=None, port=22):
+        """
+        Return a connected SSHClient from the pool, connecting if needed.
+        Options:
+            vmname   (str): name of the virtual machine
+            address  (str): IP address of the virtual machine
+            username (str): username on the virtual machine
+            password (str): password, used if AVN's key is not authorised
+            port     (int): SSH port, default 22
+        """
+        key = (vmname, username)
+        with SSHPool._lock:
+            entry = SSHPool._pool.get(key)
+            if entry is None:
+                entry = {"client": None, "address": None, "last_used": 0, "lock": threading.Lock()}
+                SSHPool._pool[key] = entry
+            SSHPool.start_reaper()
+        # Connections to different hosts are made concurrently
+        with entry["lock"]:
+            client = entry["client"]
+            if client is not None and (entry["address"] != address or not SSHPool.alive(client)):
+                # VM restarted or was given a new address
+                client.close()
+                client = None
+            if client is None:
+                client = SSHPool.open(address, username, password, port)
+                entry["client"] = client
+                entry["address"] = address
+            entry["last_used"] = time.time()
+            return client
+
+    @staticmethod
+    def open(address, username, password, port):
+        """Open a new SSH connection, authenticating with AVN's key then the password."""
+        client = paramiko.SSHClient()
+        # Lab hosts are rebuilt often, accept their host keys without recording them
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        key_path = str(SSHKeys.key_path())
+        try:
+            client.connect(address, port=port, username=username, password=password,
+                           key_filename=key_path if os.path.isfile(key_path) else None,
+                           timeout=SSHPool.timeout, banner_timeout=SSHPool.timeout, auth_timeout=SSHPool.timeout,
+                           look_for_keys=False, allow_agent=False)
+        except (paramiko.SSHException, socket.error) as e:
+            client.close()
+            raise Exception("SSH connection to " + username + "@" + str(address) + " failed: " + str(e))
+        client.get_transport().set_keepalive(SSHPool.keepalive)
+        return client
+
+    @staticmethod
+    def alive(client):
+        """Return True if a client's transport is still usable."""
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    @staticmethod
+    def exec(vmname, address, username, command, password=None, timeout=None):
+        """
+        Run a command on a virtual machine over a pooled transport. A dead
+        transport is reconnected once before giving up.
+        Returns:
+            result (tuple): (exit_status, stdout, stderr)
+        """
+        for attempt in range(2):
+            client = SSHPool.connect(vmname, address, username, password)
+            try:
+                stdin, stdout, stderr = client.exec_command(command, timeout=timeout)
+                stdin.close()
+                out = stdout.read().decode(errors="replace")
+                err = stderr.read().decode(errors="replace")
+                return stdout.channel.recv_exit_status(), out, err
+            except (paramiko.SSHException, EOFError, socket.error) as e:
+                SSHPool.evict(vmname, username)
+                if attempt:
+                    raise Exception("SSH command on " + vmname + " failed: " + str(e))
+
+    @staticmethod
+    def stream(vmname, address, username, command, on_line, password=None, timeout=None, cancel=None):
+        """
+        Run a command on a virtual machine over a pooled transport, passing
+        each line of output to a callback as soon as it arrives.
+        Options:
+            on_line (func): called as on_line(stream, line), stream is "stdout" or "stderr"
+            timeout  (int): seconds to wait for the command to finish, default None
+            cancel (Event): once set the channel is closed within a second, default None
+        Returns:
+            exit_status (int): exit status of the command
+        """
+        try:
+            channel = SSHPool.connect(vmname, address, username, password).get_transport().open_session()
+        except (paramiko.SSHException, EOFError, socket.error):
+            # Reconnect a transport that died since it was last used
+            SSHPool.evict(vmname, username)
+            channel = SSHPool.connect(vmname, address, username, password).get_transport().open_session()
+        deadline = time.time() + timeout if timeout else None
+        buffers = {"stdout": b"", "stderr": b""}
+        try:
+            channel.exec_command(command)
+            channel.shutdown_write()
+            while True:
+                if deadline and time.time() > deadline:
+                    raise Exception("Command on " + vmname + " timed out after " + str(timeout) + "s")
+                if cancel is not None and cancel.is_set():
+                    raise Exception("Command on " + vmname + " cancelled")
+                # Wait for output without polling, keep the transport from being reaped
+                select.select([channel], [], [], 1)
+                SSHPool.touch(vmname, username)
+                received = False
+                while channel.recv_ready():
+                    buffers["stdout"] += channel.recv(32768)
+                    received = True
+                while channel.recv_stderr_ready():
+                    buffers["stderr"] += channel.recv_stderr(32768)
+                    received = True
+                for name in buffers:
+                    *lines, buffers[name] = buffers[name].split(b"\n")
+                    for line in lines:
+                        on_line(name, line.decode(errors="replace"))
+                if not received and channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                    break
+            # Flush any final partial lines
+            for name, rest in buffers.items():
+                if rest:
+                    on_line(name, rest.decode(errors="replace"))
+            return channel.recv_exit_status()
+        finally:
+            channel.close()
+
+    @staticmethod
+    def touch(vmname, username):
+        """Mark a pooled transport as used."""
+        with SSHPool._lock:
+            entry = SSHPool._pool.get((vmname, username))
+            if entry is not None:
+                entry["last_used"] = time.time()
+
+    @staticmethod
+    def sftp(vmname, address, username, password=None):
+        """Return an SFTP session on a pooled transport, the caller closes it."""
+        try:
+            return SSHPool.connect(vmname, address, username, password).open_sftp()
+        except (paramiko.SSHException, EOFError, socket.error):
+            SSHPool.evict(vmname, username)
+            return SSHPool.connect(vmname, address, username, password).open_sftp()
+
+    @staticmethod
+    def evict(vmname, username=None):
+        """Close the pooled transports of a virtual machine, e.g. before it is restarted."""
+        with SSHPool._lock:
+            keys = [key for key in SSHPool._pool if key[0] == vmname and username in (None, key[1])]
+            entries = [SSHPool._pool.pop(key) for key in keys]
+        for entry in entries:
+            if entry["client"] is not None:
+                entry["client"].close()
+
+    @staticmethod
+    def evict_idle():
+        """Close transports unused for longer than idle_timeout."""
+        cutoff = time.time() - SSHPool.idle_timeout
+        with SSHPool._lock:
+            keys = [key for key, entry in SSHPool._pool.items() if entry["last_used"] < cutoff and not entry["lock"].locked()]
+            entries = [SSHPool._pool.pop(key) for key in keys]
+        for entry in entries:
+            if entry["client"] is not None:
+                entry["client"].close()
+
+    @staticmethod
+    def after_fork():
+        """
+        Forget the pooled transports in a forked child, their threads were not
+        copied. They are dropped rather than closed, closing would end the
+        parent's sessions.
+        """
+        SSHPool._pool = {}
+        SSHPool._lock = threading.Lock()
+        SSHPool._reaper = None
+
+    @staticmethod
+    def start_reaper():
+        """Start the idle eviction thread, called with the pool lock held."""
+        if SSHPool._reaper is None:
+            SSHPool._reaper = threading.Thread(target=SSHPool.reap, daemon=True, name="avn-ssh-reaper")
+            SSHPool._reaper.start()
+
+    @staticmethod
+    def reap():
+        """Evict idle transports until the pool is empty."""
+        while True:
+            time.sleep(min(60, SSHPool.idle_timeout))
+            try:
+                SSHPool.evict_idle()
+            except Exception:
+                logging.exception("SSH pool eviction failed")
+            with SSHPool._lock:
+                if not SSHPool._pool:
+                    SSHPool._reaper = None
+                    return
+
+    @staticmethod
+    def stats():
+        """Return the pooled transports for printing purposes."""
+        with SSHPool._lock:
+            return [{"vmname": key[0], "username": key[1], "address": entry["address"],
+                     "active": entry["client"] is not None and SSHPool.alive(entry["client"]),
+                     "idle": round(time.time() - entry["last_used"], 1)}
+                    for key, entry in sorted(SSHPool._pool.items())]
+
+
+# Threads are not copied into a forked child, e.g. the REST API server process
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=SSHPool.after_fork)
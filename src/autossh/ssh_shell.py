@@ -11,15 +11,31 @@ class Shell(object):
     Object for creating SSH terminal sessions with clients. 
     """
 
-    def connect(self, hostname, hostaddr, password, hostport):
+    def command(self, hostname, hostaddr, hostport, gateway=None):
+        """
+        Return the ssh command line for a host, for running by hand.
+        Options:
+            gateway (str): "<server>:<port>" of an AVN SSH gateway, hostaddr is then the vmname
+        """
+        cmd = "ssh -p " + str(hostport) + " "
+        if gateway:
+            cmd += "-o ProxyCommand=\"nc -X connect -x " + gateway + " %h %p\" "
+        return cmd + hostname + "@" + hostaddr
+
+    def connect(self, hostname, hostaddr, password, hostport, gateway=None):
         """
         Open Apple Mac terminal and open interactive SSH session with host
         Options: 
             hostname (str): username of target host 
-            hostaddr (str): IP address of the target host 
+            hostaddr (str): IP address of the target host, or vmname through a gateway
             password (str): password of the target host 
             hostport (str): SSH-client port to connect to on target host
+            gateway  (str): "<server>:<port>" of an AVN SSH gateway, default None
         """
+        # Arguments passed on to ssh_connect.sh
+        args = hostname + " " + hostaddr + " " + password + " " + str(hostport)
+        if gateway:
+            args += " " + gateway
         # Identify path the SSH bash files 
         bsPath = str(pathlib.Path(__file__).parent.absolute())
         # Check the OS to see which shell to run
@@ -31,20 +47,14 @@ class Shell(object):
                 "to do script "
                 "\"cd " + bsPath + " "
                 + "&& ./ssh_connect.sh "
-                + hostname + " "
-                + hostaddr + " "
-                + password + " "
-                + str(hostport) 
+                + args
                 + "\"'")
         elif sys.platform == "linux":
             cmd = ("gnome-terminal --working-directory="
                 "\"" + bsPath + "\""
                 + " -- "
                 + "zsh -c \"./ssh_connect.sh "
-                + hostname + " "
-                + hostaddr + " "
-                + password + " "
-                + str(hostport)
+                + args
                 + "; zsh \"")
         else:
             raise Exception("OS not supported, please open shell manually")
@@ -15,6 +15,8 @@ def parseargs():
     p = argparse.ArgumentParser(description='Launch a custom virtual network')
     p.add_argument("-r", dest="restapi" ,action="store_true", help="Start avn's REST Api only")
     p.add_argument("-c", metavar='<url/to/api>', nargs='?', dest="cliconsole", type=str, const="default", help="Start avn's Rest Client Console (no argument defaults)")
+    p.add_argument("-j", metavar='<n>', dest="vbox_limit", type=int, default=None, help="Maximum number of concurrent VBoxManage commands (default 4)")
+    p.add_argument("-p", metavar='<first>-<last>', dest="ssh_ports", type=str, default=None, help="Host ports assigned to SSH forwarding (default 2000-2999)")
     return vars(p.parse_args())
 
 def config_folder():
@@ -57,6 +59,8 @@ def config_folder():
 
 from cli import Console
 from restapi.server import RESTServer
+from vbox import VBoxManage
+from forwarding import PortAllocator
 
 if __name__ == '__main__':
 
@@ -71,6 +75,13 @@ if __name__ == '__main__':
     arguments = parseargs()
 
     create_tables()
+
+    if arguments["vbox_limit"]:
+        VBoxManage.set_limit(arguments["vbox_limit"])
+
+    if arguments["ssh_ports"]:
+        first, _, last = arguments["ssh_ports"].partition("-")
+        PortAllocator.set_range(int(first), int(last or first))
     
     if arguments["restapi"]:
         RESTServer(remote=True).start()
@@ -170,6 +170,37 @@ class Console(Cmd):
         except Exception as e:
             handle_ex(e)
 
+    ############################################
+    # Apply Template Changes
+    ############################################
+
+    def do_apply(self, cmd):
+        """
+        Apply a changed template to its deployment, only building the difference.
+        Usage:
+            apply <path/to/template>
+            apply <path/to/template> plan (show the changes without applying them)
+        """
+        cmds = cmd.split()
+        if len(cmds) == 0 or len(cmds) > 2 or (len(cmds) == 2 and cmds[1] != "plan"):
+            Print.print_warning("Invalid number of arguments, see 'help apply'")
+            return
+
+        try:
+            plan = self.client.plan(cmds[0])
+            if not plan["exists"]:
+                Print.print_information("Deployment {0} does not exist and will be built".format(plan["deployment"]))
+            if plan["actions"]:
+                print(create_table(plan["actions"], header=["action", "name", "detail"]))
+            else:
+                Print.print_information("Deployment {0} is up to date".format(plan["deployment"]))
+                return
+            if len(cmds) == 1:
+                Print.print_information("Applying template...")
+                self.client.apply(cmds[0])
+        except Exception as e:
+            handle_ex(e)
+
     ############################################
     # Start Network Topology
     ############################################
@@ -246,6 +277,172 @@ class Console(Cmd):
         except Exception as e:
             handle_ex(e)
 
+    ############################################
+    # Run Commands
+    ############################################
+
+    def do_exec(self, cmd):
+        """
+        Run a command on all virtual machines within a deployment at once,
+        printing each host's output as it arrives.
+        Usage:
+            exec <deployment-name> <command>
+            exec <deployment-name> --hosts <vmname,vmname> <command>
+        """
+        cmds = cmd.split(None, 1)
+        if len(cmds) != 2:
+            Print.print_warning("Invalid number of arguments, see 'help exec'")
+            return
+        deployment_name, command = cmds
+        hosts = None
+        if command.startswith("--hosts"):
+            options = command.split(None, 2)
+            if len(options) != 3:
+                Print.print_warning("Invalid number of arguments, see 'help exec'")
+                return
+            hosts = options[1].split(",")
+            command = options[2]
+        try:
+            results = []
+            for event in self.client.exec(deployment_name, command, hosts):
+                if "line" in event and event["stream"] == "stderr":
+                    Print.print_warning(event["vmname"] + " | " + event["line"])
+                elif "line" in event:
+                    Print.print_information(event["vmname"] + " | " + event["line"])
+                else:
+                    results.append(event)
+            print(create_table(sorted(results, key=lambda result: result["vmname"]),
+                               header=["vmname", "exit_status", "duration", "error"]))
+        except Exception as e:
+            handle_ex(e)
+
+    ############################################
+    # Snapshots
+    ############################################
+
+    def do_snapshot(self, cmd):
+        """
+        Take, list or delete snapshots of all virtual machines within a deployment.
+        Usage:
+            snapshot <deployment-name>
+            snapshot <deployment-name> <snapshot-name>
+            snapshot <deployment-name> <snapshot-name> delete
+        """
+        cmds = cmd.split()
+        if len(cmds) == 0 or len(cmds) > 3 or (len(cmds) == 3 and cmds[2] != "delete"):
+            Print.print_warning("Invalid arguments, see 'help snapshot'")
+            return
+        try:
+            if len(cmds) == 1:
+                snapshots = self.client.snapshots(cmds[0])
+                if not snapshots:
+                    Print.print_information("No snapshots for deployment " + cmds[0])
+                    return
+                print(create_table(snapshots, header=["name", "hosts", "created"]))
+            if len(cmds) == 2:
+                Print.print_information("Taking snapshot...")
+                self.client.snapshot(cmds[0], cmds[1])
+            if len(cmds) == 3:
+                Print.print_information("Deleting snapshot...")
+                self.client.delete_snapshot(cmds[0], cmds[1])
+        except Exception as e:
+            handle_ex(e)
+
+    def do_reset(self, cmd):
+        """
+        Reset all virtual machines within a deployment to a snapshot.
+        Usage:
+            reset <deployment-name> <snapshot-name>
+        """
+        cmds = cmd.split()
+        if len(cmds) != 2:
+            Print.print_warning("Invalid number of arguments, see 'help reset'")
+            return
+        try:
+            Print.print_information("Resetting deployment...")
+            self.client.reset(cmds[0], cmds[1])
+        except Exception as e:
+            handle_ex(e)
+
+    ############################################
+    # Reset DHCP Servers
+    ############################################
+
+    def do_dhcpreset(self, cmd):
+        """
+        Reset the DHCP servers of all networks within a deployment.
+        Usage:
+            dhcpreset <deployment-name>
+        """
+        cmds = cmd.split()
+        if len(cmds) != 1:
+            Print.print_warning("Invalid number of arguments, see 'help dhcpreset'")
+            return
+        try:
+            Print.print_information("Resetting DHCP servers...")
+            self.client.reset_dhcp(cmds[0])
+        except Exception as e:
+            handle_ex(e)
+
+    ############################################
+    # Warm Pool
+    ############################################
+
+    def do_pool(self, cmd):
+        """
+        Show or size the warm pools of pre-imported virtual machines.
+        Usage:
+            pool
+            pool <image.ova> <n>
+            pool <image.ova> <n> linked
+        """
+        cmds = cmd.split()
+        if len(cmds) not in (0, 2, 3) or (len(cmds) == 3 and cmds[2] != "linked"):
+            Print.print_warning("Invalid arguments, see 'help pool'")
+            return
+        try:
+            if len(cmds) >= 2:
+                if not cmds[1].isdigit():
+                    Print.print_warning("Pool size must be a non-negative integer")
+                    return
+                self.client.set_pool_size(cmds[0], int(cmds[1]), linked=(len(cmds) == 3))
+                Print.print_success("Set " + cmds[0] + " pool size to " + cmds[1])
+            pools = self.client.pool_details()
+            if not pools:
+                Print.print_information("No warm pools configured")
+                return
+            print(create_table(pools, header=["image", "linked", "size", "ready", "filling"]))
+        except Exception as e:
+            handle_ex(e)
+
+    ############################################
+    # Operation Limits
+    ############################################
+
+    def do_limit(self, cmd):
+        """
+        Show or set the number of concurrent operations of each class.
+        Usage:
+            limit
+            limit <operation> <n>
+        Operations:
+            import, boot, poweroff, delete, snapshot, ssh, resolve, network, default
+        """
+        cmds = cmd.split()
+        if len(cmds) not in (0, 2):
+            Print.print_warning("Invalid number of arguments, see 'help limit'")
+            return
+        try:
+            if len(cmds) == 2:
+                if not cmds[1].isdigit():
+                    Print.print_warning("Limit must be a positive integer")
+                    return
+                self.client.set_limit(cmds[0], int(cmds[1]))
+                Print.print_success("Set " + cmds[0] + " limit to " + cmds[1])
+            print(create_table(self.client.get_limits(), header=["operation", "limit", "workers", "active", "queued"]))
+        except Exception as e:
+            handle_ex(e)
+
     ############################################
     # Show properties
     ############################################
@@ -258,6 +455,8 @@ class Console(Cmd):
         Options:
             h: host properties
             n: network adapter properties
+            v: VBoxManage latency statistics
+            f: SSH forwarding traffic, per route and open connection
         """
         # command validation
         cmds = cmd.split()
@@ -270,6 +469,38 @@ class Console(Cmd):
                 print(create_table(self.client.host_details(), header=["vmname", "VMState", "ostype", "cpus", "memory", "deployment"]))
             if cmds[0] == 'n':
                 print(create_table(self.client.network_details(), header=["vmname", "name", "netname", "mac", "ip", "deployment"]))
+            if cmds[0] == 'v':
+                stats = self.client.vbox_stats()
+                if not stats:
+                    Print.print_information("No VBoxManage commands run yet")
+                    return
+                print(create_table(stats, header=["subcommand", "count", "errors", "mean", "min", "max", "wait"]))
+            if cmds[0] == 'f':
+                stats = self.client.forwarding_stats()
+                if not stats:
+                    Print.print_information("No SSH ports forwarded")
+                    return
+                routes, connections = [], []
+                for route in stats:
+                    routes.append({
+                        "name": route["name"],
+                        "port": route["host_port"],
+                        "destination": "{0}:{1}".format(route["dest_addr"], route["dest_port"]),
+                        "state": route["state"],
+                        "restarts": route["restarts"],
+                        "active": route["active"],
+                        "accepted": route["accepted"],
+                        "errors": route["errors"],
+                        "bytes_in": route["bytes_in"],
+                        "bytes_out": route["bytes_out"],
+                        "connect_ms": route["connect_ms"]["mean"],
+                        "duration_ms": route["duration_ms"]["mean"],
+                    })
+                    for connection in route["connections"]:
+                        connections.append(dict(connection, name=route["name"], port=route["host_port"]))
+                print(create_table(routes, header=["name", "port", "destination", "state", "restarts", "active", "accepted", "errors", "bytes_in", "bytes_out", "connect_ms", "duration_ms"]))
+                if connections:
+                    print(create_table(connections, header=["name", "port", "guest", "address", "relay", "bytes_in", "bytes_out", "connect_ms", "duration"]))
             if cmds[0] == 'u':
                 if self.remote:
                     Print.print_warning("Can't see users as remote client")
@@ -329,7 +560,9 @@ class Console(Cmd):
         # command execution
         try:
             Print.print_information("Distributing keys...")
-            self.client.send_keys(cmds[0])
+            results = self.client.send_keys(cmds[0])
+            if results:
+                print(create_table(results, header=["vmname", "address", "status", "duration", "error"]))
         except Exception as e:
             handle_ex(e)
 
@@ -365,6 +598,38 @@ class Console(Cmd):
         except Exception as e:
             handle_ex(e)
 
+    def do_gateway(self, cmd):
+        """
+        Accept SSH connections to every host on one port. Clients name the
+        host with HTTP CONNECT, e.g. ssh -o ProxyCommand="nc -X connect -x <server>:<port> %h %p" <username>@<vmname>
+        Usage:
+            gateway                 show the gateway's port
+            gateway start [port]    start the gateway, default port 2222
+            gateway stop            stop the gateway
+        """
+        # command validation
+        cmds = cmd.split()
+        if len(cmds) > 2 or (cmds and cmds[0] not in ("start", "stop")) or (len(cmds) == 2 and (cmds[0] != "start" or not cmds[1].isdigit())):
+            Print.print_warning("Invalid arguments, see 'help gateway'")
+            return
+
+        # command execution
+        try:
+            if not cmds:
+                port = self.client.gateway_port()
+                if port:
+                    Print.print_information("SSH gateway listening on port " + str(port))
+                else:
+                    Print.print_information("SSH gateway not running")
+            elif cmds[0] == "start":
+                port = self.client.start_gateway(int(cmds[1])) if len(cmds) == 2 else self.client.start_gateway()
+                Print.print_success("SSH gateway listening on port " + str(port))
+            else:
+                self.client.stop_gateway()
+                Print.print_success("SSH gateway stopped")
+        except Exception as e:
+            handle_ex(e)
+
     ############################################
     # Launch RestAPI Server
     ############################################
@@ -518,8 +783,7 @@ class Console(Cmd):
 
             #If running local client then ensure the records are cleared
             if not self.remote:
-                for server in SSHForward.get_all():
-                    SSHForward.delete(server)
+                SSHForward.delete_all(SSHForward.get_all())
             
         except Exception as e:
             handle_ex(e)
@@ -1,4 +1,4 @@
-import yaml, pathlib, os
+import yaml, pathlib, os, time
 from models.network import Network
 from models.host import Host
 from models.deployment import Deployment
@@ -7,20 +7,27 @@ import logging
 from print_colours import Print
 from sqlalchemy.exc import OperationalError
 
-from resources import Hosts, Networks, Deployments
+from resources import Hosts, Networks, Deployments, Snapshots, SSHForward
+from forwarding import ForwardingService, PortAllocator
+from taskgraph import TaskGraph
+from vbox import Inventory
+from db import Session
 
 class Constructor():
     """Collection of methods to build the topology from a configuration file."""
 
-    def __init__(self, template_file):
+    def __init__(self, template_file, workers=4):
         """
         Parse and return the hosts and networks from the template file.
         Options:
             template_file (str): The name of the yaml configuration template file
+            workers       (int): number of build tasks run at once, default 4
         """
         # Generate the network
         self.networks = {}
         self.hosts = {}
+        self.existing_networks = {}
+        self.workers = workers
 
         # Build the path
         template_path = str(pathlib.Path().home() / ".avn" / "templates" / template_file )
@@ -41,8 +48,14 @@ class Constructor():
         # Read the network and host files
         try:
             deployment_name = self.create_deployment()
-            self.build_networks(deployment_name)
-            self.build_hosts(deployment_name)
+            deployment_id = Deployments.get_by_name(deployment_name).id
+            # Model the build as a dependency graph and run it
+            graph = TaskGraph(max_workers=self.workers)
+            self.build_networks(graph, deployment_id)
+            self.build_hosts(graph, deployment_id)
+            t = time.time()
+            timings = graph.run()
+            self.print_timings(timings, time.time() - t)
             self.add_to_db()
         except Exception as e:
             Print.print_error("Build aborted with reason: {0}".format(e))
@@ -58,7 +71,184 @@ class Constructor():
             if deployment_name:
                 Print.print_information("Cleaning database...")
                 self.clear_up_database(deployment_name)
+
+            # Clear any base images no longer used
+            self.clear_up_bases()
             
+    def plan(self):
+        """
+        Compare the template with the deployed hosts and networks, in both the
+        database and VirtualBox, to find the changes required.
+        Returns:
+            plan (dict): {"deployment": , "exists": , "actions": [{"action": , "name": , "detail": }]}
+        """
+        name = self.deployment_name()
+        deployment = Deployments.get_by_name(name)
+        networks = self.template.get('networks') or {}
+        hosts = self.template.get('hosts') or {}
+        actions = []
+        # Nothing deployed, the whole template must be built
+        if deployment is None:
+            for label, values in networks.items():
+                actions.append({"action": "add_network", "name": label, "detail": values.get("netaddr")})
+            for vmname, values in hosts.items():
+                actions.append({"action": "add_host", "name": vmname, "detail": values.get("image")})
+            return {"deployment": name, "exists": False, "actions": actions}
+
+        deployed_networks = {network.label: network for network in Networks.get_deployment(deployment.id) or []}
+        deployed_hosts = {host.vmname: host for host in Hosts.get_deployment(deployment.id) or []}
+        labels = {network.netname: network.label for network in deployed_networks.values()}
+        vms = Inventory.vms()
+        hostonlyifs = Inventory.hostonlyifs()
+        # Networks to add, or rebuild if removed from VirtualBox
+        rebuilt = []
+        for label, values in networks.items():
+            if label not in deployed_networks:
+                actions.append({"action": "add_network", "name": label, "detail": values.get("netaddr")})
+            elif deployed_networks[label].netname not in hostonlyifs:
+                rebuilt.append(label)
+                actions.append({"action": "remove_network", "name": label, "detail": "missing from VirtualBox"})
+                actions.append({"action": "add_network", "name": label, "detail": values.get("netaddr")})
+        # Hosts to remove
+        for vmname in deployed_hosts:
+            if vmname not in hosts:
+                actions.append({"action": "remove_host", "name": vmname, "detail": "not in template"})
+        # Hosts to add, rebuild or reconnect
+        for vmname, values in hosts.items():
+            host = deployed_hosts.get(vmname)
+            if host is None:
+                actions.append({"action": "add_host", "name": vmname, "detail": values.get("image")})
+            elif vmname not in vms:
+                actions.append({"action": "remove_host", "name": vmname, "detail": "missing from VirtualBox"})
+                actions.append({"action": "add_host", "name": vmname, "detail": values.get("image")})
+            elif host.image != values.get("image"):
+                actions.append({"action": "remove_host", "name": vmname, "detail": "image changed"})
+                actions.append({"action": "add_host", "name": vmname, "detail": values.get("image")})
+            else:
+                current = self.describe_adapters(host.adapters(), labels)
+                desired = list(values.get("networks") or [])
+                if "internet_adapter" in values:
+                    desired.append(values["internet_adapter"])
+                if current != desired:
+                    detail = ", ".join(current) + " -> " + ", ".join(desired)
+                    actions.append({"action": "change_nics", "name": vmname, "detail": detail})
+                elif any(label in rebuilt for label in desired):
+                    # A rebuilt network gets a new interface, reattach the host to it
+                    detail = "reattach to rebuilt " + ", ".join(label for label in desired if label in rebuilt)
+                    actions.append({"action": "change_nics", "name": vmname, "detail": detail})
+        # Networks no longer in the template
+        for label in deployed_networks:
+            if label not in networks:
+                actions.append({"action": "remove_network", "name": label, "detail": "not in template"})
+        return {"deployment": name, "exists": True, "actions": actions}
+
+    def describe_adapters(self, adapters, labels):
+        """Describe a host's adapters as template network labels or internet adapter types."""
+        described = []
+        for adapter in range(1, 9):
+            config = adapters.get(adapter, {"type": "none", "netname": None})
+            if config["type"] == "hostonly":
+                described.append(labels.get(config["netname"], config["netname"]))
+            else:
+                described.append(config["type"])
+        # Trailing disabled adapters are not described in templates
+        while described and described[-1] == "none":
+            described.pop()
+        return described
+
+    def apply(self):
+        """
+        Apply the template to its deployment, only building the difference
+        between the template and what is already deployed.
+        Returns:
+            plan (dict): the plan that was applied, see plan()
+        """
+        plan = self.plan()
+        if not plan["exists"]:
+            self.parse()
+            return plan
+        if not plan["actions"]:
+            Print.print_information("Deployment " + plan["deployment"] + " is up to date")
+            return plan
+
+        actions = {}
+        for action in plan["actions"]:
+            actions.setdefault(action["action"], []).append(action["name"])
+        deployment = Deployments.get_by_name(plan["deployment"])
+        deployed_networks = {network.label: network for network in Networks.get_deployment(deployment.id) or []}
+        deployed_hosts = {host.vmname: host for host in Hosts.get_deployment(deployment.id) or []}
+        template_networks = self.template.get('networks') or {}
+        template_hosts = self.template.get('hosts') or {}
+        obsolete = []
+        try:
+            # Remove hosts no longer in the template, or to be rebuilt
+            bases = set()
+            for vmname in actions.get("remove_host", []):
+                host = deployed_hosts.pop(vmname)
+                # Powers off the host first, a host deleted outside of AVN is only forgotten
+                host.destroy()
+                bases.add(host.get_base())
+                Snapshots.delete_all(Snapshots.get_by_host(host.id))
+                # Forward rows are deleted in the same commit as their host
+                servers = SSHForward.get_by_host(host.id)
+                host_ports = [server.host_port for server in servers] + [host.ssh_remote_port]
+                for server in servers:
+                    Session.delete(server)
+                Hosts().delete(host)
+                # Stop forwarding to the removed host and free its ports
+                if servers:
+                    service = ForwardingService.shared()
+                    for host_port in host_ports:
+                        service.remove_route(host_port)
+                PortAllocator.release(host_ports)
+            Hosts().release_bases(bases)
+            # Forget networks missing from VirtualBox, keep obsolete ones until hosts are reconnected
+            for label in actions.get("remove_network", []):
+                network = deployed_networks.pop(label)
+                if label in template_networks:
+                    Networks().delete(network)
+                else:
+                    obsolete.append(network)
+            self.existing_networks = {label: network.get_name() for label, network in deployed_networks.items()}
+
+            # Model the changes as a dependency graph and run it
+            graph = TaskGraph(max_workers=self.workers)
+            self.build_networks(graph, deployment.id, labels=actions.get("add_network", []))
+            self.build_hosts(graph, deployment.id, vmnames=actions.get("add_host", []))
+            for vmname in actions.get("change_nics", []):
+                host = deployed_hosts[vmname]
+                # Load the host's attributes before handing it to a worker thread
+                Session.refresh(host)
+                values = template_hosts[vmname]
+                assignments, internet = self.host_adapters(values)
+                graph.add("nics:" + vmname, self.reconfigure_host, host, values, assignments, internet,
+                          depends=self.network_tasks(graph, assignments))
+            t = time.time()
+            timings = graph.run()
+            self.print_timings(timings, time.time() - t)
+            self.add_to_db()
+        except Exception as e:
+            Print.print_error("Apply aborted with reason: {0}".format(e))
+            Print.print_information("Cleaning build...")
+            # Only clear up what was built by this apply
+            self.clear_up_networks()
+            self.clear_up_hosts()
+            self.clear_up_bases()
+            return plan
+
+        # Remove networks no longer in the template
+        for network in obsolete:
+            network.destroy()
+            Networks().delete(network)
+        Print.print_success("Applied {0} changes to deployment {1}".format(len(plan["actions"]), plan["deployment"]))
+        return plan
+
+    def deployment_name(self):
+        """Return the deployment name given in the template."""
+        if "deployment" in self.template and "name" in self.template['deployment']:
+            return self.template['deployment']['name']
+        raise Exception("No deployment information in template")
+
     def create_deployment(self):
         """Initialise deployment for grouping host-network topologies."""
         if "deployment" in self.template:
@@ -71,64 +261,145 @@ class Constructor():
                 Print.print_information("Building deployment: " + name)
                 return name
 
-    def build_networks(self, deployment_name):
-        """Build networks inline with configuration template."""
+    def build_networks(self, graph, deployment_id, labels=None):
+        """
+        Add a build task to the graph for each network in the configuration template.
+        Options:
+            labels (list): only build these networks, default all
+        """
         # Read the network information and catch if it doesnt exist
         if "networks" in self.template:
             networks = self.template['networks']
             # Loop through the networks and collect the information
             for label, values in networks.items():
+                if labels is not None and label not in labels:
+                    continue
                 # Validate template and network address 
                 if self.is_valid_net_template(values) and self.is_valid_net_addr(values["netaddr"]): 
-                    # Build the network 
-                    deployment_id = Deployments.get_by_name(deployment_name).id
-                    self.networks[label] = Network(label, values["netaddr"], values["dhcplower"], values["dhcpupper"], deployment_id)         
+                    # Networks have no dependencies, names are allocated safely in parallel
+                    graph.add("network:" + label, self.build_network, label, values, deployment_id, op="network")
         else:
             raise Exception("No network information in template")
 
-    def build_hosts(self, deployment_name):
-        """Build networks inline with configuration template."""
-        # Read the hosts information and catch if it doesnt exist
+    def build_network(self, label, values, deployment_id):
+        """Build a single network, run as a graph task."""
+        self.networks[label] = Network(label, values["netaddr"], values["dhcplower"], values["dhcpupper"], deployment_id)
 
+    def build_hosts(self, graph, deployment_id, vmnames=None):
+        """
+        Add build tasks to the graph for each host in the configuration template.
+        Each host is imported independently, its adapters are assigned once
+        both the host and its networks have been built.
+        Options:
+            vmnames (list): only build these hosts, default all
+        """
+        # Read the hosts information and catch if it doesnt exist
         if "hosts" in self.template:
             hosts = self.template['hosts']
 
             # Loop through the hosts and collect the information
             for vmname, values in hosts.items():
+                if vmnames is not None and vmname not in vmnames:
+                    continue
                 # Validate template and host name
                 if self.is_valid_host_template(values) and self.is_valid_host_vname(vmname): 
-                    
-                    # Build the host
-                    deployment_id = Deployments.get_by_name(deployment_name).id
-                    self.hosts[vmname] = Host(vmname, values["image"], values["username"], values["password"], deployment_id)
-                    
-                    # Manage network assignments
-                    networks = values["networks"]
-                    # Initiaise adapter identifier, starts at adapter 1
-                    adapter = 1
-                    # Loop through rest of list and assign adapter
-                    for index, networklabel in enumerate(networks):
-                        adapter += index # at first iteration index = 0
-                        # Check if network has been created and adapters havent gone over 8
-                        if networklabel in self.networks and adapter <= 8:
-                            self.hosts[vmname].assign_network(adapter, self.networks[networklabel].get_name())
-                        else:
-                            raise Exception("Error assigning network adapter, please check template file")
-                    # Point to next free adapter 
-                    adapter += 1
-                    # Assign network access if required to the next adapter
-                    if "internet_adapter" in values:
-                        # Check a free adapter is avaliable 
-                        if adapter <= 8:
-                            try:
-                                self.hosts[vmname].assign_internet(adapter, values["internet_adapter"])
-                            except Exception as e:
-                                raise Exception("failed to assign internet adapter: " + repr(e)) 
-                        else:
-                            raise Exception("Error adapter count for host exceeded")
+                    assignments, internet = self.host_adapters(values)
+                    # Build the host, then configure it once its networks exist
+                    graph.add("host:" + vmname, self.build_host, vmname, values, deployment_id, op="import")
+                    depends = ["host:" + vmname] + self.network_tasks(graph, assignments)
+                    graph.add("nics:" + vmname, self.assign_nics, vmname, values, assignments, internet, depends=depends)
         else:
             Print.print_error("No host information in template")
 
+    def host_adapters(self, values):
+        """
+        Identify the adapter assignments for a host in the template.
+        Returns:
+            assignments (list): [(adapter, network label)]
+            internet     (int): adapter for internet access, None if not required
+        """
+        networks = self.template.get('networks') or {}
+        # Manage network assignments, adapters start at 1
+        assignments = []
+        for adapter, networklabel in enumerate(values["networks"], start=1):
+            # Check if network is in the template and adapters havent gone over 8
+            if networklabel in networks and adapter <= 8:
+                assignments.append((adapter, networklabel))
+            else:
+                raise Exception("Error assigning network adapter, please check template file")
+        # Assign network access if required to the next adapter
+        internet = None
+        if "internet_adapter" in values:
+            # Check a free adapter is avaliable 
+            internet = len(assignments) + 1
+            if internet > 8:
+                raise Exception("Error adapter count for host exceeded")
+        return assignments, internet
+
+    def network_tasks(self, graph, assignments):
+        """Return the graph tasks building the networks a host is assigned to."""
+        tasks = []
+        for adapter, label in assignments:
+            if "network:" + label in graph and "network:" + label not in tasks:
+                tasks.append("network:" + label)
+        return tasks
+
+    def network_name(self, label):
+        """Return the VirtualBox name of a network built now or previously deployed."""
+        if label in self.networks:
+            return self.networks[label].get_name()
+        return self.existing_networks[label]
+
+    def build_host(self, vmname, values, deployment_id):
+        """Import or clone a single host, run as a graph task."""
+        self.hosts[vmname] = Host(vmname, values["image"], values["username"], values["password"], deployment_id, linked=self.is_linked())
+
+    def assign_nics(self, vmname, values, assignments, internet):
+        """Assign a host's adapters and apply its settings before first boot, run as a graph task."""
+        self.configure_host(self.hosts[vmname], values, assignments, internet)
+
+    def configure_host(self, host, values, assignments, internet):
+        """Queue and apply a host's hardware and adapter settings."""
+        # Queue optional hardware settings
+        hardware = {key: values[key] for key in ["cpus", "memory"] if key in values}
+        if hardware:
+            host.configure(**hardware)
+        for adapter, networklabel in assignments:
+            host.assign_network(adapter, self.network_name(networklabel))
+        if internet:
+            try:
+                host.assign_internet(internet, values["internet_adapter"])
+            except Exception as e:
+                raise Exception("failed to assign internet adapter: " + repr(e)) 
+        # Apply all queued settings before first boot
+        host.apply_settings()
+
+    def reconfigure_host(self, host, values, assignments, internet):
+        """Change the adapters of a deployed host, run as a graph task."""
+        running = host.properties()["VMState"] == "running"
+        if running:
+            host.stop()
+        # Disable adapters no longer in the template
+        used = len(assignments) + (1 if internet else 0)
+        host.configure(**{"nic" + str(adapter): "none" for adapter in range(used + 1, 9)})
+        self.configure_host(host, values, assignments, internet)
+        if running:
+            host.start()
+
+    def print_timings(self, timings, total):
+        """Print the duration of each build task and the overall build."""
+        for name in sorted(timings, key=timings.get, reverse=True):
+            logging.info("Build task {0} took {1:.1f}s".format(name, timings[name]))
+        if timings:
+            slowest = max(timings, key=timings.get)
+            Print.print_information("Built {0} tasks in {1:.1f}s (slowest {2}: {3:.1f}s)".format(len(timings), total, slowest, timings[slowest]))
+
+    def is_linked(self):
+        """Check if the template requests hosts be built as linked clones of a base image."""
+        if "deployment" in self.template and self.template['deployment'].get('linked_clones'):
+            return True
+        return False
+
     def is_valid_deployment_name(self, deployment_name):
         """Check if the deployment name is in the database, if present raise an exception."""
         if Deployments.get_by_name(deployment_name) == None:
@@ -169,6 +440,11 @@ class Constructor():
         for host in self.hosts.values():
             host.destroy()
 
+    def clear_up_bases(self):
+        """Clear from virtualbox any base images created for, and only used by, this build."""
+        bases = set(host.get_base() for host in self.hosts.values())
+        Hosts().release_bases(bases)
+
     def clear_up_database(self, deployment_name):
         """Clear any built networks and hosts during the constructor phase."""
         # Get any networks writen to the database
@@ -1,6 +1,6 @@
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.engine.reflection import Inspector
 from pathlib import Path 
 import os 
@@ -19,6 +19,21 @@ def bind_engine(engine):
 def create_tables():
     """Initialise all tables in the database"""
     Base.metadata.create_all(engine)
+    upgrade_tables()
+
+def upgrade_tables():
+    """Add any columns missing from tables created by an earlier version"""
+    inspector = Inspector.from_engine(engine)
+    tables = inspector.get_table_names()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = [column["name"] for column in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name not in existing:
+                coltype = column.type.compile(dialect=engine.dialect)
+                with engine.begin() as connection:
+                    connection.execute(text("ALTER TABLE {0} ADD COLUMN {1} {2}".format(table.name, column.name, coltype)))
 
 def return_tables():
     """Return all tables in the database"""
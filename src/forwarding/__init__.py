@@ -0,0 +1,3 @@
+from .service import ForwardingService
+from .ports import PortAllocator
+from .gateway import Gateway
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+import argparse
+import threading
+import socket
+import time
+import os
+
+from forwarding.service import ForwardingService
+from forwarding.relay import SpliceChannel
+
+################################################################################
+# Throughput benchmark of the forwarding relay against a local echo server.
+# Run from src: python3 -m forwarding.benchmark [-s <MiB>] [-c <connections>]
+################################################################################
+
+def parseargs():
+    p = argparse.ArgumentParser(description='Benchmark forwarding throughput against a local echo server')
+    p.add_argument("-s", metavar='<MiB>', dest="size", type=int, default=256, help="MiB sent by each connection (default 256)")
+    p.add_argument("-c", metavar='<n>', dest="connections", type=int, default=4, help="Concurrent connections (default 4)")
+    p.add_argument("-b", metavar='<KiB>', dest="buffer", type=int, default=ForwardingService.buffer_size // 1024, help="Relay buffer per direction (default {0})".format(ForwardingService.buffer_size // 1024))
+    return vars(p.parse_args())
+
+def echo_server():
+    """Start a threaded echo server on a free local port, returns the port."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(64)
+
+    def echo(conn):
+        buf = bytearray(1024 * 1024)
+        view = memoryview(buf)
+        with conn:
+            while True:
+                n = conn.recv_into(buf)
+                if not n:
+                    break
+                conn.sendall(view[:n])
+
+    def serve():
+        while True:
+            conn = listener.accept()[0]
+            threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+def client(port, size, errors):
+    """Send size bytes through a port and read the echo back."""
+    chunk = os.urandom(1024 * 1024)
+    conn = socket.create_connection(("127.0.0.1", port))
+
+    def send():
+        sent = 0
+        while sent < size:
+            conn.sendall(chunk[:min(len(chunk), size - sent)])
+            sent += min(len(chunk), size - sent)
+        conn.shutdown(socket.SHUT_WR)
+
+    sender = threading.Thread(target=send, daemon=True)
+    sender.start()
+    buf = bytearray(1024 * 1024)
+    received = 0
+    while True:
+        n = conn.recv_into(buf)
+        if not n:
+            break
+        received += n
+    sender.join()
+    conn.close()
+    if received != size:
+        errors.append("received {0} of {1} bytes".format(received, size))
+
+def run(port, size, connections):
+    """Return (seconds, cpu seconds) to echo size bytes over each connection."""
+    errors = []
+    threads = [threading.Thread(target=client, args=(port, size, errors)) for _ in range(connections)]
+    start, cpu = time.time(), time.process_time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise Exception("Benchmark transfer failed: " + errors[0])
+    return time.time() - start, time.process_time() - cpu
+
+def main():
+    args = parseargs()
+    size = args["size"] * 1024 * 1024
+    echo_port = echo_server()
+    modes = [("direct", None), ("buffered", False)]
+    if SpliceChannel.available():
+        modes.append(("splice", True))
+
+    print("{0} connection(s), {1} MiB each way per connection".format(args["connections"], args["size"]))
+    print("{0:<10}{1:>12}{2:>12}".format("mode", "MiB/s", "cpu s"))
+    for name, splice in modes:
+        if splice is None:
+            port = echo_port
+        else:
+            # A fresh service per mode, relaying with the chosen channel
+            service = ForwardingService()
+            service.buffer_size = args["buffer"] * 1024
+            service.splice = splice
+            service.start()
+            port = service.add_route(0, "127.0.0.1", echo_port, host_addr="127.0.0.1", name=name)
+        seconds, cpu = run(port, size, args["connections"])
+        if splice is not None:
+            service.stop()
+        # Data crosses the relay in both directions
+        rate = 2 * size * args["connections"] / seconds / (1024 * 1024)
+        print("{0:<10}{1:>12.1f}{2:>12.2f}".format(name, rate, cpu))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+class Gateway(object):
+    """
+    HTTP CONNECT handshake of the single-port SSH gateway. A client opens
+    a tunnel to a guest with e.g. "CONNECT host1:22 HTTP/1.0" followed by
+    a blank line, as "nc -X connect -x <server>:<port> %h %p" does when
+    used as an OpenSSH ProxyCommand.
+    """
+    # Longest request accepted, headers included
+    max_request = 8192
+    ESTABLISHED = b"HTTP/1.1 200 Connection established\r\n\r\n"
+    BAD_REQUEST = b"HTTP/1.1 400 Bad Request\r\n\r\n"
+    FORBIDDEN = b"HTTP/1.1 403 Forbidden\r\n\r\n"
+    NOT_FOUND = b"HTTP/1.1 404 Not Found\r\n\r\n"
+    NOT_ALLOWED = b"HTTP/1.1 405 Method Not Allowed\r\n\r\n"
+    BAD_GATEWAY = b"HTTP/1.1 502 Bad Gateway\r\n\r\n"
+    TIMEOUT = b"HTTP/1.1 504 Gateway Timeout\r\n\r\n"
+
+    @staticmethod
+    def parse(request, dest_port):
+        """
+        Parse a CONNECT request, ending with a blank line.
+        Options:
+            request  (bytes): data received from the client
+            dest_port  (int): only port the client may connect to
+        Returns:
+            result (tuple): (name, preamble, error), name of the guest, bytes
+                            sent after the request and None, or an error
+                            response for the client if the request is refused
+        """
+        head, _, preamble = request.partition(b"\r\n\r\n")
+        fields = head.split(b"\r\n")[0].decode(errors="replace").split()
+        if len(fields) != 3 or not fields[2].startswith("HTTP/"):
+            return None, b"", Gateway.BAD_REQUEST
+        if fields[0].upper() != "CONNECT":
+            return None, b"", Gateway.NOT_ALLOWED
+        # Target is "name:port", a missing port means the destination port
+        name, sep, port = fields[1].rpartition(":")
+        if not sep:
+            name, port = fields[1], str(dest_port)
+        if not name:
+            return None, b"", Gateway.BAD_REQUEST
+        if port != str(dest_port):
+            return name, b"", Gateway.FORBIDDEN
+        return name, preamble, None
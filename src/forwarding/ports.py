@@ -0,0 +1,98 @@
+import threading
+
+class PortAllocator(object):
+    """
+    Allocator of host ports for SSH forwarding within a configurable range.
+    Allocations are tracked in an integer bitmap, bit i set meaning port
+    first + i is taken. The bitmap is loaded once from the recorded port
+    forwards in the database, reservations are made under a lock so hosts
+    forwarded in parallel never get the same port, and each candidate is
+    verified by binding it.
+    """
+    first = 2000
+    last = 2999
+    _bitmap = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def set_range(first, last):
+        """
+        Set the range of ports handed out, inclusive. Allocations are
+        reloaded from the database on next use.
+        """
+        if not 1 <= first <= last <= 65535:
+            raise Exception("Invalid port range " + str(first) + "-" + str(last))
+        with PortAllocator._lock:
+            PortAllocator.first = first
+            PortAllocator.last = last
+            PortAllocator._bitmap = None
+
+    @staticmethod
+    def ensure_loaded(loader):
+        """
+        Load the allocated ports, unless already loaded.
+        Options:
+            loader (func): returns the host ports recorded in the database
+        """
+        with PortAllocator._lock:
+            if PortAllocator._bitmap is None:
+                PortAllocator.mark(loader())
+
+    @staticmethod
+    def mark(ports):
+        """Set the bits of ports within the range, called with the lock held."""
+        bitmap = PortAllocator._bitmap or 0
+        for port in ports:
+            if port is not None and PortAllocator.first <= port <= PortAllocator.last:
+                bitmap |= 1 << (port - PortAllocator.first)
+        PortAllocator._bitmap = bitmap
+
+    @staticmethod
+    def allocate(bind):
+        """
+        Reserve the lowest free port in the range.
+        Options:
+            bind (func): called as bind(port), raises OSError if the port
+                         can't be bound, e.g. it is used by another program
+        Returns:
+            port (int): reserved port, bound by the bind function
+        """
+        with PortAllocator._lock:
+            bitmap = PortAllocator._bitmap or 0
+            # Ports found bound by other programs are skipped for this call only
+            skipped = 0
+            size = PortAllocator.last - PortAllocator.first + 1
+            while True:
+                taken = bitmap | skipped
+                # Lowest clear bit of the bitmap
+                offset = (~taken & (taken + 1)).bit_length() - 1
+                if offset >= size:
+                    raise Exception("No free port in range " + str(PortAllocator.first) + "-" + str(PortAllocator.last))
+                port = PortAllocator.first + offset
+                try:
+                    bind(port)
+                except OSError:
+                    skipped |= 1 << offset
+                    continue
+                PortAllocator._bitmap = bitmap | (1 << offset)
+                return port
+
+    @staticmethod
+    def release(ports):
+        """Free a list of ports, e.g. when their forwarders are torn down."""
+        with PortAllocator._lock:
+            if PortAllocator._bitmap is None:
+                return
+            for port in ports:
+                if port is not None and PortAllocator.first <= port <= PortAllocator.last:
+                    PortAllocator._bitmap &= ~(1 << (port - PortAllocator.first))
+
+    @staticmethod
+    def stats():
+        """Return the range and number of allocated ports for printing purposes."""
+        with PortAllocator._lock:
+            return {
+                "first": PortAllocator.first,
+                "last": PortAllocator.last,
+                "allocated": bin(PortAllocator._bitmap or 0).count("1"),
+            }
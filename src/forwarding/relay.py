@@ -0,0 +1,232 @@
+import selectors
+import socket
+import fcntl
+import time
+import os
+
+class BufferedChannel(object):
+    """
+    One direction of a relay, copying from a source socket to a destination
+    socket through a preallocated buffer. Data is received straight into
+    the free end of the buffer and sent from a memoryview of the filled
+    part, so no bytes objects are created per read.
+    """
+
+    def __init__(self, src, dst, size):
+        self.src = src
+        self.dst = dst
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        # Filled part of the buffer is [start:end]
+        self.start = 0
+        self.end = 0
+        # Source reached end of stream, destination write side shut down
+        self.eof = False
+        self.shut = False
+        # Bytes read from the source
+        self.transferred = 0
+
+    def readable(self):
+        """Return True if the channel can take more data from its source."""
+        return not self.eof and self.end < self.size
+
+    def pending(self):
+        """Return True if data is waiting to be written to the destination."""
+        return self.end > self.start
+
+    def fill(self):
+        """Receive from the source into the free part of the buffer."""
+        try:
+            n = self.src.recv_into(self.view[self.end:])
+        except (BlockingIOError, InterruptedError):
+            return
+        if n:
+            self.end += n
+            self.transferred += n
+        else:
+            self.eof = True
+
+    def preload(self, data):
+        """Queue data for the destination ahead of anything read, at most size bytes."""
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def drain(self):
+        """Send as much buffered data to the destination as it will take."""
+        if not self.pending():
+            return
+        try:
+            self.start += self.dst.send(self.view[self.start:self.end])
+        except (BlockingIOError, InterruptedError):
+            return
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start > self.size // 2:
+            # Move a small remainder to the front to free space for reads
+            remaining = self.end - self.start
+            self.view[:remaining] = self.view[self.start:self.end]
+            self.start, self.end = 0, remaining
+
+    def close(self):
+        """Release the buffer."""
+        self.view.release()
+
+
+class SpliceChannel(object):
+    """
+    One direction of a relay using splice(2), Linux only. Data moves from
+    the source socket into a pipe and from the pipe into the destination
+    socket without being copied through user space.
+    """
+    flags = getattr(os, "SPLICE_F_MOVE", 0) | getattr(os, "SPLICE_F_NONBLOCK", 0)
+
+    def __init__(self, src, dst, size):
+        self.src = src
+        self.dst = dst
+        self.pipe_r, self.pipe_w = os.pipe()
+        # Grow the pipe to the buffer size where allowed, the default is 64KiB
+        try:
+            self.size = fcntl.fcntl(self.pipe_w, fcntl.F_SETPIPE_SZ, size)
+        except (AttributeError, OSError):
+            self.size = 65536
+        # Bytes held in the pipe
+        self.queued = 0
+        self.eof = False
+        self.shut = False
+        self.transferred = 0
+
+    @staticmethod
+    def available():
+        """Return True if splice(2) can be used on this platform."""
+        return hasattr(os, "splice") and hasattr(os, "SPLICE_F_NONBLOCK")
+
+    def readable(self):
+        """Return True if the channel can take more data from its source."""
+        return not self.eof and self.queued < self.size
+
+    def pending(self):
+        """Return True if data is waiting to be written to the destination."""
+        return self.queued > 0
+
+    def fill(self):
+        """Splice from the source socket into the pipe."""
+        try:
+            n = os.splice(self.src.fileno(), self.pipe_w, self.size - self.queued, flags=SpliceChannel.flags)
+        except (BlockingIOError, InterruptedError):
+            return
+        if n:
+            self.queued += n
+            self.transferred += n
+        else:
+            self.eof = True
+
+    def preload(self, data):
+        """Queue data for the destination ahead of anything read, smaller than the pipe."""
+        view = memoryview(data)
+        while view:
+            written = os.write(self.pipe_w, view)
+            self.queued += written
+            view = view[written:]
+
+    def drain(self):
+        """Splice from the pipe into the destination socket."""
+        if not self.pending():
+            return
+        try:
+            self.queued -= os.splice(self.pipe_r, self.dst.fileno(), self.queued, flags=SpliceChannel.flags)
+        except (BlockingIOError, InterruptedError):
+            return
+
+    def close(self):
+        """Close the pipe."""
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+
+class Relay(object):
+    """
+    A forwarded connection, a client socket paired with its upstream socket
+    by a channel in each direction. Each direction is shut down on its own,
+    once its source has ended and everything read has been written, so
+    half-closed connections keep flowing the other way.
+    """
+
+    def __init__(self, route, client, upstream, buffer_size=65536, splice=False, to_upstream=b"", to_client=b""):
+        self.route = route
+        self.sockets = (client, upstream)
+        channel = SpliceChannel if splice else BufferedChannel
+        self.channels = [channel(client, upstream, buffer_size)]
+        try:
+            self.channels.append(channel(upstream, client, buffer_size))
+        except OSError:
+            self.channels[0].close()
+            raise
+        # Data to send before anything relayed, e.g. a gateway's response
+        self.channels[0].preload(to_upstream)
+        self.channels[1].preload(to_client)
+        self.closed = False
+        self.started = time.time()
+        # Set by the service once connected
+        self.address = None
+        self.name = route.name
+        self.connect_time = None
+
+    def interest(self, sock):
+        """Return the selector events a socket should be registered for."""
+        events = 0
+        for channel in self.channels:
+            if channel.src is sock and channel.readable():
+                events |= selectors.EVENT_READ
+            if channel.dst is sock and channel.pending():
+                events |= selectors.EVENT_WRITE
+        return events
+
+    def service(self, sock, events):
+        """Move data for a socket reported ready by the selector."""
+        for channel in self.channels:
+            if channel.src is sock and events & selectors.EVENT_READ:
+                channel.fill()
+                # Write straight away rather than waiting for the next select
+                channel.drain()
+            elif channel.dst is sock and events & selectors.EVENT_WRITE:
+                channel.drain()
+            # Pass the half-close on once everything read has been written
+            if channel.eof and not channel.pending() and not channel.shut:
+                channel.shut = True
+                channel.dst.shutdown(socket.SHUT_WR)
+
+    def finished(self):
+        """Return True once both directions have been shut down."""
+        return all(channel.shut for channel in self.channels)
+
+    def bytes_in(self):
+        """Return bytes relayed from the client to the destination."""
+        return self.channels[0].transferred
+
+    def bytes_out(self):
+        """Return bytes relayed from the destination to the client."""
+        return self.channels[1].transferred
+
+    def dict(self):
+        """Return a dictionary of the connection for printing purposes."""
+        return {
+            "address": "{0}:{1}".format(*self.address) if self.address else None,
+            "guest": self.name,
+            # Buffered where splice(2) is not available
+            "relay": "splice" if isinstance(self.channels[0], SpliceChannel) else "buffered",
+            "bytes_in": self.bytes_in(),
+            "bytes_out": self.bytes_out(),
+            "connect_ms": round(1000 * self.connect_time, 1) if self.connect_time is not None else None,
+            "duration": round(time.time() - self.started, 1),
+        }
+
+    def close(self):
+        """Close both sockets and release the channels."""
+        if self.closed:
+            return
+        self.closed = True
+        for channel in self.channels:
+            channel.close()
+        for sock in self.sockets:
+            sock.close()
@@ -0,0 +1,683 @@
+from concurrent.futures import Future
+import selectors
+import threading
+import logging
+import socket
+import queue
+import errno
+import time
+import os
+
+from forwarding.relay import Relay, SpliceChannel
+from forwarding.gateway import Gateway
+
+class Timing(object):
+    """
+    Running count, mean, min and max of a duration, cheap to update.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, duration):
+        """Add a single duration."""
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+
+    def dict(self):
+        """Return a dictionary of the timing in milliseconds for printing purposes."""
+        return {
+            "count": self.count,
+            "mean": round(1000 * self.total / self.count, 1) if self.count else None,
+            "min": round(1000 * self.min, 1) if self.min is not None else None,
+            "max": round(1000 * self.max, 1) if self.max is not None else None,
+        }
+
+
+class Route(object):
+    """
+    A listening port forwarded to a destination address and port, with
+    traffic counters for its connections. Counters are only updated on
+    the event loop thread.
+    """
+
+    def __init__(self, listener, host_addr, host_port, dest_addr, dest_port, name=None, group=None, backlog=128, max_connections=64, resolve=None):
+        self.listener = listener
+        self.host_addr = host_addr
+        self.host_port = host_port
+        self.dest_addr = dest_addr
+        self.dest_port = dest_port
+        # Gateway routes resolve the destination of each connection, see add_gateway
+        self.resolve = resolve
+        self.name = name
+        self.group = group
+        self.backlog = backlog
+        self.max_connections = max_connections
+        # Listener restarts, None while the listener is down awaiting restart
+        self.restarts = 0
+        self.last_error = None
+        self.retry_at = None
+        self.backoff = None
+        self.relays = set()
+        # Clients waiting for their upstream connection
+        self.connecting = set()
+        # Listener unregistered while the route is at its connection cap
+        self.paused = False
+        self.accepted = 0
+        self.errors = 0
+        # Bytes relayed by closed connections, open connections are added on read
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Time to connect to the destination, and lifetime of closed connections
+        self.connect = Timing()
+        self.duration = Timing()
+
+    def full(self):
+        """Return True if the route is at its connection cap."""
+        return len(self.relays) + len(self.connecting) >= self.max_connections
+
+    def closed(self, relay):
+        """Fold a closed connection's counters into the route."""
+        self.relays.discard(relay)
+        self.bytes_in += relay.bytes_in()
+        self.bytes_out += relay.bytes_out()
+        self.duration.record(time.time() - relay.started)
+
+    def state(self):
+        """Return "listening", "full" at the connection cap, or "restarting"."""
+        if self.listener is None:
+            return "restarting"
+        return "full" if self.paused else "listening"
+
+    def dict(self):
+        """Return a dictionary of the route for printing purposes."""
+        return {
+            "name": self.name,
+            "group": self.group,
+            "state": self.state(),
+            "restarts": self.restarts,
+            "last_error": self.last_error,
+            "host_port": self.host_port,
+            "dest_addr": self.dest_addr,
+            "dest_port": self.dest_port,
+            "active": len(self.relays),
+            "connecting": len(self.connecting),
+            "max_connections": self.max_connections,
+            "accepted": self.accepted,
+            "errors": self.errors,
+            "bytes_in": self.bytes_in + sum(relay.bytes_in() for relay in self.relays),
+            "bytes_out": self.bytes_out + sum(relay.bytes_out() for relay in self.relays),
+            "connect_ms": self.connect.dict(),
+            "duration_ms": self.duration.dict(),
+        }
+
+
+class Connect(object):
+    """
+    An accepted client waiting for its upstream connect. Gateway clients
+    first send a CONNECT request naming the guest, which is then resolved.
+    """
+
+    def __init__(self, route, client, address, timeout):
+        self.route = route
+        self.client = client
+        self.address = address
+        self.upstream = None
+        self.dest_addr = None
+        self.started = time.time()
+        self.deadline = self.started + timeout
+        # Gateway request, the guest it names and bytes sent after it
+        self.buffer = bytearray()
+        self.name = route.name
+        self.preamble = b""
+
+
+class ForwardingService(object):
+    """
+    Single event loop relaying TCP traffic for every forwarded port. Routes
+    are listening sockets bound by the caller, then handed to the loop,
+    every accepted connection is relayed by the same thread. Routes can be
+    added and removed at runtime from any thread.
+
+    Upstream connects are non-blocking, so a guest that doesn't answer
+    only delays its own clients. A route stops accepting at its connection
+    cap, leaving clients in the listen backlog, and a side of a connection
+    is not read while the other side can't take more data.
+
+    The service supervises its routes: a listener that fails is closed and
+    bound again after an exponential backoff, until its route is removed.
+    """
+    backlog = 128
+    max_connections = 64
+    connect_timeout = 5
+    # Delay before restarting a failed listener, doubled on each failure
+    restart_delay = 1
+    max_restart_delay = 60
+    # Bytes buffered per direction of each connection
+    buffer_size = 256 * 1024
+    # Relay with splice(2) where the platform supports it
+    splice = SpliceChannel.available()
+    _shared = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.routes = {}
+        self.connecting = set()
+        # Routes whose listener failed, awaiting restart
+        self.restarting = set()
+        self.commands = queue.Queue()
+        self.thread = None
+        self.running = False
+        # Self-pipe used to wake the loop when a command is queued
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+
+    @staticmethod
+    def shared():
+        """Return the process-wide forwarding service, starting it if needed."""
+        with ForwardingService._lock:
+            if ForwardingService._shared is None:
+                ForwardingService._shared = ForwardingService()
+            ForwardingService._shared.start()
+            return ForwardingService._shared
+
+    @staticmethod
+    def after_fork():
+        """
+        Forget the shared service in a forked child, whose copy has no event
+        loop thread. The child's copies of its sockets are closed.
+        """
+        stale = ForwardingService._shared
+        ForwardingService._shared = None
+        ForwardingService._lock = threading.Lock()
+        if stale is not None:
+            stale.discard()
+
+    def discard(self):
+        """
+        Close this process's copies of the service's sockets without touching
+        the selector's registrations, which a forked child shares with its parent.
+        """
+        for route in self.routes.values():
+            if route.listener is not None:
+                route.listener.close()
+            for relay in route.relays:
+                relay.close()
+        for connect in self.connecting:
+            connect.client.close()
+            if connect.upstream is not None:
+                connect.upstream.close()
+        self.wake_r.close()
+        self.wake_w.close()
+        self.selector.close()
+        self.routes = {}
+        self.connecting = set()
+        self.running = False
+
+    def start(self):
+        """Start the event loop thread, unless already running."""
+        if self.running:
+            return
+        self.running = True
+        self.selector.register(self.wake_r, selectors.EVENT_READ, ("wake", None))
+        self.thread = threading.Thread(target=self.run, daemon=True, name="avn-forwarding")
+        self.thread.start()
+
+    def stop(self):
+        """Close every route and connection and stop the event loop."""
+        if not self.running:
+            return
+        self.call(self._stop).result()
+        self.thread.join()
+
+    ############################################
+    # Public API, safe to call from any thread
+    ############################################
+
+    def add_route(self, host_port, dest_addr, dest_port=22, host_addr='', name=None, group=None, backlog=None, max_connections=None):
+        """
+        Listen on a port and forward its connections to a destination.
+        Options:
+            host_port       (int): port to listen on, 0 picks a free port
+            dest_addr       (str): address to forward to
+            dest_port       (int): port to forward to, default 22
+            host_addr       (str): address to listen on, default all
+            name            (str): label for the route, e.g. the vmname
+            group                  : key to remove routes together, e.g. the deployment
+            backlog         (int): listen backlog, default ForwardingService.backlog
+            max_connections (int): open connections allowed, default ForwardingService.max_connections
+        Returns:
+            host_port (int): port listened on
+        Raises OSError if the port can't be bound.
+        """
+        backlog = backlog or self.backlog
+        listener = ForwardingService.listen(host_addr, host_port, backlog)
+        route = Route(listener, host_addr, listener.getsockname()[1], dest_addr, dest_port, name, group,
+                      backlog, max_connections or self.max_connections)
+        self.call(self._add_route, route).result()
+        return route.host_port
+
+    def add_gateway(self, host_port, resolve, dest_port=22, host_addr='', name="gateway", group="gateway", backlog=None, max_connections=None):
+        """
+        Listen on one port for connections to any guest. Each client sends
+        an HTTP CONNECT request naming the guest, e.g. "CONNECT host1:22",
+        as OpenSSH's ProxyCommand does with "nc -X connect", and is then
+        relayed to that guest's dest_port.
+        Options:
+            host_port (int): port to listen on
+            resolve  (func): called as resolve(name), returns a Future of the
+                             guest's address, or of None if it is unknown
+            dest_port (int): only port clients may connect to, default 22
+        Returns:
+            host_port (int): port listened on
+        Raises OSError if the port can't be bound.
+        """
+        backlog = backlog or self.backlog
+        listener = ForwardingService.listen(host_addr, host_port, backlog)
+        route = Route(listener, host_addr, listener.getsockname()[1], "*", dest_port, name, group,
+                      backlog, max_connections or self.max_connections, resolve)
+        self.call(self._add_route, route).result()
+        return route.host_port
+
+    @staticmethod
+    def listen(host_addr, host_port, backlog):
+        """Return a non-blocking socket listening on a port, raises OSError if it can't be bound."""
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((host_addr, host_port))
+            listener.listen(backlog)
+            listener.setblocking(False)
+        except OSError:
+            listener.close()
+            raise
+        return listener
+
+    def remove_route(self, host_port):
+        """
+        Stop listening on a port and close its connections.
+        Returns True if the route existed.
+        """
+        return self.call(self._remove_route, host_port).result()
+
+    def remove_group(self, group):
+        """
+        Stop listening on every port of a group and close their connections.
+        Returns:
+            host_ports (list): ports of the removed routes
+        """
+        def remove():
+            host_ports = [host_port for host_port, route in self.routes.items() if route.group == group]
+            for host_port in host_ports:
+                self._remove_route(host_port)
+            return host_ports
+        return self.call(remove).result()
+
+    def get_routes(self, group=None):
+        """Return a dictionary of each route, optionally of one group, for printing purposes."""
+        return self.call(lambda: [route.dict() for route in self.routes.values()
+                                  if group is None or route.group == group]).result()
+
+    def get_stats(self):
+        """
+        Return traffic counters for each route and its open connections.
+        Returns:
+            stats (list): [{name: , host_port: , ..., connections: [{address: , bytes_in: , ...}]}]
+        """
+        def collect():
+            stats = []
+            for host_port in sorted(self.routes):
+                route = self.routes[host_port]
+                data = route.dict()
+                data["connections"] = [relay.dict() for relay in route.relays]
+                stats.append(data)
+            return stats
+        return self.call(collect).result()
+
+    def call(self, func, *args):
+        """Run a function on the event loop thread, returns a Future for its result."""
+        future = Future()
+        if not self.running:
+            future.set_exception(Exception("Forwarding service is not running"))
+            return future
+        self.commands.put((future, func, args))
+        try:
+            self.wake_w.send(b"\0")
+        except BlockingIOError:
+            # Wake-up already pending
+            pass
+        return future
+
+    ############################################
+    # Event loop, only run on the loop thread
+    ############################################
+
+    def run(self):
+        """Dispatch socket events until stopped."""
+        while self.running:
+            # Wake up in time for the first connect deadline or listener restart
+            deadlines = [connect.deadline for connect in self.connecting] + [route.retry_at for route in self.restarting]
+            timeout = max(0, min(deadlines) - time.time()) if deadlines else None
+            for key, events in self.selector.select(timeout):
+                if key.fileobj.fileno() < 0:
+                    # Closed by an earlier event in this batch
+                    continue
+                kind, obj = key.data
+                try:
+                    if kind == "wake":
+                        self._run_commands()
+                    elif kind == "listen":
+                        try:
+                            self._accept(obj)
+                        except OSError as e:
+                            self._listener_failed(obj, e)
+                    elif kind == "handshake":
+                        self._handshake(obj)
+                    elif kind == "connect":
+                        self._connected(obj)
+                    elif kind == "relay":
+                        self._service(obj, key.fileobj, events)
+                except Exception:
+                    logging.exception("Forwarding service error")
+                    if kind == "relay":
+                        self._close_relay(obj)
+                    elif kind in ("handshake", "connect"):
+                        self._fail_connect(obj, "internal error")
+            try:
+                self._expire_connects()
+                self._restart_listeners()
+            except Exception:
+                logging.exception("Forwarding service error")
+        self.selector.close()
+
+    def _run_commands(self):
+        """Run every queued command."""
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                future, func, args = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _add_route(self, route):
+        if route.host_port in self.routes:
+            route.listener.close()
+            raise Exception("Port " + str(route.host_port) + " is already forwarded")
+        self.routes[route.host_port] = route
+        self.selector.register(route.listener, selectors.EVENT_READ, ("listen", route))
+
+    def _remove_route(self, host_port):
+        route = self.routes.pop(host_port, None)
+        if route is None:
+            return False
+        self.restarting.discard(route)
+        if route.listener is not None:
+            if not route.paused:
+                self.selector.unregister(route.listener)
+            route.listener.close()
+        for connect in list(route.connecting):
+            self._drop_connect(connect)
+        for relay in list(route.relays):
+            self._close_relay(relay)
+        return True
+
+    def _stop(self):
+        for host_port in list(self.routes):
+            self._remove_route(host_port)
+        self.selector.unregister(self.wake_r)
+        self.running = False
+
+    def _accept(self, route):
+        """Accept pending connections on a route and start connecting them upstream."""
+        while not route.full():
+            try:
+                client, address = route.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionAbortedError:
+                # Client gave up while queued in the backlog
+                continue
+            # The listener is working, a later failure starts from the initial delay
+            route.backoff = None
+            connect = Connect(route, client, address, self.connect_timeout)
+            route.connecting.add(connect)
+            self.connecting.add(connect)
+            if route.resolve is None:
+                self._start_connect(connect, route.dest_addr)
+            else:
+                # Gateway clients first name the guest they want
+                client.setblocking(False)
+                self.selector.register(client, selectors.EVENT_READ, ("handshake", connect))
+        # Leave further clients in the listen backlog until a connection closes
+        self.selector.unregister(route.listener)
+        route.paused = True
+
+    def _resume(self, route):
+        """Accept on a paused route again once it is below its connection cap."""
+        if route.paused and not route.full() and self.routes.get(route.host_port) is route:
+            route.paused = False
+            if route.listener is not None:
+                self.selector.register(route.listener, selectors.EVENT_READ, ("listen", route))
+
+    def _listener_failed(self, route, error):
+        """Close a failed listener and schedule its restart, open connections are kept."""
+        logging.warning("Forwarding listener on port {0} failed: {1}".format(route.host_port, error))
+        if not route.paused:
+            self.selector.unregister(route.listener)
+        route.listener.close()
+        route.listener = None
+        route.paused = False
+        route.last_error = str(error)
+        self._schedule_restart(route)
+
+    def _schedule_restart(self, route):
+        """Set the time of a route's next listener restart, doubling the delay each time."""
+        route.backoff = min(2 * route.backoff, self.max_restart_delay) if route.backoff else self.restart_delay
+        route.retry_at = time.time() + route.backoff
+        self.restarting.add(route)
+
+    def _restart_listeners(self):
+        """Bind the listeners of routes whose restart is due."""
+        now = time.time()
+        for route in [route for route in self.restarting if route.retry_at <= now]:
+            self.restarting.discard(route)
+            try:
+                route.listener = ForwardingService.listen(route.host_addr, route.host_port, route.backlog)
+            except OSError as e:
+                logging.warning("Restarting forwarding listener on port {0} failed: {1}".format(route.host_port, e))
+                route.last_error = str(e)
+                self._schedule_restart(route)
+                continue
+            route.restarts += 1
+            route.retry_at = None
+            if route.full():
+                route.paused = True
+            else:
+                self.selector.register(route.listener, selectors.EVENT_READ, ("listen", route))
+            logging.info("Forwarding listener on port {0} restarted".format(route.host_port))
+
+    def _start_connect(self, connect, dest_addr):
+        """Start a non-blocking connect to the route's destination port."""
+        connect.upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connect.upstream.setblocking(False)
+        connect.dest_addr = dest_addr
+        connect.deadline = time.time() + self.connect_timeout
+        err = connect.upstream.connect_ex((dest_addr, connect.route.dest_port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._fail_connect(connect, os.strerror(err), Gateway.BAD_GATEWAY)
+            return
+        self.selector.register(connect.upstream, selectors.EVENT_WRITE, ("connect", connect))
+
+    def _handshake(self, connect):
+        """Read a gateway client's CONNECT request and resolve the guest it names."""
+        try:
+            data = connect.client.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            self._fail_connect(connect, "client closed before CONNECT")
+            return
+        connect.buffer += data
+        if b"\r\n\r\n" not in connect.buffer:
+            if len(connect.buffer) > Gateway.max_request:
+                self._fail_connect(connect, "CONNECT request too long", Gateway.BAD_REQUEST)
+            return
+        self.selector.unregister(connect.client)
+        name, connect.preamble, error = Gateway.parse(bytes(connect.buffer), connect.route.dest_port)
+        connect.name = name
+        if error:
+            self._fail_connect(connect, "refused " + error.decode().split("\r\n")[0], error)
+            return
+        future = connect.route.resolve(name)
+        # Resolved off the loop, the result is handed back through call()
+        future.add_done_callback(lambda f: self.call(self._resolved, connect, f))
+
+    def _resolved(self, connect, future):
+        """Connect a gateway client to the address its guest resolved to."""
+        if connect not in self.connecting:
+            # Timed out or removed with its route while resolving
+            return
+        try:
+            dest_addr = future.result()
+        except Exception as e:
+            logging.warning("Resolving {0} failed: {1}".format(connect.name, e))
+            dest_addr = None
+        if not dest_addr:
+            self._fail_connect(connect, "no address for " + str(connect.name), Gateway.NOT_FOUND)
+            return
+        self._start_connect(connect, dest_addr)
+
+    def _connected(self, connect):
+        """Start relaying a client once its upstream connect completes."""
+        route = connect.route
+        self._drop_connect(connect, close=False)
+        err = connect.upstream.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self._fail_connect(connect, os.strerror(err), Gateway.BAD_GATEWAY)
+            return
+        route.connect.record(time.time() - connect.started)
+        connect.client.setblocking(False)
+        # Gateway clients are told the tunnel is open, and any bytes they
+        # sent after the request are passed on
+        to_client = Gateway.ESTABLISHED if route.resolve is not None else b""
+        try:
+            relay = Relay(route, connect.client, connect.upstream, self.buffer_size, self.splice,
+                          to_upstream=connect.preamble, to_client=to_client)
+        except OSError as e:
+            # Out of file descriptors for the splice pipes
+            self._fail_connect(connect, str(e), Gateway.BAD_GATEWAY)
+            return
+        relay.address = connect.address
+        relay.name = connect.name
+        relay.connect_time = time.time() - connect.started
+        route.relays.add(relay)
+        route.accepted += 1
+        for sock in relay.sockets:
+            self.selector.register(sock, selectors.EVENT_READ, ("relay", relay))
+            self._update(relay, sock)
+
+    def _expire_connects(self):
+        """Give up on handshakes and upstream connects past their deadline."""
+        now = time.time()
+        for connect in [connect for connect in self.connecting if connect.deadline <= now]:
+            self._fail_connect(connect, "timed out after " + str(self.connect_timeout) + "s", Gateway.TIMEOUT)
+
+    def _drop_connect(self, connect, close=True):
+        """Stop waiting for a handshake or upstream connect."""
+        self.connecting.discard(connect)
+        connect.route.connecting.discard(connect)
+        for sock in (connect.client, connect.upstream):
+            if sock is None:
+                continue
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+            if close:
+                sock.close()
+
+    def _fail_connect(self, connect, reason, response=None):
+        """Close a client whose handshake or upstream connect failed."""
+        route = connect.route
+        self._drop_connect(connect, close=False)
+        logging.warning("Forwarding to {0}:{1} failed: {2}".format(connect.dest_addr or connect.name, route.dest_port, reason))
+        route.errors += 1
+        if route.resolve is not None and response:
+            try:
+                # Best effort, the client is closed either way
+                connect.client.send(response)
+            except OSError:
+                pass
+        connect.client.close()
+        if connect.upstream is not None:
+            connect.upstream.close()
+        self._resume(route)
+
+    def _service(self, relay, sock, events):
+        """Move data for one side of a relay."""
+        if relay.closed:
+            return
+        try:
+            relay.service(sock, events)
+        except OSError as e:
+            # Connection reset or broken by either end
+            logging.debug("Forwarded connection on port {0} closed: {1}".format(relay.route.host_port, e))
+            relay.route.errors += 1
+            self._close_relay(relay)
+            return
+        if relay.finished():
+            self._close_relay(relay)
+            return
+        for side in relay.sockets:
+            self._update(relay, side)
+
+    def _update(self, relay, sock):
+        """Register a socket for the events it currently needs."""
+        events = relay.interest(sock)
+        try:
+            registered = self.selector.get_key(sock).events
+        except KeyError:
+            registered = 0
+        if events == registered:
+            return
+        if not registered:
+            self.selector.register(sock, events, ("relay", relay))
+        elif not events:
+            self.selector.unregister(sock)
+        else:
+            self.selector.modify(sock, events, ("relay", relay))
+
+    def _close_relay(self, relay):
+        """Close both sides of a relay."""
+        if relay.closed:
+            return
+        relay.route.closed(relay)
+        self._resume(relay.route)
+        for sock in relay.sockets:
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+        relay.close()
+
+
+# Threads are not copied into a forked child, e.g. the REST API server process
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=ForwardingService.after_fork)
@@ -4,3 +4,4 @@ from . import deployment
 from . import port_forward
 from . import user
 from . import token
+from . import snapshot
@@ -4,10 +4,13 @@ import re
 import os
 import time
 import netifaces
+from vbox import VBoxManage, Inventory, VMSettings, LeaseIndex, BaseImage, StateWatcher
+from warm_pool import WarmPool
 from models.network import Network
 from models.port_forward import PortForward
 from tabulate import tabulate
-from autossh import ssh_shell
+from autossh import ssh_shell, KnownHosts, SSHKeys, SSHPool
+from forwarding import ForwardingService, PortAllocator
 from print_colours import Print
 
 from sqlalchemy import Column, Integer, String, Sequence, ForeignKey
@@ -27,8 +30,11 @@ class Host(Base):
     password = Column(String)
     deployment_id = Column(Integer, ForeignKey('deployments.id'))
     ssh_remote_port = Column(Integer, unique=True)
+    base = Column(String)
+    # MAC addresses per vmname, fixed once the machine is imported
+    mac_cache = {}
 
-    def __init__(self, vmname, image, username, password, deployment_id):
+    def __init__(self, vmname, image, username, password, deployment_id, linked=False):
         """
         Initialises Ubuntu Server 20.04 virtual machine via VirtualBox
         Options:
@@ -36,6 +42,7 @@ class Host(Base):
             image       (str): name of the .ova image located in vm_templates directory
             username    (str): username of the machine
             password    (str): password of the machine
+            linked     (bool): create as a linked clone of the image's base vm (default is False)
         """
         self.vmname = vmname
         self.image = image
@@ -43,29 +50,25 @@ class Host(Base):
         self.password = password
         self.deployment_id = deployment_id
         self.ssh_port = None
+        self.base = None
         # Check if image template or vmname already exists
         if self.check_exists(image):
             raise Exception("Template image already exists, unable to duplicate")
         if self.check_exists(vmname):
             raise Exception("VM image with assigned name already exists")
-        # Import image into VirtualBox
-        self.import_image()
-        # Write to database
-        try:
-            self.write_to_db()
-        except Exception as e:
-            raise Exception("Faied to add host model to database: " + repr(e))
+        # Take a ready machine from the warm pool, else import image into VirtualBox
+        if not self.claim_image(linked):
+            if linked:
+                self.clone_image()
+            else:
+                self.import_image()
 
     @classmethod
     def check_exists(self, vmname):
         """Check if a virtual machine with the given label exists."""
-        # Collate list of currently imported vm names
-        cmd = ['vboxmanage list vms']
-        vmsfound = re.findall(r"\"(.*)\"", subprocess.getoutput(cmd))
-        # Check if any match
-        for name in vmsfound:
-            if vmname == name:
-                return True
+        # Check against the cached list of currently imported vm names
+        if vmname in Inventory.vms():
+            return True
 
     def import_image(self):
         """Import vm .ova image into VirtualBox"""
@@ -75,11 +78,10 @@ class Host(Base):
         if not os.path.isfile(images_path):
             raise Exception("Virtual machine '.ova'. template not found")
         # Form path to image
-        try:
-            cmd = 'VBoxManage import ' + "\"" + str(images_path) + "\"" + ' --vsys 0 --vmname ' + self.vmname
-            subprocess.getoutput(cmd)
-        except Exception as e:
-            raise Exception("Failed to import image") 
+        r = VBoxManage.run("import", str(images_path), "--vsys", "0", "--vmname", self.vmname)
+        Inventory.invalidate("vms")
+        if not r.ok:
+            raise Exception("Failed to import image: " + r.stderr.strip())
 
         # Check vm successfully imported
         if not self.check_exists(self.vmname):
@@ -87,6 +89,28 @@ class Host(Base):
         else:
             Print.print_success("Successfully imported machine " + self.vmname)
 
+    def clone_image(self):
+        """Create the vm as a linked clone of the image's snapshotted base vm"""
+        self.base = BaseImage.clone(self.image, self.vmname)
+        # Check vm successfully cloned
+        if not self.check_exists(self.vmname):
+            raise Exception("Failed to clone virtual machine.")
+        else:
+            Print.print_success("Successfully cloned machine " + self.vmname + " from " + self.base)
+
+    def claim_image(self, linked=False):
+        """Claim a pre-imported vm from the warm pool, returns False if none are ready"""
+        if not WarmPool.claim(self.image, self.vmname, linked):
+            return False
+        if linked:
+            self.base = BaseImage.name(self.image)
+        Print.print_success("Claimed machine " + self.vmname + " from the warm pool")
+        return True
+
+    def get_base(self):
+        """Return the base vm the host was cloned from, None if fully imported."""
+        return self.base
+
     def assign_network(self, adapter, netname):
         """
         Assign a virtual machine adapter to a network
@@ -97,12 +121,11 @@ class Host(Base):
         # Check network exists
         if not Network.check_exists(netname):
             raise Exception("Unable to assign network, does not exist.")
+        settings = self.pending_settings()
         # Set network interface type to host-only
-        cmd = 'vboxmanage modifyvm ' + self.vmname + ' --nic' + str(adapter) + ' hostonly'
-        subprocess.getoutput(cmd)
+        settings.nic(adapter, "hostonly")
         # Assign network interface adapter to the host-only network
-        cmd = 'vboxmanage modifyvm ' + self.vmname + ' --hostonlyadapter' + str(adapter) + ' ' + netname
-        subprocess.getoutput(cmd)
+        settings.hostonly_adapter(adapter, netname)
 
     def assign_internet(self, adapter, nettype='bridged'):
         """
@@ -123,37 +146,62 @@ class Host(Base):
                 Print.print_success("Interface identified")
             except Exception as e:
                 raise Exception("failed to retrieve interface name" + repr(e)) 
-        # Build command for assigning adapter to interface
+        # Queue settings for assigning adapter to interface
+        settings = self.pending_settings()
         if nettype == 'nat':
-            try:
-                cmd = 'vboxmanage modifyvm ' + self.vmname + ' --nic' + str(adapter) + ' ' + 'nat'
-                # Assign network interface 
-                subprocess.getoutput(cmd)
-            except Exception as e:
-                raise Exception("failed to assign nat adapter " + repr(e))
+            settings.nic(adapter, "nat")
         elif nettype == 'bridged':
-            try:
-                cmd = 'vboxmanage modifyvm ' + self.vmname + ' --nic' + str(adapter) + ' ' + nettype + " --bridgeadapter2 " + "'" + iface + "'"
-                # Assign network interface 
-                subprocess.getoutput(cmd)
-            except Exception as e:
-                raise Exception("failed to assign bridged adapter " + repr(e)) 
+            settings.nic(adapter, nettype)
+            settings.bridge_adapter(adapter, iface)
         else: 
             raise Exception("Invalid nettype, please choose between 'bridged' and 'nat'.")
 
+    def configure(self, **options):
+        """
+        Queue additional modifyvm options, e.g. configure(cpus=2, memory=2048).
+        Options are applied with the network settings by apply_settings().
+        """
+        settings = self.pending_settings()
+        for option, value in options.items():
+            settings.set(option, value)
+
+    def pending_settings(self):
+        """Return the queued modifyvm settings for the virtual machine."""
+        # Hosts loaded from the database do not run __init__
+        if getattr(self, "_settings", None) is None:
+            self._settings = VMSettings(self.vmname)
+        return self._settings
+
+    def apply_settings(self):
+        """Apply all queued settings with a single modifyvm invocation."""
+        applied = self.pending_settings().flush()
+        # Only adapter changes can alter the cached MAC addresses
+        if any(option.startswith(("nic", "macaddress", "hostonlyadapter", "bridgeadapter")) for option in applied):
+            Host.mac_cache.pop(self.vmname, None)
+
+    def vminfo(self):
+        """
+        Retrieve the virtual machine's machine readable showvminfo output.
+        Returns:
+            info (dict): {key: value} in output order, with quotes removed
+        """
+        info = {}
+        for entry in VBoxManage.run("showvminfo", self.vmname, "--machinereadable").stdout.splitlines():
+            if "=" not in entry:
+                continue
+            key, value = entry.split("=", 1)
+            info[key.strip('"')] = value.strip('"')
+        return info
+
     def properties(self):
         """
         Retrieve configuration properties for the virtual machine.
         Returns dict {"VMState": , "ostype": , "cpus":, "memory": }
         """
-        # Get individual vm data
-        cmd = 'vboxmanage showvminfo ' +  self.vmname + ' --machinereadable'
-        info = subprocess.getoutput(cmd).splitlines()
+        info = self.vminfo()
         # Parse data
         dinfo = {"VMState": None, "ostype": None, "cpus": None, "memory": None, "nics": {}}
-        for entry in info:
-            key = entry.split("=")[0]
-            value = entry.split("=")[1].replace('"', "")
+        for key, value in info.items():
             if key in dinfo.keys():
                 dinfo[key] = value
             # Identify network connections
@@ -161,30 +209,51 @@ class Host(Base):
                 nic = re.match('.*?([0-9]+)$', key).group(1)
                 dinfo["nics"][nic] = {"netname": value, "mac": None, "ip": None}
         # Identify MAC addresses
-        for entry in info:
-            key = entry.split("=")[0]
-            value = entry.split("=")[1].replace('"', "")
+        for key, value in info.items():
             if "macaddress" in key:
                 nic = re.match('.*?([0-9]+)$', key).group(1)
                 # Format MAC address to lower case with colons
-                mac = ':'.join(value.strip('"').lower()[i:i+2] for i in range(0,12,2))
+                mac = ':'.join(value.lower()[i:i+2] for i in range(0,12,2))
                 dinfo["nics"][nic]["mac"] = mac
+        macs = [nic["mac"] for nic in dinfo["nics"].values()]
+        if macs:
+            Host.mac_cache[self.vmname] = macs
         # Identify IP addresses
+        leases = LeaseIndex.lookup_many(macs)
         for nic in dinfo["nics"].values():
-            netname = nic["netname"]
-            mac = nic["mac"]
-            if mac in Network.get_dhcp_leases(netname).keys():
-                nic["ip"] = Network.get_dhcp_leases(netname)[mac]
+            nic["ip"] = leases.get(nic["mac"])
         return dinfo
 
+    def adapters(self):
+        """
+        Retrieve the adapter configuration of the virtual machine.
+        Returns dict {adapter: {"type": , "netname": }}
+        """
+        adapters = {}
+        for key, value in self.vminfo().items():
+            m = re.match('^(nic|hostonlyadapter|bridgeadapter)([0-9]+)$', key)
+            if m:
+                adapter = adapters.setdefault(int(m.group(2)), {"type": "none", "netname": None})
+                if m.group(1) == "nic":
+                    adapter["type"] = value
+                else:
+                    adapter["netname"] = value
+        return adapters
+
+    def get_macs(self):
+        """Return the MAC addresses of the host's network adapters."""
+        if self.vmname not in Host.mac_cache:
+            self.properties()
+        return Host.mac_cache.get(self.vmname, [])
+
     def get_ip(self):
         """
         Return first assigned IP address.
         """
-        p = self.properties()
-        for nic in p["nics"].values():
-            if nic["ip"] is not None:
-                return nic["ip"]
+        leases = LeaseIndex.lookup_many(self.get_macs())
+        for mac in self.get_macs():
+            if mac in leases:
+                return leases[mac]
 
     def get_username(self):
         """Return host username."""
@@ -204,45 +273,132 @@ class Host(Base):
         Options:
             headerless (bool): run without VirtualBox display (default is True)
         """
+        # Apply any settings queued since construction
+        self.apply_settings()
         # Set headerless option and start VM
-        cmd = 'VBoxManage startvm ' + self.vmname
+        args = ["startvm", self.vmname]
         if headerless:
-            cmd += ' --type headless'
-        r = subprocess.getoutput(cmd)
+            args += ["--type", "headless"]
+        r = VBoxManage.run(*args)
         # Check if successfull
-        if "successfully started" not in r:
-            raise Exception("Failed to start virtual machine: " + r)
+        if "successfully started" not in r.output:
+            raise Exception("Failed to start virtual machine: " + r.output)
 
         Print.print_success("Launched machine " + self.vmname)
 
-    def stop(self):
-        """Shutdown the virtual machine."""
-        cmd = 'VBoxManage controlvm ' + self.vmname + ' poweroff'
-        subprocess.getoutput(cmd)
+    def watcher(self):
+        """Return the shared state watcher for the host's deployment."""
+        return StateWatcher.for_deployment(self.deployment_id)
+
+    def stop(self, timeout=30):
+        """
+        Shutdown the virtual machine, returning once it is powered off.
+        Options:
+            timeout (int): seconds to wait for poweroff, default is 30s
+        Returns:
+            state (str): "poweroff", or "absent" if the machine no longer exists in VirtualBox
+        """
+        VBoxManage.run("controlvm", self.vmname, "poweroff")
+        # Pooled SSH connections don't survive a poweroff
+        SSHPool.evict(self.vmname)
+        # Wait for VM to poweroff, a machine deleted outside of AVN is already off
+        state = self.watcher().wait_for(self.vmname, ("poweroff", "absent"), timeout)
+        if state is None:
+            raise Exception("Timeout, virtual machine " + self.vmname + " did not power off")
+        if state == "absent":
+            Print.print_warning("Virtual machine " + self.vmname + " not found in VirtualBox")
+            return state
+        # Commands run next, e.g. startvm, modifyvm or unregistervm, fail while the session is locked
+        if not self.wait_unlocked():
+            raise Exception("Timeout, virtual machine " + self.vmname + " session was not released")
         Print.print_success("Powered off machine " + self.vmname)
+        return state
+
+    def wait_unlocked(self, timeout=10, poll_interval=0.5):
+        """
+        Wait for VirtualBox to release the virtual machine's session, which
+        outlives the poweroff state change by a moment.
+        Options:
+            timeout       (int): seconds to wait, default is 10s
+            poll_interval (int): seconds between checks, default is 0.5s
+        Returns:
+            unlocked (bool): True if the session was released in time
+        """
+        deadline = time.time() + timeout
+        while True:
+            info = self.vminfo()
+            # A locked session is reported by its state, or by its name on older releases
+            if info.get("SessionState", "Unlocked").lower() == "unlocked" and not info.get("SessionName"):
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(poll_interval)
 
     def restart(self):
         """Power off and on again the virtual machine."""
-        # Call host to poweroff 
+        # Call host to poweroff, waits for the poweroff state and the session to be released
         self.stop()
-        # Wait for VM to poweroff 
-        t = time.time() 
-        while time.time() - t < 30:
-            state = self.properties()["VMState"]
-            if state == "poweroff":
-                break
-        time.sleep(3) 
         self.start()
 
-    def destroy(self):
-        """Permanently delete the virtual machine and all it's files."""
+    def take_snapshot(self, name):
+        """
+        Take a VirtualBox snapshot of the virtual machine.
+        Returns:
+            uuid (str): VirtualBox snapshot uuid, None if it couldn't be identified
+        """
+        r = VBoxManage.run("snapshot", self.vmname, "take", name)
+        if not r.ok:
+            raise Exception("Failed to snapshot virtual machine " + self.vmname + ": " + r.stderr.strip())
+        Print.print_success("Took snapshot " + name + " of machine " + self.vmname)
+        m = re.search(r'UUID: ([0-9a-fA-F-]+)', r.output)
+        return m.group(1) if m else None
+
+    def restore_snapshot(self, snapshot, restart=False):
+        """
+        Restore the virtual machine to a snapshot.
+        Options:
+            snapshot (str): snapshot name or uuid
+            restart (bool): machine is running, power off before and start after (default is False)
+        """
+        if restart:
+            self.stop()
+        r = VBoxManage.run("snapshot", self.vmname, "restore", snapshot)
+        if not r.ok:
+            raise Exception("Failed to restore snapshot of " + self.vmname + ": " + r.stderr.strip())
+        Print.print_success("Restored snapshot of machine " + self.vmname)
+        if restart:
+            self.start()
+
+    def delete_snapshot(self, snapshot):
+        """
+        Delete a snapshot of the virtual machine.
+        Options:
+            snapshot (str): snapshot name or uuid
+        """
+        r = VBoxManage.run("snapshot", self.vmname, "delete", snapshot)
+        if not r.ok:
+            raise Exception("Failed to delete snapshot of " + self.vmname + ": " + r.stderr.strip())
+
+    def destroy(self, known_hosts=True):
+        """
+        Permanently delete the virtual machine and all it's files.
+        Options:
+            known_hosts (bool): remove the host's SSH known_hosts entry (default is True),
+                                bulk teardowns remove all entries at once instead
+        """
+        # Virtual machines must be powered off before being unregistered
+        state = self.stop()
         # Delete SSH known_hosts entry
-        if self.get_ip():
-            cmd = "sed -i '' '/" + self.get_ip() + "/d' ~/.ssh/known_hosts"
-            subprocess.getoutput(cmd)
-        # Delete virtual machine from VirtualBox
-        cmd = 'VBoxManage unregistervm --delete ' + self.vmname
-        subprocess.getoutput(cmd)
+        if known_hosts:
+            KnownHosts.remove([self.get_ip()])
+        SSHPool.evict(self.vmname)
+        # Delete virtual machine from VirtualBox, unless already deleted outside of AVN
+        if state != "absent":
+            r = VBoxManage.run("unregistervm", "--delete", self.vmname)
+            if not r.ok:
+                raise Exception("Failed to delete virtual machine " + self.vmname + ": " + r.stderr.strip())
+        Inventory.invalidate("vms")
+        Host.mac_cache.pop(self.vmname, None)
         # Show status
         Print.print_success("Destroyed machine " + self.vmname)
 
@@ -256,51 +412,99 @@ class Host(Base):
         # Open SSH session through new terminal
         shell.connect(hostname=self.username, hostaddr=ip, password=self.password, hostport=22)
 
-    def dist_pkey(self):
-        """Create and distribute SSH keys for/to the host."""
-        p = Path().home() / ".avn" / "keys"
-        keyname = "id_rsa_vb"
-        # Check keys path exists, else create 
-        if not os.path.isdir(str(p)): 
-            os.mkdir(str(p)) 
-        # Check if key already exists
-        ap = p / keyname
-        if not ((os.path.isfile(str(ap))) or (os.path.isfile(str(ap) + ".pub"))):
-            # Create RSA key pair
-            cmd = "ssh-keygen -t rsa -b 4096 -q -N \"\" -f " + str(ap)
-            subprocess.getoutput(cmd)
-        if not ((os.path.isfile(str(ap))) or (os.path.isfile(str(ap) + ".pub"))):
-            raise Exception("RSA key pair generation failed.")
-        # Add private key the SSH agent
-        cmd = "eval `ssh-agent`"
-        subprocess.getoutput(cmd)
-        cmd = "ssh-add " + str(ap)
-        subprocess.getoutput(cmd)
-        # Share public key with host
-        shell = ssh_shell.Shell()
+    def dist_pkey(self, public_key=None):
+        """
+        Distribute AVN's SSH public key to the host.
+        Options:
+            public_key (str): OpenSSH formatted public key, the key pair is created if not given
+        Returns:
+            result (dict): {"vmname": , "address": , "status": , "duration": , "error": }
+        """
+        t = time.time()
+        result = {"vmname": self.vmname, "address": None, "status": None, "duration": None, "error": None}
+        try:
+            # Create the key pair, if not already created
+            if public_key is None:
+                public_key = SSHKeys.ensure_key_pair()
+            ip = self.get_ip()
+            if not ip:
+                raise Exception("No IP address assigned to host")
+            result["address"] = ip
+            # Append the key to the host's authorized_keys over a pooled connection
+            sftp = SSHPool.sftp(self.vmname, ip, self.username, self.password)
+            try:
+                result["status"] = SSHKeys.install(sftp, public_key)
+            finally:
+                sftp.close()
+            Print.print_success("SSH key " + result["status"] + " on host " + self.vmname + " at " + self.username + "@" + ip)
+        except Exception as e:
+            result["status"] = "failed"
+            result["error"] = str(e)
+            Print.print_error("Failed to distribute SSH public key to host " + self.vmname + ": " + str(e))
+        result["duration"] = round(time.time() - t, 2)
+        return result
+
+    def exec(self, command, timeout=None):
+        """
+        Run a command on the host over a pooled SSH connection.
+        Options:
+            command (str): shell command to run
+            timeout (int): seconds to wait for output, default None
+        Returns:
+            result (tuple): (exit_status, stdout, stderr)
+        """
         ip = self.get_ip()
-        r = shell.copy(hostname=self.username, hostaddr=ip, password=self.password, keypath=(str(ap) + ".pub"))
-        if "try logging" not in r:
-            raise Exception("Failed to distribute SSH public key to host.")
-        else:
-            Print.print_success("SSH key distributed to host " + self.vmname + " at " + self.username + "@" + self.get_ip())
+        if not ip:
+            raise Exception("No IP address assigned to host " + self.vmname)
+        return SSHPool.exec(self.vmname, ip, self.username, command, password=self.password, timeout=timeout, cancel=cancel)
 
-    def ssh_forwarder(self): 
+    def exec_stream(self, command, on_line, timeout=None, cancel=None):
         """
-        Run a background server to forward SSH traffic between the host machine
-        and the virtual machine. 
+        Run a command on the host, passing each line of output to a callback as it arrives.
+        Options:
+            command (str): shell command to run
+            on_line (func): called as on_line(stream, line)
+            timeout (int): seconds to wait for the command, default None
+            cancel (Event): set to close the command's channel, default None
+        Returns:
+            exit_status (int): exit status of the command
         """
-        shell = PortForward(self.deployment_id)
-        # Find an unassigned port 
-        host_port = 2000
-        while shell.port_in_use(host_port):
-            host_port += 1
-        self.ssh_remote_port = host_port
-        Print.print_information("SSH port assigned to " + self.vmname + ": " + str(host_port))
         ip = self.get_ip()
-        shell.start_forwarding_server(host_port=host_port, dest_addr=ip) 
-        self.update_to_db() 
-    
+        if not ip:
+            raise Exception("No IP address assigned to host " + self.vmname)
+        return SSHPool.stream(self.vmname, ip, self.username, command, on_line, password=self.password, timeout=timeout)
+
+    def ssh_forwarder(self, ip=None):
+        """
+        Forward a host port to the virtual machine's SSH port. The port is
+        reserved by the PortAllocator and served by the shared
+        ForwardingService.
+        Options:
+            ip (str): address of the virtual machine if already looked up
+        Returns:
+            host_port (int): port forwarded to the virtual machine
+        """
+        ip = ip or self.get_ip()
+        if not ip:
+            raise Exception("No IP address assigned to host " + self.vmname)
+        service = ForwardingService.shared()
+        # Ports recorded in the database are taken, even if not yet bound in this process
+        PortAllocator.ensure_loaded(lambda: [port for port, in Session.query(PortForward.host_port)] +
+                                            [port for port, in Session.query(Host.ssh_remote_port)])
+        host_port = PortAllocator.allocate(lambda port: service.add_route(port, ip, 22, name=self.vmname, group=self.deployment_id))
+        try:
+            # Forward row and host port are recorded in one commit
+            Session.add(PortForward(host_port, ip, 22, self.id, self.deployment_id))
+            self.ssh_remote_port = host_port
+            self.update_to_db()
+        except Exception:
+            Session.rollback()
+            service.remove_route(host_port)
+            PortAllocator.release([host_port])
+            raise
+        Print.print_information("SSH port assigned to " + self.vmname + ": " + str(host_port))
+        return host_port
+
     def proxy_ssh(self, public_ip):
         """
         Launch SSH session with virtual machine via host system. 
@@ -331,7 +535,7 @@ class Host(Base):
         """Return an ordered dictionary for printing purposes."""
         # Get the dict and organised keys
         dict = self.__dict__
-        keys = ["id", "vmname", "image", "username"]
+        keys = ["id", "vmname", "image", "username", "base"]
 
         # Create and return a new dictionary
         new_dict= {}
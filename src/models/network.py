@@ -1,13 +1,9 @@
-from pathlib import Path
-import xml.etree.ElementTree as ET
-import subprocess
-import re
-import time
-import sys
+import os
 
 from sqlalchemy import Column, Integer, String, Sequence, ForeignKey
 from db import Base, Session
 from print_colours import Print
+from vbox import VBoxManage, Inventory, LeaseIndex, HostOnlyAllocator, DHCPServer, config_dir
 
 class Network(Base):
     """
@@ -34,8 +30,8 @@ class Network(Base):
             deployment_id   (int): ID for the deployment group
         """
         self.label = label
-        # recieve name from VirtualBox
-        self.netname = self.next_name() 
+        # recieve name from VirtualBox on creation
+        self.netname = None
         self.netaddr = netaddr
         self.dhcplower = dhcplower
         self.dhcpupper = dhcpupper
@@ -46,8 +42,7 @@ class Network(Base):
     @classmethod
     def check_exists(self, netname):
         """Check if network already exists, if present returns True"""
-        r = subprocess.getoutput("vboxmanage list hostonlyifs|grep '" + netname + "'")
-        if (r != ""):
+        if netname in Inventory.hostonlyifs():
             return True
 
     @classmethod
@@ -57,107 +52,58 @@ class Network(Base):
         Returns:
             leases  (dict): {mac: ip}
         """
-        leases = {}
-        if sys.platform == "darwin":
-            # Mac config location ~/Library/VirtualBox
-            path = Path.home().glob('Library' + '/VirtualBox' + '/HostInterfaceNetworking-' + netname + '-Dhcpd.leases')
-        elif sys.platform == "linux":
-            # Linux config location ~/.config/VirtualBox/...
-            path = Path.home().glob('.config' + '/VirtualBox' + '/HostInterfaceNetworking-' + netname + '-Dhcpd.leases')
-        else:
-            raise Exception("OS not supported")
-
-        for filepath in path:
-            # Create element tree object
-            root = ET.parse(str(filepath)).getroot()
-            # Loop through the hosts and find assigned IP
-            for lease in root.findall('Lease'):
-                if lease.attrib["state"] != "expired":
-                    macaddr = lease.attrib["mac"]
-                    leases[macaddr] = lease.find('Address').attrib['value']
-        return leases
+        # Served from the lease index, files are only re-parsed when changed
+        return LeaseIndex.leases(netname)
 
     def get_name(self):
         """Return the name of the network as assigned by VirtualBox."""
         return self.netname
 
-    def next_name(self):
-        """
-        Identify next host-only network interface name to be assigned by VBox
-        Note, VirtualBox increments host-only names, e.g. "vboxnetN"
-        Limited to 128 host-only network interfaces.
-        """
-        r = subprocess.getoutput("vboxmanage list hostonlyifs|grep HostInterfaceNetworking-vboxnet")
-        netnames = r.splitlines()
-        netids = [int(re.match('.*?([0-9]+)$', name).group(1)) for name in netnames]
-        netids.sort()
-        bigid = 0
-        if len(netids) != 0:
-            bigid = netids[-1] # Largest id assigned
-        # Search for smallest unused id, up to 1 greater than the largest
-        for n in range(0, bigid + 2): 
-            if n not in netids:
-                return "vboxnet" + str(n)
-        raise Exception("[!] Failed to find a free network name.")
-
     def create(self):
         """
         Create host-only network interface.
         Note, VirtualBox increments host-only names, e.g. "vboxnetN"
         """
-        # Check if network name is avaliable
-        if self.check_exists(self.netname):
-            raise Exception("Network with name " + self.netname + " already exists.")
-        # Create host-only network interface
-        subprocess.getoutput("VBoxManage hostonlyif create")
-        # Check if network has been created
-        if not self.check_exists(self.netname):
-            raise Exception("Failed to create network with name " + self.netname)
+        # Create host-only network interface, reserving the name VirtualBox assigns
+        self.netname = HostOnlyAllocator.create()
         # Set IP address of the host-only network interface
-        cmd = 'VBoxManage hostonlyif ipconfig ' + self.netname + ' --ip ' + self.netaddr
-        subprocess.getoutput(cmd)
+        VBoxManage.run("hostonlyif", "ipconfig", self.netname, "--ip", self.netaddr)
         # Create the DHCP server
-        cmd = 'VBoxManage dhcpserver add --ifname '+ self.netname
-        cmd += ' --ip ' + self.netaddr
-        cmd += ' --netmask 255.255.255.0'
-        cmd += ' --lowerip ' + self.dhcplower
-        cmd += ' --upperip ' + self.dhcpupper
-        subprocess.getoutput(cmd)
+        VBoxManage.run("dhcpserver", "add", "--ifname", self.netname,
+                       "--ip", self.netaddr,
+                       "--netmask", "255.255.255.0",
+                       "--lowerip", self.dhcplower,
+                       "--upperip", self.dhcpupper)
         # Enable the server
-        cmd = 'VBoxManage dhcpserver modify --ifname '+ self.netname +' --enable'
-        subprocess.getoutput(cmd)
+        VBoxManage.run("dhcpserver", "modify", "--ifname", self.netname, "--enable")
+        Inventory.invalidate("hostonlyifs", "dhcpservers")
         Print.print_success("Created network " + self.netname)
 
-    def reset_dhcp(self):
-        """Call DHCP server to reset."""
-        # Disable the DHCP server
-        cmd = 'VBoxManage dhcpserver modify --ifname '+ self.netname +' --disable'
-        subprocess.getoutput(cmd)
-        time.sleep(20)
-        # Re-enable the DHCP server
-        cmd = 'VBoxManage dhcpserver modify --ifname '+ self.netname +' --enable'
-        subprocess.getoutput(cmd)
+    def reset_dhcp(self, timeout=30):
+        """
+        Call DHCP server to reset, returning once it is confirmed back up.
+        Options:
+            timeout (int): seconds to wait for the reset, default is 30s
+        """
+        duration = DHCPServer.reset(self.netname, timeout)
+        Print.print_success("Reset DHCP server for {0} in {1:.1f}s".format(self.netname, duration))
+        return duration
 
     def destroy(self):
         """Permanently destroy host-only network."""
         # Destroy DHCP server
-        cmd = 'VBoxManage dhcpserver remove --interface ' + self.netname
-        subprocess.getoutput(cmd)
+        VBoxManage.run("dhcpserver", "remove", "--interface", self.netname)
         # Delete DHCP logs and lease config files
-        if sys.platform == "darwin":
-            # Mac config location ~/Library/VirtualBox
-            path = Path.home().glob('Library' + '/VirtualBox' + '/HostInterfaceNetworking-' + self.netname + '-Dhcpd.*')
-        elif sys.platform == "linux":
-            # Linux config location ~/.config/VirtualBox/... 
-            path = Path.home().glob('.config' + '/VirtualBox' + '/HostInterfaceNetworking-' + self.netname + '-Dhcpd.*')
-        else:
-            raise Exception("OS not supported")
-        for filepath in path:
-            cmd = 'rm ' + str(filepath)
-            subprocess.getoutput(cmd)
+        for filepath in config_dir().glob('HostInterfaceNetworking-' + self.netname + '-Dhcpd.*'):
+            try:
+                os.unlink(str(filepath))
+            except FileNotFoundError:
+                pass
         # Destroy host-only network interface
-        cmd = 'VBoxManage hostonlyif remove ' + self.netname
-        subprocess.getoutput(cmd)
+        VBoxManage.run("hostonlyif", "remove", self.netname)
+        Inventory.invalidate("hostonlyifs", "dhcpservers")
+        LeaseIndex.forget(self.netname)
+        HostOnlyAllocator.release(self.netname)
         # Set network object properties to None (indicate deleted)
         self.netname = None
         self.netaddr = None
@@ -0,0 +1,47 @@
+import time
+
+from sqlalchemy import Column, Integer, String, Float, Sequence, ForeignKey, UniqueConstraint
+from db import Base
+from db import Session
+
+class Snapshot(Base):
+    """
+    Snapshot object to represent a named VirtualBox snapshot of a Host.
+    """
+    # Define 'snapshots' SQL table for instances of Snapshot
+    __tablename__ = 'snapshots'
+    __table_args__ = (UniqueConstraint('host_id', 'name'), )
+    id = Column(Integer, Sequence('snapshot_id_seq'), primary_key=True)
+    name = Column(String)
+    uuid = Column(String)
+    created = Column(Float)
+    host_id = Column(Integer, ForeignKey('hosts.id'))
+    deployment_id = Column(Integer, ForeignKey('deployments.id'))
+
+    def __init__(self, name, uuid, host_id, deployment_id):
+        self.name = name
+        self.uuid = uuid
+        self.created = time.time()
+        self.host_id = host_id
+        self.deployment_id = deployment_id
+
+    def dict(self):
+        """Return a dictionary of the snapshot for printing purposes."""
+        return {
+            "id": self.id,
+            "name": self.name,
+            "uuid": self.uuid,
+            "created": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.created)),
+            "host_id": self.host_id,
+            "deployment_id": self.deployment_id,
+        }
+
+    def write_to_db(self):
+        """Write the snapshot to the database."""
+        Session.add(self)
+        Session.commit()
+
+    def delete_from_db(self):
+        """Remove the snapshot from the database."""
+        Session.delete(self)
+        Session.commit()
@@ -3,4 +3,5 @@ from .network_resource import Networks
 from .deployment_resource import Deployments
 from .sshforward_resource import SSHForward
 from .user_resource import Users
-from .token_resource import Tokens
\ No newline at end of file
+from .token_resource import Tokens
+from .snapshot_resource import Snapshots
\ No newline at end of file
@@ -1,4 +1,8 @@
 from models.deployment import Deployment
+from models.host import Host
+from models.network import Network
+from models.port_forward import PortForward
+from models.snapshot import Snapshot
 from db import Session
 
 class Deployments():
@@ -29,6 +33,26 @@ class Deployments():
         if deployment:
             deployment.delete_from_db()
     
+    @staticmethod
+    def teardown(name):
+        """
+        Delete a deployment with all of its snapshot, port forward, host and
+        network rows in a single transaction.
+        """
+        deployment = Session.query(Deployment).filter_by(name=name).first()
+        if not deployment:
+            return
+        try:
+            for model in (Snapshot, PortForward, Host, Network):
+                Session.query(model).filter_by(deployment_id=deployment.id).delete(synchronize_session=False)
+            Session.query(Deployment).filter_by(id=deployment.id).delete(synchronize_session=False)
+            Session.commit()
+        except Exception:
+            Session.rollback()
+            raise
+        # Drop deleted rows still held by the session
+        Session.expire_all()
+
     @staticmethod
     def get_by_name(name): 
         """Get the deployment matched by name."""
@@ -1,6 +1,8 @@
 from models.host import Host
 from models.deployment import Deployment
 from db import Session
+from vbox import BaseImage
+from warm_pool import WarmPool
 
 class Hosts():
     """Collection of methods for reading/writing to Hosts table of database."""
@@ -40,6 +42,18 @@ class Hosts():
         else:
             return None
 
+    @classmethod
+    def get_by_base(self, base):
+        """Return all hosts cloned from a given base vm."""
+        return Session.query(Host).filter_by(base=base).all()
+
+    @classmethod
+    def release_bases(self, bases):
+        """Delete base vms that are no longer referenced by any host or pool vm."""
+        for base in bases:
+            if base and not self.get_by_base(base) and not WarmPool.uses_base(base):
+                BaseImage.destroy(base)
+
     @classmethod
     def check_database(self):
         """Check if db has any hosts."""
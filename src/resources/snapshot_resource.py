@@ -0,0 +1,40 @@
+from models.snapshot import Snapshot
+from models.deployment import Deployment
+from db import Session
+
+class Snapshots():
+    """Collection of methods for reading/writing to Snapshots table of database."""
+
+    @staticmethod
+    def get_by_deployment(deployment_name):
+        """Return all snapshots of hosts within a deployment."""
+        deployment = Session.query(Deployment).filter_by(name=deployment_name).first()
+        if deployment:
+            return Session.query(Snapshot).filter_by(deployment_id=deployment.id).order_by(Snapshot.created).all()
+        return []
+
+    @staticmethod
+    def get_by_name(deployment_name, name):
+        """Return the snapshots with a given name, one per host of the deployment."""
+        deployment = Session.query(Deployment).filter_by(name=deployment_name).first()
+        if deployment:
+            return Session.query(Snapshot).filter_by(deployment_id=deployment.id, name=name).all()
+        return []
+
+    @staticmethod
+    def get_by_host(host_id):
+        """Return all snapshots of a host."""
+        return Session.query(Snapshot).filter_by(host_id=host_id).all()
+
+    @staticmethod
+    def post_all(snapshots):
+        """Write a set of snapshots to the database in a single commit."""
+        Session.add_all(snapshots)
+        Session.commit()
+
+    @staticmethod
+    def delete_all(snapshots):
+        """Delete a set of snapshots from the database in a single commit."""
+        for snapshot in snapshots:
+            Session.delete(snapshot)
+        Session.commit()
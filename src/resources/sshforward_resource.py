@@ -1,5 +1,6 @@
 from models.port_forward import PortForward
 from models.deployment import Deployment
+from models.host import Host
 from db import Session
 
 class SSHForward():
@@ -19,8 +20,28 @@ class SSHForward():
             sshforwards = Session.query(PortForward).filter_by(deployment_id= deployment.id).all()
             return sshforwards
 
+    @staticmethod
+    def get_by_host(host_id):
+        """Return all sshforward servers of a host in db."""
+        sshforwards = Session.query(PortForward).filter_by(host_id=host_id).all()
+        return sshforwards
+
     @staticmethod
     def delete(sshforward):
         """Delete a sshforward from the database."""
         Session.delete(sshforward)
         Session.commit()
+
+    @staticmethod
+    def delete_all(sshforwards):
+        """
+        Delete a list of sshforwards from the database in one commit, clearing
+        the forwarded port recorded on their hosts.
+        """
+        host_ports = [sshforward.host_port for sshforward in sshforwards]
+        if host_ports:
+            for host in Session.query(Host).filter(Host.ssh_remote_port.in_(host_ports)):
+                host.ssh_remote_port = None
+        for sshforward in sshforwards:
+            Session.delete(sshforward)
+        Session.commit()
@@ -1,6 +1,6 @@
 #!/usr/bin/python3
 
-import requests, os
+import requests, os, json
 from pathlib import Path
 from autossh import ssh_shell
 from urllib3.exceptions import InsecureRequestWarning
@@ -85,6 +85,34 @@ class RESTClient(object):
         if r.status_code != 202:
             raise Exception("Failed to deploy topology: " + r.text)
     
+    @staticmethod
+    def plan(template_file="default.yaml"): 
+        """
+        Request AVN Rest API to compare a template with its deployment.
+        Returns:
+            plan (dict): {deployment: , exists: , actions: [{action: , name: , detail: }]}
+        """
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "apply/" + template_file
+        r = requests.get(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 200:
+            raise Exception("Failed to GET deployment plan: " + r.text)
+        data = r.json() 
+        return data 
+
+    @staticmethod
+    def apply(template_file="default.yaml"): 
+        """
+        Request AVN Rest API to apply a template to its deployment.
+        Options:
+            template_file (str): <template_name.yaml>
+        """
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "apply/" + template_file
+        r = requests.put(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 202:
+            raise Exception("Failed to apply topology: " + r.text)
+
     @staticmethod
     def start(deployment_name, vmname='all'): 
         """Request AVN Rest API to start virtual host machines."""
@@ -114,13 +142,86 @@ class RESTClient(object):
     
     @staticmethod
     def send_keys(deployment_name): 
-        """Request AVN Rest API to generate and distribute SSH keys."""
+        """
+        Request AVN Rest API to generate and distribute SSH keys.
+        Returns:
+            results (list): [{vmname: , address: , status: , duration: , error: }]
+        """
         headers = RESTClient.get_api_variables()
         url = RESTClient.server_url + "keys/" + deployment_name
         r = requests.put(url, headers=headers, verify=RESTClient.ssl_verify)
-        if r.status_code != 202:
+        if r.status_code != 200:
             raise Exception("Failed to distribute keys: " + r.text)
+        return r.json()
     
+    @staticmethod
+    def reset_dhcp(deployment_name): 
+        """Request AVN Rest API to reset the DHCP servers of a deployment."""
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "dhcpreset/" + deployment_name
+        r = requests.put(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 202:
+            raise Exception("Failed to reset DHCP servers: " + r.text)
+
+    @staticmethod
+    def exec(deployment_name, command, hosts=None, timeout=None): 
+        """
+        Request AVN Rest API to run a command on hosts within a deployment.
+        Returns a generator of events as they arrive:
+            {vmname: , stream: , line: }  per line of output
+            {vmname: , exit_status: , duration: , error: }  once a host finishes
+        """
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "exec/" + deployment_name
+        data = {"command": command, "hosts": hosts, "timeout": timeout}
+        r = requests.post(url, headers=headers, json=data, stream=True, verify=RESTClient.ssl_verify)
+        if r.status_code != 200:
+            raise Exception("Failed to run command: " + r.text)
+        for line in r.iter_lines():
+            if line:
+                yield json.loads(line)
+
+    @staticmethod
+    def snapshots(deployment_name): 
+        """
+        Request AVN Rest API to get the snapshots of a deployment.
+        Returns:
+            snapshots (list): [{name: , hosts: , created: }]
+        """
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "snapshots/" + deployment_name
+        r = requests.get(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 200:
+            raise Exception("Failed to GET snapshots: " + r.text)
+        return r.json()
+
+    @staticmethod
+    def snapshot(deployment_name, name): 
+        """Request AVN Rest API to snapshot all hosts within a deployment."""
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "snapshot/" + deployment_name + "/" + name
+        r = requests.put(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 202:
+            raise Exception("Failed to snapshot deployment: " + r.text)
+
+    @staticmethod
+    def delete_snapshot(deployment_name, name): 
+        """Request AVN Rest API to delete a snapshot of a deployment."""
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "snapshot/" + deployment_name + "/" + name
+        r = requests.delete(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 202:
+            raise Exception("Failed to delete snapshot: " + r.text)
+
+    @staticmethod
+    def reset(deployment_name, name): 
+        """Request AVN Rest API to reset all hosts within a deployment to a snapshot."""
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "reset/" + deployment_name + "/" + name
+        r = requests.put(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 202:
+            raise Exception("Failed to reset deployment: " + r.text)
+
     @staticmethod
     def destroy(deployment_name): 
         """Request AVN Rest API to destroy the topology."""
@@ -160,17 +261,102 @@ class RESTClient(object):
         data = r.json() 
         return data 
 
+    @staticmethod
+    def vbox_stats(): 
+        """
+        Request AVN Rest API to get VBoxManage latency statistics
+        Returns:
+            stats (dict): {subcommand: , count: , errors: , mean: , min: , max: , wait: , histogram: }
+        """
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "details/vbox"
+        r = requests.get(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 200:
+            raise Exception("Failed to GET VBoxManage statistics: " + r.text)
+        data = r.json() 
+        return data 
+
+    @staticmethod
+    def forwarding_stats(): 
+        """
+        Request AVN Rest API to get SSH forwarding traffic counters
+        Returns:
+            stats (list): [{name: , host_port: , active: , bytes_in: , bytes_out: , ..., connections: []}]
+        """
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "details/forwarding"
+        r = requests.get(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 200:
+            raise Exception("Failed to GET forwarding statistics: " + r.text)
+        return r.json()
+
+    @staticmethod
+    def pool_details(): 
+        """
+        Request AVN Rest API to get the warm pools
+        Returns:
+            pools (list): [{image: , linked: , size: , ready: , filling: , machines: }]
+        """
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "pool"
+        r = requests.get(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 200:
+            raise Exception("Failed to GET warm pools: " + r.text)
+        return r.json()
+
+    @staticmethod
+    def set_pool_size(image, size, linked=False): 
+        """Request AVN Rest API to set the size of an image's warm pool."""
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "pool/" + image + "/" + str(size)
+        r = requests.put(url, headers=headers, params={"linked": str(linked).lower()}, verify=RESTClient.ssl_verify)
+        if r.status_code != 200:
+            raise Exception("Failed to set warm pool size: " + r.text)
+
+    @staticmethod
+    def get_limits(): 
+        """
+        Request AVN Rest API to get the scheduler's operation pools
+        Returns:
+            limits (list): [{operation: , limit: , workers: , active: , queued: }]
+        """
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "limits"
+        r = requests.get(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 200:
+            raise Exception("Failed to GET operation limits: " + r.text)
+        return r.json()
+
+    @staticmethod
+    def set_limit(op, limit): 
+        """Request AVN Rest API to set the concurrency limit of an operation class."""
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "limits/" + op + "/" + str(limit)
+        r = requests.put(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 200:
+            raise Exception("Failed to set operation limit: " + r.text)
+
     @staticmethod
     def shell(options):
         """
         Create an SSH shell terminal sessions with each host.
         Support for Mac and Linux (Gnome zsh). 
+        Connects through the server's SSH gateway if it is running,
+        otherwise through the host's forwarded SSH port.
         Options:
             vmname      (str): name of rm to create shell session for
             server_ip   (str): ip address of the host machine 
             username    (str): virtual host's username 
             password    (str): virtual host's password
         """
+        shell = ssh_shell.Shell()
+        gateway = RESTClient.gateway_port()
+        if gateway:
+            # The gateway is told the vmname, the guest's SSH port is always 22
+            proxy = options[1] + ":" + str(gateway)
+            print(shell.command(options[2], options[0], 22, proxy))
+            shell.connect(hostname=options[2], hostaddr=options[0], password=options[3], hostport=22, gateway=proxy)
+            return
         # Get the ssh_remote_port of the virtual machine
         headers = RESTClient.get_api_variables()
         port = None
@@ -184,9 +370,37 @@ class RESTClient(object):
             else:
                 port = data["port"]
         # Open SSH session through new terminal
-        shell = ssh_shell.Shell()
         shell.connect(hostname=options[2], hostaddr=options[1], password=options[3], hostport=port)
 
+    @staticmethod
+    def gateway_port():
+        """Request AVN Rest API to get the SSH gateway's port, None if it isn't running."""
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "gateway"
+        r = requests.get(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 200:
+            raise Exception("Failed to GET SSH gateway: " + r.text)
+        return r.json()["port"]
+
+    @staticmethod
+    def start_gateway(port=2222):
+        """Request AVN Rest API to start the SSH gateway, returns its port."""
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "gateway/" + str(port)
+        r = requests.put(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 200:
+            raise Exception("Failed to start SSH gateway: " + r.text)
+        return r.json()["port"]
+
+    @staticmethod
+    def stop_gateway():
+        """Request AVN Rest API to stop the SSH gateway."""
+        headers = RESTClient.get_api_variables()
+        url = RESTClient.server_url + "gateway"
+        r = requests.delete(url, headers=headers, verify=RESTClient.ssl_verify)
+        if r.status_code != 200:
+            raise Exception("Failed to stop SSH gateway: " + r.text)
+
     @staticmethod
     def start_ssh_forwarder(deployment_name):
         """Start ssh forwarder server for connection to vm through host machine."""
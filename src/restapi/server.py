@@ -1,6 +1,7 @@
 from gevent.pywsgi import WSGIServer, LoggingLogAdapter
+import gevent
 from flask import Flask, Response, jsonify, request
-import multiprocessing, logging, threading
+import multiprocessing, logging, threading, json
 from print_colours import Print
 import atexit
 import subprocess
@@ -16,6 +17,7 @@ import socket
 from security import authorise, authenticate, default_user, change_password, remove_user
 from resources import Hosts, Networks, SSHForward, Users
 from topo import Topology
+from db import Session
 
 # Initialise app-rest Api server 
 app = Flask(__name__)
@@ -40,6 +42,37 @@ def make_secure():
     return decorator
 
 
+def stream_events(events):
+    """
+    Yield events as JSON lines from a blocking generator, each event is
+    awaited on gevent's thread pool so other requests are still served.
+    """
+    threadpool = gevent.get_hub().threadpool
+    try:
+        while True:
+            event = threadpool.apply(next, (events, None))
+            if event is None:
+                return
+            yield json.dumps(event) + "\n"
+    finally:
+        # Closed early when the client disconnects, stops the remote commands
+        events.close()
+
+
+def run_in_threadpool(func, *args):
+    """
+    Run a blocking call on gevent's thread pool and wait for it, so other
+    requests are still served. The pool thread's database session is
+    dropped afterwards, pool threads are reused.
+    """
+    def call():
+        try:
+            return func(*args)
+        finally:
+            Session.remove()
+    return gevent.get_hub().threadpool.apply(call)
+
+
 def handle_ex(exception):
     """Print exception and traceback."""
     logging.exception("Server error: " + str(exception))
@@ -126,6 +159,25 @@ def build(template="default.yaml"):
         handle_ex(e)
         return ("Error", 500)
 
+@app.route('/apply/<string:template>', methods=['GET'])
+@make_secure()
+def plan(template):
+    try:
+        return (jsonify(Topology.plan(template)), 200)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
+@app.route('/apply/<string:template>', methods=['PUT'])
+@make_secure()
+def apply(template):
+    try:
+        threading.Thread(target=Topology.apply, args=(template,)).start()
+        return ("Network apply accepted", 202)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
 @app.route('/start/<string:deployment_name>/<string:vmname>', methods=['PUT'])
 @make_secure()
 def start(deployment_name, vmname):
@@ -160,12 +212,74 @@ def restart(deployment_name, vmname):
 @make_secure()
 def keys(deployment_name):
     try:
-        threading.Thread(target=Topology.send_keys, args=(deployment_name, )).start()
-        return ("Network keys request accepted", 202)
+        results = run_in_threadpool(Topology.send_keys, deployment_name)
+        return (jsonify(results), 200)
     except Exception as e:
         handle_ex(e)
         return ("Error", 500)
 
+@app.route('/dhcpreset/<string:deployment_name>', methods=['PUT'])
+@make_secure()
+def reset_dhcp(deployment_name):
+    try:
+        threading.Thread(target=Topology.reset_dhcp, args=(deployment_name, )).start()
+        return ("DHCP reset request accepted", 202)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
+@app.route('/exec/<string:deployment_name>', methods=['POST'])
+@make_secure()
+def exec_command(deployment_name):
+    try:
+        data = request.get_json()
+        if not data or "command" not in data:
+            return ("No command given", 400)
+        events = Topology.exec_stream(deployment_name, data["command"], data.get("hosts"), data.get("timeout"))
+        # Stream one JSON event per line as output arrives
+        return Response(stream_events(events), mimetype="application/x-ndjson")
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
+@app.route('/snapshots/<string:deployment_name>', methods=['GET'])
+@make_secure()
+def snapshots(deployment_name):
+    try:
+        return (jsonify(Topology.snapshots(deployment_name)), 200)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
+@app.route('/snapshot/<string:deployment_name>/<string:name>', methods=['PUT'])
+@make_secure()
+def snapshot(deployment_name, name):
+    try:
+        threading.Thread(target=Topology.snapshot, args=(deployment_name, name)).start()
+        return ("Snapshot request accepted", 202)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
+@app.route('/snapshot/<string:deployment_name>/<string:name>', methods=['DELETE'])
+@make_secure()
+def delete_snapshot(deployment_name, name):
+    try:
+        threading.Thread(target=Topology.delete_snapshot, args=(deployment_name, name)).start()
+        return ("Snapshot delete request accepted", 202)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
+@app.route('/reset/<string:deployment_name>/<string:name>', methods=['PUT'])
+@make_secure()
+def reset(deployment_name, name):
+    try:
+        threading.Thread(target=Topology.reset, args=(deployment_name, name)).start()
+        return ("Reset request accepted", 202)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
     
 @app.route('/destroy/<string:deployment_name>', methods=['DELETE'])
 @make_secure()
@@ -197,6 +311,66 @@ def network_details():
         handle_ex(e)
         return ("Error", 500)
 
+@app.route('/details/vbox', methods=['GET'])
+@make_secure()
+def vbox_stats():
+    try:
+        stats = Topology.vbox_stats()
+        return (jsonify(stats), 200)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
+@app.route('/details/forwarding', methods=['GET'])
+@make_secure()
+def forwarding_stats():
+    try:
+        stats = Topology.forwarding_stats()
+        return (jsonify(stats), 200)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
+@app.route('/limits', methods=['GET'])
+@make_secure()
+def get_limits():
+    try:
+        limits = Topology.get_limits()
+        return (jsonify(limits), 200)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
+@app.route('/limits/<string:op>/<int:limit>', methods=['PUT'])
+@make_secure()
+def set_limit(op, limit):
+    try:
+        Topology.set_limit(op, limit)
+        return ("Limit set", 200)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
+@app.route('/pool', methods=['GET'])
+@make_secure()
+def pool_details():
+    try:
+        return (jsonify(Topology.pool_details()), 200)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
+@app.route('/pool/<string:image>/<int:size>', methods=['PUT'])
+@make_secure()
+def set_pool_size(image, size):
+    try:
+        linked = request.args.get("linked", "false").lower() in ("1", "true", "yes")
+        Topology.set_pool_size(image, size, linked)
+        return ("Pool size set", 200)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
 @app.route('/hosts', methods=['GET'])
 @make_secure()
 def get_hosts():
@@ -253,6 +427,34 @@ def get_ssh_remote_port(vmname):
         handle_ex(e)
         return ("Error", 500)
 
+@app.route('/gateway', methods=['GET'])
+@make_secure()
+def gateway_port():
+    try:
+        return (jsonify({"port": Topology.gateway_port()}), 200)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
+@app.route('/gateway/<int:port>', methods=['PUT'])
+@make_secure()
+def start_gateway(port):
+    try:
+        return (jsonify({"port": Topology.start_gateway(port)}), 200)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
+@app.route('/gateway', methods=['DELETE'])
+@make_secure()
+def stop_gateway():
+    try:
+        Topology.stop_gateway()
+        return ("SSH gateway stopped", 200)
+    except Exception as e:
+        handle_ex(e)
+        return ("Error", 500)
+
 @app.route('/sshforward/<string:deployment_name>', methods=['PUT'])
 @make_secure()
 def ssh_forward(deployment_name):
@@ -392,8 +594,7 @@ class RESTServer(object):
 
     def do_exit(self):
         """Handle exit, and cleanup SSH forwarding servers for Rest API only mode"""
-        for server in SSHForward.get_all():
-            SSHForward.delete(server)
+        SSHForward.delete_all(SSHForward.get_all())
 
 ################################################################################
 # Resources 
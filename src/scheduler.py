@@ -0,0 +1,189 @@
+from concurrent.futures import Future
+import itertools
+import threading
+import os
+import logging
+import queue
+
+from vbox import VBoxManage
+
+class OperationPool(object):
+    """
+    Worker pool for one class of operation. Queued work is started in
+    priority order (lowest value first), then in submission order. Workers
+    are started on demand up to the pool's limit and exit when idle.
+    """
+    idle_timeout = 5
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.workers = 0
+        self.active = 0
+        self.queue = queue.PriorityQueue()
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+
+    def submit(self, priority, func, args):
+        """Queue a call, returns a Future for its result."""
+        future = Future()
+        self.queue.put((priority, next(self.seq), future, func, args))
+        with self.lock:
+            if self.workers < self.limit:
+                self.workers += 1
+                threading.Thread(target=self.worker, daemon=True, name="avn-" + self.name).start()
+        return future
+
+    def resize(self, limit):
+        """Change the number of workers, extra workers exit after their current task."""
+        with self.lock:
+            self.limit = limit
+            # Start workers for any work already queued
+            while self.workers < self.limit and self.workers - self.active < self.queue.qsize():
+                self.workers += 1
+                threading.Thread(target=self.worker, daemon=True, name="avn-" + self.name).start()
+
+    def worker(self):
+        """Run queued work until the pool shrinks or there is nothing left to do."""
+        while True:
+            with self.lock:
+                if self.workers > self.limit:
+                    self.workers -= 1
+                    return
+            try:
+                priority, seq, future, func, args = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self.lock:
+                    # Re-check under the lock, submit only starts workers while holding it
+                    if self.queue.empty():
+                        self.workers -= 1
+                        return
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self.lock:
+                self.active += 1
+            # VBoxManage calls made by this task queue at the task's priority
+            VBoxManage.set_priority(priority)
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                VBoxManage.set_priority(None)
+                with self.lock:
+                    self.active -= 1
+
+    def dict(self):
+        """Return a dictionary of the pool's state for printing purposes."""
+        with self.lock:
+            return {"operation": self.name, "limit": self.limit, "workers": self.workers,
+                    "active": self.active, "queued": self.queue.qsize()}
+
+
+class Scheduler(object):
+    """
+    Owns the worker pools used by every topology operation. Each class of
+    operation has its own concurrency limit and queued work carries a
+    priority, so interactive requests such as 'stop' run ahead of queued
+    background builds.
+    """
+    HIGH = 0
+    NORMAL = 5
+    LOW = 10
+    limits = {
+        "import": 2,
+        "boot": 4,
+        "poweroff": 8,
+        "delete": 4,
+        "snapshot": 8,
+        "ssh": 8,
+        # Gateway address lookups, kept apart from long running ssh commands
+        "resolve": 4,
+        "network": 2,
+        "default": 4,
+    }
+    _pools = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def after_fork():
+        """Forget the pools in a forked child, their workers were not copied."""
+        Scheduler._pools = {}
+        Scheduler._lock = threading.Lock()
+
+    @staticmethod
+    def pool(op):
+        """Return the pool for an operation class, creating it if needed."""
+        if op not in Scheduler.limits:
+            raise Exception("Unknown operation class " + op)
+        with Scheduler._lock:
+            if op not in Scheduler._pools:
+                Scheduler._pools[op] = OperationPool(op, Scheduler.limits[op])
+            return Scheduler._pools[op]
+
+    @staticmethod
+    def set_limit(op, limit):
+        """
+        Set the number of concurrent operations of a class.
+        Options:
+            op    (str): operation class, e.g. "import", "boot", "poweroff"
+            limit (int): concurrent operations, must be at least 1
+        """
+        limit = int(limit)
+        if op not in Scheduler.limits:
+            raise Exception("Unknown operation class " + op)
+        if limit < 1:
+            raise Exception("Concurrency limit must be at least 1")
+        with Scheduler._lock:
+            Scheduler.limits[op] = limit
+            pool = Scheduler._pools.get(op)
+        if pool:
+            pool.resize(limit)
+
+    @staticmethod
+    def get_limits():
+        """Return the state of each operation pool."""
+        return [Scheduler.pool(op).dict() for op in sorted(Scheduler.limits)]
+
+    @staticmethod
+    def submit(op, func, *args, priority=NORMAL):
+        """
+        Queue a call on an operation pool.
+        Options:
+            op       (str): operation class, e.g. "import", "boot", "poweroff"
+            func    (func): callable to run
+            args          : positional arguments for func
+            priority (int): Scheduler.HIGH, NORMAL or LOW, default NORMAL
+        Returns:
+            future (Future): result of the call
+        """
+        return Scheduler.pool(op).submit(priority, func, args)
+
+    @staticmethod
+    def run_all(op, func, items, priority=NORMAL):
+        """
+        Call func on each item using an operation pool and wait for them all.
+        Every call is allowed to finish, the first exception is then raised.
+        Returns:
+            results (list): return values in the order of items
+        """
+        futures = [Scheduler.submit(op, func, item, priority=priority) for item in items]
+        results = []
+        error = None
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logging.exception("Scheduled " + op + " operation failed")
+                results.append(None)
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return results
+
+
+# Threads are not copied into a forked child, e.g. the REST API server process
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=Scheduler.after_fork)
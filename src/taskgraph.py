@@ -0,0 +1,116 @@
+from concurrent.futures import wait, FIRST_COMPLETED
+import logging
+import time
+
+from scheduler import Scheduler
+
+class TaskGraph(object):
+    """
+    Dependency graph of tasks executed on the scheduler's operation pools. A
+    task starts as soon as all of its dependencies have completed. If a task fails no further
+    tasks are started, tasks already running are allowed to finish and the
+    first exception is raised.
+    """
+
+    def __init__(self, max_workers=4, priority=Scheduler.LOW):
+        """
+        Options:
+            max_workers (int): maximum number of tasks run at once, default 4
+            priority    (int): scheduler priority of the tasks, default LOW
+        """
+        self.max_workers = max_workers
+        self.priority = priority
+        self.tasks = {}
+        self.timings = {}
+
+    def add(self, name, func, *args, depends=(), op="default"):
+        """
+        Add a task to the graph.
+        Options:
+            name     (str): unique name of the task, e.g. "host:host1"
+            func    (func): callable to run
+            args          : positional arguments for func
+            depends (list): names of tasks that must complete first
+            op       (str): scheduler operation class, default "default"
+        """
+        if name in self.tasks:
+            raise Exception("Task " + name + " already in graph")
+        self.tasks[name] = {"func": func, "args": args, "depends": list(depends), "op": op}
+
+    def __contains__(self, name):
+        return name in self.tasks
+
+    def validate(self):
+        """Check all dependencies exist and the graph has no cycles."""
+        for name, task in self.tasks.items():
+            for dep in task["depends"]:
+                if dep not in self.tasks:
+                    raise Exception("Task " + name + " depends on unknown task " + dep)
+        # Kahn's algorithm, any task left unvisited is part of a cycle
+        indegree = {name: len(task["depends"]) for name, task in self.tasks.items()}
+        ready = [name for name, count in indegree.items() if count == 0]
+        visited = 0
+        while ready:
+            current = ready.pop()
+            visited += 1
+            for name, task in self.tasks.items():
+                if current in task["depends"]:
+                    indegree[name] -= 1
+                    if indegree[name] == 0:
+                        ready.append(name)
+        if visited != len(self.tasks):
+            raise Exception("Task graph contains a dependency cycle")
+
+    def run(self):
+        """
+        Run all tasks, respecting dependencies.
+        Returns:
+            timings (dict): {task name: duration in seconds}
+        """
+        self.validate()
+        remaining = {name: set(task["depends"]) for name, task in self.tasks.items()}
+        running = {}
+        error = None
+        try:
+            while remaining or running:
+                # Start tasks whose dependencies have completed, up to max_workers
+                if error is None:
+                    for name in [name for name, deps in remaining.items() if not deps]:
+                        if len(running) >= self.max_workers:
+                            break
+                        del remaining[name]
+                        future = Scheduler.submit(self.tasks[name]["op"], self.execute, name, priority=self.priority)
+                        running[future] = name
+                if not running:
+                    break
+                done = wait(running.keys(), return_when=FIRST_COMPLETED)[0]
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.exception("Task " + name + " failed")
+                        if error is None:
+                            error = e
+                        continue
+                    for deps in remaining.values():
+                        deps.discard(name)
+                if error is not None:
+                    # Drop tasks still queued in their pools, only running ones are waited for
+                    for future in [future for future in running if future.cancel()]:
+                        del running[future]
+        finally:
+            # Let tasks that could not be cancelled finish before returning
+            wait([future for future in running if not future.cancel()])
+        if error is not None:
+            raise error
+        return self.timings
+
+    def execute(self, name):
+        """Run a single task and record its duration."""
+        task = self.tasks[name]
+        start = time.time()
+        try:
+            return task["func"](*task["args"])
+        finally:
+            self.timings[name] = time.time() - start
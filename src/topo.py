@@ -1,6 +1,7 @@
 import os,sys
-from concurrent.futures import ThreadPoolExecutor
 import time
+import queue
+import threading
 import subprocess
 from pathlib import Path
 import xml.etree.ElementTree as ET
@@ -11,9 +12,15 @@ from models.network import Network
 from models.host import Host
 from models.deployment import Deployment
 from models.port_forward import PortForward
-from resources import Hosts, Networks, Deployments, SSHForward
+from models.snapshot import Snapshot
+from resources import Hosts, Networks, Deployments, SSHForward, Snapshots
 from constructor import Constructor
+from scheduler import Scheduler
+from warm_pool import WarmPool
 from print_colours import Print
+from vbox import VBoxManage, Inventory, LeaseIndex, LeaseWatcher, StateWatcher
+from autossh import KnownHosts, SSHKeys
+from forwarding import ForwardingService, PortAllocator
 
 from db import Session, create_tables, close_database, return_tables
 
@@ -21,36 +28,48 @@ class Topology():
     """Collection of methods to build/interact with a deployment topology."""
 
     @staticmethod
-    def build(template_file="default.yaml"):
+    def build(template_file="default.yaml", workers=4):
         """
         Read a yaml configuration file to get the network required and then
         initialise the network
+        Options:
+            template_file (str): name of the yaml configuration template file
+            workers       (int): number of build tasks run at once, default 4
         """
         # Make sure that the tables are created
         create_tables()
 
         # Check if the file exits, if not then raise an exception
-        Constructor(template_file).parse()
+        Constructor(template_file, workers).parse()
     
+    @staticmethod
+    def plan(template_file="default.yaml"):
+        """
+        Compare a yaml configuration file with its deployment and return the
+        changes required, see Constructor.plan
+        """
+        create_tables()
+        return Constructor(template_file).plan()
+
+    @staticmethod
+    def apply(template_file="default.yaml", workers=4):
+        """
+        Apply a yaml configuration file to its deployment, only building the
+        hosts and networks that have changed. Builds the deployment if it
+        doesn't exist.
+        """
+        create_tables()
+        return Constructor(template_file, workers).apply()
+
     @staticmethod
     def start(deployment_name, vmname='all'):
         """Start virtual network and machines."""
         # Get the hosts from the database
         hosts = Hosts().get_deployment_by_name(deployment_name)
         if hosts:
-            # Start the thread executor
-            executor = ThreadPoolExecutor(max_workers=len(hosts))
-            threads = []
-
-            # Assign each host start command to a thread
-            for host in hosts:
-                # Filter for host
-                if host.get_vmname() == vmname or vmname == 'all':
-                    t = executor.submit(host.start)
-                    threads.append(t)
-            # Wait for all threaded processes to complete
-            for thread in threads:
-                thread.result()
+            # Boot each selected host on the scheduler's boot pool
+            selected = [host for host in hosts if host.get_vmname() == vmname or vmname == 'all']
+            Scheduler.run_all("boot", Host.start, selected)
             # Poll hosts for IP assignment
             Topology.poll_ips(deployment_name)
         else:
@@ -59,23 +78,27 @@ class Topology():
     @staticmethod
     def poll_ips(deployment_name, timeout=30):
         """
-        Poll hosts for IP assignment.
+        Wait for hosts to be assigned IP addresses, returning as soon as the
+        last lease is written.
         Options: 
             deployment_name (str): name of the deployment 
-            timeout         (int): polling timeout in seconds, default is 30s
+            timeout         (int): timeout in seconds, default is 30s
+        Returns:
+            ips (dict): {vmname: ip} for each host assigned an address
         """
         # Get the hosts from the database
         hosts = Hosts().get_deployment_by_name(deployment_name)
-        # Poll all hosts until response received from each
+        # Watch the lease files until a lease is received for each host
         if hosts:
-            t = time.time()
-            while time.time() - t < timeout and len(hosts) > 0:
-                time.sleep(1)
-                for host in hosts:
-                    if host.get_ip():
-                        hosts.remove(host)
-            if len(hosts) > 0:
+            ips = {}
+            vm_macs = {host.get_vmname(): host.get_macs() for host in hosts}
+            with LeaseWatcher() as watcher:
+                for vmname, ip in watcher.stream(vm_macs, timeout):
+                    Print.print_information("IP address assigned to " + vmname + ": " + ip)
+                    ips[vmname] = ip
+            if len(ips) < len(hosts):
                 Print.print_warning("Timeout, IP addresses not yet assigned.")
+            return ips
         else:
             Print.print_error("No Deployment with name {name}".format(name=deployment_name))
 
@@ -84,18 +107,9 @@ class Topology():
         """Shutdown virtual machines."""
         hosts = Hosts().get_deployment_by_name(deployment_name)
         if hosts:
-            # Start the thread executor
-            executor = ThreadPoolExecutor(max_workers=3)
-            threads = []
-            # Assign each host shutdown command to a thread
-            for host in hosts:
-                # Filter for host
-                if host.get_vmname() == vmname or vmname == 'all':
-                    t = executor.submit(host.stop)
-                    threads.append(t)
-            # Wait for all threaded processes to complete
-            for thread in threads:
-                thread.result()
+            # Power off each selected host, ahead of any queued background work
+            selected = [host for host in hosts if host.get_vmname() == vmname or vmname == 'all']
+            Scheduler.run_all("poweroff", Host.stop, selected, priority=Scheduler.HIGH)
         else:
             Print.print_error("No Deployment with name {name}".format(name=deployment_name))
 
@@ -104,69 +118,137 @@ class Topology():
         """Restart virtual machines."""
         hosts = Hosts().get_deployment_by_name(deployment_name)
         if hosts:
-             # Start the thread executor
-            executor = ThreadPoolExecutor(max_workers=len(hosts))
-            threads = []
-            # Assign each host restart command to a thread
-            for host in hosts:
-                # Filter for host
-                if host.get_vmname() == vmname or vmname == 'all':
-                    t = executor.submit(host.restart)
-                    threads.append(t)
-            # Wait for all threaded processes to complete
-            for thread in threads:
-                thread.result()
+            # Restart each selected host on the scheduler's boot pool
+            selected = [host for host in hosts if host.get_vmname() == vmname or vmname == 'all']
+            Scheduler.run_all("boot", Host.restart, selected)
         else:
            Print.print_error("No Deployment with name {name}".format(name=deployment_name))
 
+    @staticmethod
+    def reset_dhcp(deployment_name, timeout=30):
+        """Reset the DHCP servers of all networks within a deployment at once."""
+        networks = Networks().get_deployment_by_name(deployment_name)
+        if networks:
+            # Reset each network's DHCP server on the scheduler's network pool
+            Scheduler.run_all("network", lambda network: network.reset_dhcp(timeout), networks)
+        else:
+            Print.print_error("No Deployment with name {name}".format(name=deployment_name))
+
+    @staticmethod
+    def snapshot(deployment_name, name):
+        """
+        Take a named snapshot of every host within a deployment at once.
+        Options:
+            deployment_name (str): name of the deployment
+            name            (str): name of the snapshot, unique within the deployment
+        """
+        hosts = Hosts().get_deployment_by_name(deployment_name)
+        if hosts:
+            if Snapshots.get_by_name(deployment_name, name):
+                raise Exception("Snapshot " + name + " already exists for deployment " + deployment_name)
+            t = time.time()
+            try:
+                uuids = Scheduler.run_all("snapshot", lambda host: host.take_snapshot(name), hosts)
+            except Exception:
+                # Remove any snapshots taken, the set is only useful if complete
+                Scheduler.run_all("snapshot", lambda host: Topology.discard_snapshot(host, name), hosts)
+                raise
+            # Record the snapshots in a single commit
+            Snapshots.post_all([Snapshot(name, uuid, host.id, host.deployment_id) for host, uuid in zip(hosts, uuids)])
+            Print.print_success("Took snapshot {0} of {1} hosts in {2:.1f}s".format(name, len(hosts), time.time() - t))
+        else:
+            Print.print_error("No Deployment with name {name}".format(name=deployment_name))
+
+    @staticmethod
+    def discard_snapshot(host, name):
+        """Delete a host's snapshot, ignoring hosts without it."""
+        try:
+            host.delete_snapshot(name)
+        except Exception:
+            pass
+
+    @staticmethod
+    def reset(deployment_name, name):
+        """
+        Restore every host within a deployment to a named snapshot at once.
+        Hosts that are running are powered off, restored and started again.
+        Options:
+            deployment_name (str): name of the deployment
+            name            (str): name of the snapshot
+        """
+        hosts = Hosts().get_deployment_by_name(deployment_name)
+        if hosts:
+            snapshots = Snapshots.get_by_name(deployment_name, name)
+            if not snapshots:
+                raise Exception("No snapshot " + name + " for deployment " + deployment_name)
+            t = time.time()
+            by_id = {host.id: host for host in hosts}
+            for host in hosts:
+                if host.id not in [snapshot.host_id for snapshot in snapshots]:
+                    Print.print_warning("Host " + host.get_vmname() + " has no snapshot " + name + ", skipping")
+            # A single listing of the running machines for the whole deployment
+            running = Inventory.parse_vms(VBoxManage.check("list", "runningvms"))
+            restores = [(by_id[snapshot.host_id], snapshot.uuid or snapshot.name) for snapshot in snapshots if snapshot.host_id in by_id]
+            Scheduler.run_all("snapshot", lambda restore: restore[0].restore_snapshot(restore[1], restore[0].get_vmname() in running), restores)
+            Print.print_success("Reset {0} hosts to snapshot {1} in {2:.1f}s".format(len(restores), name, time.time() - t))
+        else:
+            Print.print_error("No Deployment with name {name}".format(name=deployment_name))
+
+    @staticmethod
+    def delete_snapshot(deployment_name, name):
+        """Delete a named snapshot from every host within a deployment."""
+        snapshots = Snapshots.get_by_name(deployment_name, name)
+        if not snapshots:
+            raise Exception("No snapshot " + name + " for deployment " + deployment_name)
+        hosts = {host.id: host for host in Hosts().get_deployment_by_name(deployment_name) or []}
+        deletes = [(hosts[snapshot.host_id], snapshot.uuid or snapshot.name) for snapshot in snapshots if snapshot.host_id in hosts]
+        Scheduler.run_all("snapshot", lambda delete: delete[0].delete_snapshot(delete[1]), deletes)
+        Snapshots.delete_all(snapshots)
+        Print.print_success("Deleted snapshot " + name)
+
+    @staticmethod
+    def snapshots(deployment_name):
+        """
+        Return the snapshots of a deployment.
+        Returns:
+            snapshots (list): [{"name": , "hosts": , "created": }]
+        """
+        summary = {}
+        for snapshot in Snapshots.get_by_deployment(deployment_name):
+            if snapshot.name not in summary:
+                summary[snapshot.name] = {"name": snapshot.name, "hosts": 0, "created": snapshot.dict()["created"]}
+            summary[snapshot.name]["hosts"] += 1
+        return list(summary.values())
+
     @staticmethod
     def destroy(deployment_name):
         """Permanently delete all virtual machines and networks."""
         hosts = Hosts().get_deployment_by_name(deployment_name)
         if hosts:
 
+            deployment_id = hosts[0].deployment_id
+            bases = set(host.get_base() for host in hosts)
+            networks = Networks().get_deployment_by_name(deployment_name) or []
+            # Collect every host's IP addresses in one pass, before the leases are removed
+            leases = LeaseIndex.lookup_many([mac for host in hosts for mac in host.get_macs()])
+            # Stop any SSH forwarding routes, their rows are removed with the deployment
+            host_ports = ForwardingService.shared().remove_group(deployment_id)
+            PortAllocator.release(host_ports + [server.host_port for server in SSHForward.get_by_deployment(deployment_name) or []])
+
             # Ensure all virtual machines are powered down
             Topology.stop(deployment_name)
-            # Start the thread executor
-            executor = ThreadPoolExecutor(max_workers=len(hosts))
-            threads = []
-            # Assign each host destroy command to a thread
-            for host in hosts:
-                t = executor.submit(host.destroy)
-                threads.append(t)
-            # Wait for all threaded processes to complete
-            for thread in threads:
-                thread.result()
-            executor.shutdown(wait=True)
-
-            # Delete host database entry
-            for host in hosts:
-                Session.delete(host)
-                Session.commit()
-
-            # Get the networks from the database
-            networks = Networks().get_deployment_by_name(deployment_name)
-
-            if networks:
-                # Start the thread executor
-                executor = ThreadPoolExecutor(max_workers=len(networks))
-                threads = []
-                # Assign each network destroy command to a thread
-                for network in networks:
-                    t = executor.submit(network.destroy)
-                    threads.append(t)
-                # Wait for all threaded processes to complete
-                for thread in threads:
-                    thread.result()
-                executor.shutdown(wait=True)
-
-                # Delete network database entry
-                for network in networks:
-                    Session.delete(network)
-                    Session.commit()
-
-            # Delete deployment
-            Deployments().delete_by_name(deployment_name)
+            # Delete each host on the scheduler's delete pool
+            Scheduler.run_all("delete", lambda host: host.destroy(known_hosts=False), hosts)
+            # Remove all of the hosts' SSH known_hosts entries with a single rewrite
+            KnownHosts.remove(leases.values())
+            # Delete each network on the scheduler's network pool
+            Scheduler.run_all("network", Network.destroy, networks)
+
+            # Delete all of the deployment's database entries in one transaction
+            StateWatcher.forget(deployment_id)
+            Deployments.teardown(deployment_name)
+            # Delete any base images no longer cloned from
+            Hosts().release_bases(bases)
         else:
             Print.print_error("No Deployment with name {name}".format(name=deployment_name))
 
@@ -209,6 +291,74 @@ class Topology():
                 data.append(n)
         return data
 
+    @staticmethod
+    def get_limits():
+        """Return the concurrency limit and load of each scheduler operation pool."""
+        return Scheduler.get_limits()
+
+    @staticmethod
+    def set_limit(op, limit):
+        """Set the concurrency limit of a scheduler operation class."""
+        Scheduler.set_limit(op, limit)
+
+    @staticmethod
+    def pool_details():
+        """Return the size and contents of each warm pool."""
+        return WarmPool.stats()
+
+    @staticmethod
+    def set_pool_size(image, size, linked=False):
+        """Set the number of ready machines kept in an image's warm pool."""
+        WarmPool.set_size(image, size, linked)
+
+    @staticmethod
+    def vbox_stats():
+        """Return latency statistics for each VBoxManage subcommand run."""
+        return VBoxManage.stats()
+
+    @staticmethod
+    def forwarding_stats():
+        """Return traffic counters for each SSH forwarding route and its connections."""
+        return ForwardingService.shared().get_stats()
+
+    @staticmethod
+    def start_gateway(port=2222):
+        """
+        Start the single-port SSH gateway, relaying HTTP CONNECT tunnels to
+        any host by vmname.
+        Returns:
+            port (int): port the gateway listens on
+        """
+        current = Topology.gateway_port()
+        if current:
+            raise Exception("SSH gateway already listening on port " + str(current))
+        return ForwardingService.shared().add_gateway(port, Topology.resolve_guest)
+
+    @staticmethod
+    def stop_gateway():
+        """Stop the SSH gateway, closing its tunnels."""
+        ForwardingService.shared().remove_group("gateway")
+
+    @staticmethod
+    def gateway_port():
+        """Return the port of the SSH gateway, None if it isn't running."""
+        routes = ForwardingService.shared().get_routes(group="gateway")
+        return routes[0]["host_port"] if routes else None
+
+    @staticmethod
+    def resolve_guest(vmname):
+        """Look up a host's IP address on the resolve pool, returns a Future."""
+        return Scheduler.submit("resolve", Topology.guest_address, vmname, priority=Scheduler.HIGH)
+
+    @staticmethod
+    def guest_address(vmname):
+        """Return the IP address of a host, None if there is no such host."""
+        try:
+            return Hosts().get_ip(vmname)
+        finally:
+            # Pool threads are reused, don't keep rows that may be deleted
+            Session.remove()
+
     @staticmethod
     def shell(vmname):
         """
@@ -223,33 +373,132 @@ class Topology():
 
     @staticmethod
     def send_keys(deployment_name):
-        """Generate and distribute SSH public keys to hosts."""
+        """
+        Generate and distribute SSH public keys to hosts.
+        Returns:
+            results (list): [{"vmname": , "address": , "status": , "duration": , "error": }]
+        """
         hosts = Hosts().get_deployment_by_name(deployment_name)
         if hosts:
-            for host in hosts:
-                host.dist_pkey()
+            # Create the key pair once, up front
+            public_key = SSHKeys.ensure_key_pair()
+            t = time.time()
+            # Distribute keys to all hosts at once on the scheduler's ssh pool
+            results = Scheduler.run_all("ssh", lambda host: host.dist_pkey(public_key), hosts)
+            failed = len([result for result in results if result["status"] == "failed"])
+            Print.print_information("Distributed SSH keys to {0} hosts in {1:.1f}s, {2} failed".format(len(hosts) - failed, time.time() - t, failed))
+            return results
         else:
             Print.print_error("No Deployment with name {name}".format(name=deployment_name))
+            return []
     
+    @staticmethod
+    def exec_stream(deployment_name, command, hosts=None, timeout=None):
+        """
+        Run a command on hosts within a deployment at once, on the scheduler's
+        ssh pool, returning a generator of events as they happen:
+            {"vmname": , "stream": "stdout" | "stderr", "line": }  per line of output
+            {"vmname": , "exit_status": , "duration": , "error": }  once a host finishes
+        Options:
+            deployment_name (str): name of the deployment
+            command         (str): shell command to run
+            hosts          (list): vmnames to run on, default all
+            timeout         (int): seconds to wait for each host, default None
+        """
+        deployed = Hosts().get_deployment_by_name(deployment_name)
+        if not deployed:
+            raise Exception("No Deployment with name " + deployment_name)
+        selected = [host for host in deployed if hosts is None or host.get_vmname() in hosts]
+        if hosts is not None:
+            unknown = set(hosts) - set(host.get_vmname() for host in selected)
+            if unknown:
+                raise Exception("Unknown hosts: " + ", ".join(sorted(unknown)))
+        events = queue.Queue()
+        # Set once the consumer stops reading, e.g. an HTTP client disconnects
+        cancel = threading.Event()
+
+        def run(host):
+            vmname = host.get_vmname()
+            t = time.time()
+            result = {"vmname": vmname, "exit_status": None, "duration": None, "error": None}
+            try:
+                on_line = lambda stream, line: events.put({"vmname": vmname, "stream": stream, "line": line})
+                result["exit_status"] = host.exec_stream(command, on_line, timeout, cancel)
+            except Exception as e:
+                result["error"] = str(e)
+            result["duration"] = round(time.time() - t, 2)
+            events.put(result)
+
+        futures = [Scheduler.submit("ssh", run, host) for host in selected]
+
+        def stream():
+            try:
+                remaining = len(selected)
+                while remaining:
+                    event = events.get()
+                    if "line" not in event:
+                        remaining -= 1
+                    yield event
+            finally:
+                # Free the ssh pool if iteration stops early, queued hosts never start
+                # and running commands have their channels closed
+                cancel.set()
+                for future in futures:
+                    future.cancel()
+        return stream()
+
+    @staticmethod
+    def exec(deployment_name, command, hosts=None, timeout=None):
+        """
+        Run a command on hosts within a deployment at once, printing
+        host-prefixed output as it arrives.
+        Returns:
+            results (list): [{"vmname": , "exit_status": , "duration": , "error": }]
+        """
+        results = []
+        for event in Topology.exec_stream(deployment_name, command, hosts, timeout):
+            if "line" in event and event["stream"] == "stderr":
+                Print.print_warning(event["vmname"] + " | " + event["line"])
+            elif "line" in event:
+                Print.print_information(event["vmname"] + " | " + event["line"])
+            else:
+                results.append(event)
+        return results
+
     @staticmethod
     def start_ssh_forwarder(deployment_name):
-        """Start ssh forwarder server for connection to vm through host machine."""
+        """
+        Forward a host port to each host's SSH port. Every route is served
+        by the one ForwardingService event loop in this process.
+        """
         hosts = Hosts().get_deployment_by_name(deployment_name)
         if hosts:
-            for host in hosts:
-                host.ssh_forwarder() 
+            # Replace any routes already forwarded for the deployment
+            Topology.stop_ssh_forwarders(deployment_name)
+            # Reload the hosts expired by the commit before handing them to worker threads
+            hosts = Hosts().get_deployment_by_name(deployment_name)
+            # Look up each host's address in parallel, this reads VirtualBox but not the database
+            ips = Scheduler.run_all("ssh", Host.get_ip, hosts)
+            # Ports are recorded with this thread's database session
+            for host, ip in zip(hosts, ips):
+                host.ssh_forwarder(ip)
         else:
             Print.print_error("No Deployment with name {name}".format(name=deployment_name))
 
     @staticmethod
     def stop_ssh_forwarders(deployment_name):
-        """Stop any running ssh forwardingservers"""
-        #Loop through the sshforwarders running
-        for server in SSHForward.get_by_deployment(deployment_name):
-            try:
-                os.kill(server.pid, 9)
-                SSHForward.delete(server)
-            except ProcessLookupError:
-                print ("here")
-                pass
-           
+        """
+        Stop forwarding SSH ports for a deployment. The routes are removed
+        from the in-process ForwardingService, no signals are sent.
+        """
+        hosts = Hosts().get_deployment_by_name(deployment_name) or []
+        if not hosts:
+            return
+        # Routes are grouped by deployment, the service knows which are live
+        host_ports = ForwardingService.shared().remove_group(hosts[0].deployment_id)
+        servers = SSHForward.get_by_deployment(deployment_name) or []
+        PortAllocator.release(host_ports + [server.host_port for server in servers])
+        for host in hosts:
+            host.ssh_remote_port = None
+        # Rows and host ports are cleared in one commit
+        SSHForward.delete_all(servers)
@@ -0,0 +1,9 @@
+from .manage import VBoxManage, VBoxResult
+from .inventory import Inventory
+from .settings import VMSettings
+from .leases import LeaseIndex, config_dir, lease_path
+from .lease_watcher import LeaseWatcher
+from .base_image import BaseImage
+from .hostonly import HostOnlyAllocator
+from .dhcp import DHCPServer
+from .state_watcher import StateWatcher
@@ -0,0 +1,94 @@
+from pathlib import Path
+import hashlib
+import threading
+import re
+import os
+
+from vbox.manage import VBoxManage
+from vbox.inventory import Inventory
+from print_colours import Print
+
+class BaseImage(object):
+    """
+    Golden base virtual machines used for linked-clone builds. Each distinct
+    .ova image is imported once into the '/avn-bases' group and snapshotted,
+    hosts are then created as linked clones of that snapshot.
+    """
+    prefix = "avn-base-"
+    snapshot = "avn-base"
+    group = "/avn-bases"
+    _locks = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def name(image):
+        """Return the base virtual machine name for an image."""
+        stem = re.sub(r'[^A-Za-z0-9_.-]', '-', Path(image).stem)
+        digest = hashlib.sha1(image.encode()).hexdigest()[:8]
+        return BaseImage.prefix + stem + "-" + digest
+
+    @staticmethod
+    def is_base(vmname):
+        """Return True if a virtual machine name belongs to a base image."""
+        return vmname.startswith(BaseImage.prefix)
+
+    @staticmethod
+    def ensure(image):
+        """
+        Import and snapshot the base virtual machine for an image, unless it
+        already exists.
+        Returns:
+            base (str): name of the base virtual machine
+        """
+        base = BaseImage.name(image)
+        # Serialise per image so concurrent builds share a single import
+        with BaseImage._lock:
+            lock = BaseImage._locks.setdefault(base, threading.Lock())
+        with lock:
+            if base in Inventory.vms():
+                return base
+            images_path = Path().home() / ".avn" / "images" / image
+            if not os.path.isfile(images_path):
+                raise Exception("Virtual machine '.ova'. template not found")
+            Print.print_information("Importing base image " + base + "...")
+            r = VBoxManage.run("import", str(images_path), "--vsys", "0", "--vmname", base, "--group", BaseImage.group)
+            Inventory.invalidate("vms")
+            if not r.ok:
+                raise Exception("Failed to import base image: " + r.stderr.strip())
+            r = VBoxManage.run("snapshot", base, "take", BaseImage.snapshot)
+            if not r.ok:
+                VBoxManage.run("unregistervm", "--delete", base)
+                Inventory.invalidate("vms")
+                raise Exception("Failed to snapshot base image: " + r.stderr.strip())
+            Print.print_success("Created base image " + base)
+            return base
+
+    @staticmethod
+    def clone(image, vmname, group=None):
+        """
+        Create a virtual machine as a linked clone of an image's base.
+        Options:
+            group (str): VirtualBox group of the clone, default none
+        Returns:
+            base (str): name of the base virtual machine cloned from
+        """
+        base = BaseImage.ensure(image)
+        args = ["clonevm", base, "--snapshot", BaseImage.snapshot, "--options", "link", "--name", vmname, "--register"]
+        if group:
+            args += ["--groups", group]
+        r = VBoxManage.run(*args)
+        Inventory.invalidate("vms")
+        if not r.ok:
+            raise Exception("Failed to clone base image: " + r.stderr.strip())
+        return base
+
+    @staticmethod
+    def destroy(base):
+        """Delete a base virtual machine, it must no longer have any linked clones."""
+        if base not in Inventory.vms():
+            return
+        r = VBoxManage.run("unregistervm", "--delete", base)
+        Inventory.invalidate("vms")
+        if not r.ok:
+            raise Exception("Failed to delete base image " + base + ": " + r.stderr.strip())
+        Print.print_success("Destroyed base image " + base)
@@ -0,0 +1,93 @@
+import subprocess
+import time
+import sys
+import re
+import os
+
+from vbox.manage import VBoxManage
+from vbox.inventory import Inventory
+from vbox.leases import LeaseIndex, lease_path
+
+class DHCPServer(object):
+    """
+    Control and readiness checks for the VirtualBox DHCP server of a
+    host-only network.
+    """
+    poll_interval = 0.5
+
+    @staticmethod
+    def enabled(netname):
+        """Return True if VirtualBox reports the network's DHCP server as enabled."""
+        server = Inventory.dhcpservers().get(netname)
+        return server is not None and server.get("Enabled") == "Yes"
+
+    @staticmethod
+    def pids(netname):
+        """Return the process ids of the VBoxNetDHCP processes serving the network."""
+        pattern = re.compile(("HostInterfaceNetworking-" + re.escape(netname) + r"(?![0-9])").encode())
+        if sys.platform == "linux":
+            pids = set()
+            for pid in os.listdir("/proc"):
+                if not pid.isdigit():
+                    continue
+                try:
+                    with open("/proc/" + pid + "/cmdline", "rb") as f:
+                        cmdline = f.read()
+                except OSError:
+                    continue
+                if b"VBoxNetDHCP" in cmdline and pattern.search(cmdline):
+                    pids.add(int(pid))
+            return pids
+        output = subprocess.run(["ps", "-axo", "pid=,command="], stdout=subprocess.PIPE).stdout
+        return set(int(line.split()[0]) for line in output.splitlines() if b"VBoxNetDHCP" in line and pattern.search(line))
+
+    @staticmethod
+    def running(netname):
+        """Return True if a VBoxNetDHCP process is serving the network."""
+        return len(DHCPServer.pids(netname)) > 0
+
+    @staticmethod
+    def wait(check, deadline):
+        """Poll a check until it returns True, returns False if the deadline passes."""
+        while not check():
+            if time.time() > deadline:
+                return False
+            time.sleep(DHCPServer.poll_interval)
+        return True
+
+    @staticmethod
+    def reset(netname, timeout=30):
+        """
+        Restart a network's DHCP server, returning as soon as the server is
+        confirmed back up.
+        Options:
+            netname (str): name of the host-only network
+            timeout (int): seconds to wait for the reset, default is 30s
+        Returns:
+            duration (float): seconds taken to reset
+        """
+        start = time.time()
+        deadline = start + timeout
+        # VirtualBox only runs the server while a machine uses the network
+        old_pids = DHCPServer.pids(netname)
+        # Restart the server process, supported from VirtualBox 6.1
+        r = VBoxManage.run("dhcpserver", "restart", "--ifname", netname)
+        if r.ok:
+            # The restarted server runs as a new process
+            ready = lambda: len(DHCPServer.pids(netname) - old_pids) > 0
+        else:
+            # Older releases only toggle the server, the flag is set before modify returns
+            for option in ["--disable", "--enable"]:
+                r = VBoxManage.run("dhcpserver", "modify", "--ifname", netname, option)
+                Inventory.invalidate("dhcpservers")
+                if not r.ok:
+                    raise Exception("Failed to reset DHCP server for " + netname + ": " + r.stderr.strip())
+            if not DHCPServer.enabled(netname):
+                raise Exception("DHCP server for " + netname + " not enabled")
+            # The process isn't stopped while adapters are attached, a lingering one is still serving
+            ready = lambda: DHCPServer.running(netname)
+        # The server is up once its process is running and has its lease file to serve from
+        if old_pids and not DHCPServer.wait(lambda: ready() and lease_path(netname).exists(), deadline):
+            raise Exception("Timeout, DHCP server for " + netname + " not restarted")
+        LeaseIndex.refresh(netname)
+        return time.time() - start
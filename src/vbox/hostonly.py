@@ -0,0 +1,49 @@
+import threading
+import re
+
+from vbox.manage import VBoxManage
+from vbox.inventory import Inventory
+
+class HostOnlyAllocator(object):
+    """
+    Thread-safe allocation of VirtualBox host-only interface names.
+    VirtualBox picks the name itself on 'hostonlyif create', so creation is
+    serialised, the assigned name is parsed from its output and reserved
+    in-process until the network is destroyed.
+    """
+    _lock = threading.Lock()
+    _reserved = set()
+
+    @staticmethod
+    def create():
+        """
+        Create a host-only interface.
+        Returns:
+            netname (str): name assigned by VirtualBox, e.g. "vboxnet0"
+        """
+        with HostOnlyAllocator._lock:
+            r = VBoxManage.run("hostonlyif", "create")
+            Inventory.invalidate("hostonlyifs")
+            if not r.ok:
+                raise Exception("Failed to create host-only interface: " + r.stderr.strip())
+            m = re.search(r"Interface '(.+?)' was successfully created", r.output)
+            if not m:
+                raise Exception("Unable to identify created host-only interface: " + r.output)
+            netname = m.group(1)
+            if netname in HostOnlyAllocator._reserved:
+                # Don't leak the interface just created
+                VBoxManage.run("hostonlyif", "remove", netname)
+                Inventory.invalidate("hostonlyifs")
+                raise Exception("Host-only interface " + netname + " already allocated")
+            HostOnlyAllocator._reserved.add(netname)
+        # Reconcile with VirtualBox's view of the interfaces
+        if netname not in Inventory.hostonlyifs():
+            HostOnlyAllocator.release(netname)
+            raise Exception("Failed to create network with name " + netname)
+        return netname
+
+    @staticmethod
+    def release(netname):
+        """Release a name once its host-only interface has been removed."""
+        with HostOnlyAllocator._lock:
+            HostOnlyAllocator._reserved.discard(netname)
@@ -0,0 +1,122 @@
+import threading
+import time
+import re
+
+from vbox.manage import VBoxManage
+
+class Inventory(object):
+    """
+    In-process cache of VirtualBox's VMs, host-only interfaces and DHCP servers.
+    Each list is fetched once and parsed into a dict. AVN's own create/destroy
+    calls invalidate the affected list, the TTL is a fallback for changes made
+    outside of AVN.
+    """
+    ttl = 5
+    _cache = {}
+    # Bumped by invalidate, a list fetched while its generation changed is stale
+    _generations = {"vms": 0, "hostonlyifs": 0, "dhcpservers": 0}
+    _lock = threading.Lock()
+    _locks = {"vms": threading.Lock(), "hostonlyifs": threading.Lock(), "dhcpservers": threading.Lock()}
+
+    @staticmethod
+    def vms():
+        """
+        Return all VirtualBox virtual machines.
+        Returns:
+            vms (dict): {vmname: uuid}
+        """
+        return Inventory._get("vms", Inventory.parse_vms)
+
+    @staticmethod
+    def hostonlyifs():
+        """
+        Return all VirtualBox host-only interfaces.
+        Returns:
+            hostonlyifs (dict): {netname: {"Name": , "IPAddress": , "NetworkName": , ...}}
+        """
+        return Inventory._get("hostonlyifs", Inventory.parse_hostonlyifs)
+
+    @staticmethod
+    def dhcpservers():
+        """
+        Return all VirtualBox DHCP servers, keyed by host-only interface name.
+        Returns:
+            dhcpservers (dict): {netname: {"NetworkName": , "Dhcpd IP": , "Enabled": , ...}}
+        """
+        return Inventory._get("dhcpservers", Inventory.parse_dhcpservers)
+
+    @staticmethod
+    def invalidate(*kinds):
+        """
+        Drop cached lists so the next read fetches them from VirtualBox.
+        Options:
+            kinds (str): "vms", "hostonlyifs" and/or "dhcpservers", default all
+        """
+        with Inventory._lock:
+            for kind in kinds or list(Inventory._generations):
+                Inventory._cache.pop(kind, None)
+                Inventory._generations[kind] += 1
+
+    @staticmethod
+    def _get(kind, parser):
+        """Return the cached list, refreshing it if invalidated or expired."""
+        # Only one thread refreshes a given list, the others wait for its result
+        with Inventory._locks[kind]:
+            while True:
+                with Inventory._lock:
+                    entry = Inventory._cache.get(kind)
+                    generation = Inventory._generations[kind]
+                if entry is not None and time.time() - entry[0] <= Inventory.ttl:
+                    return entry[1]
+                r = VBoxManage.run("list", kind)
+                if not r.ok:
+                    raise Exception("Failed to list VirtualBox " + kind + ": " + r.stderr.strip())
+                entry = (time.time(), parser(r.stdout))
+                with Inventory._lock:
+                    # Invalidated while listing, the result may predate the change
+                    if Inventory._generations[kind] != generation:
+                        continue
+                    Inventory._cache[kind] = entry
+                return entry[1]
+
+    @staticmethod
+    def parse_vms(output):
+        """Parse 'list vms' output into {vmname: uuid}."""
+        vms = {}
+        for line in output.splitlines():
+            m = re.match(r'^"(.*)" \{(.*)\}$', line.strip())
+            if m:
+                vms[m.group(1)] = m.group(2)
+        return vms
+
+    @staticmethod
+    def parse_blocks(output):
+        """Parse blank line separated 'Key: value' blocks into a list of dicts."""
+        blocks = []
+        block = {}
+        for line in output.splitlines():
+            if not line.strip():
+                if block:
+                    blocks.append(block)
+                block = {}
+                continue
+            if ":" in line:
+                key, value = line.split(":", 1)
+                block[key.strip()] = value.strip()
+        if block:
+            blocks.append(block)
+        return blocks
+
+    @staticmethod
+    def parse_hostonlyifs(output):
+        """Parse 'list hostonlyifs' output into {netname: properties}."""
+        return {block["Name"]: block for block in Inventory.parse_blocks(output) if "Name" in block}
+
+    @staticmethod
+    def parse_dhcpservers(output):
+        """Parse 'list dhcpservers' output into {netname: properties}."""
+        servers = {}
+        for block in Inventory.parse_blocks(output):
+            name = block.get("NetworkName", "")
+            servers[name.replace("HostInterfaceNetworking-", "")] = block
+        return servers
@@ -0,0 +1,118 @@
+import ctypes
+import ctypes.util
+import select
+import struct
+import time
+import sys
+import os
+
+from vbox.leases import LeaseIndex, config_dir
+
+# inotify constants, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+EVENT_HEADER = struct.Struct("iIII")
+
+class LeaseWatcher(object):
+    """
+    Watches the VirtualBox DHCP lease files and reports leases the moment they
+    are written. Uses inotify on Linux and falls back to polling the lease
+    index elsewhere, or if inotify is unavaliable.
+    """
+    poll_interval = 0.5
+    # Upper bound on an inotify wait, guards against missed events
+    max_wait = 5
+
+    def __init__(self):
+        self.fd = None
+        if sys.platform == "linux":
+            try:
+                self.fd = self.inotify_watch(str(config_dir()))
+            except OSError:
+                self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def inotify_watch(path):
+        """Return a non-blocking inotify descriptor watching a directory for lease file writes."""
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, "inotify_add_watch failed for " + path)
+        return fd
+
+    def close(self):
+        """Release the inotify descriptor."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def wait(self, timeout):
+        """
+        Block until a lease file changes or the timeout expires.
+        Returns True if a lease file event was received.
+        """
+        if self.fd is None:
+            time.sleep(min(timeout, self.poll_interval))
+            return False
+        readable = select.select([self.fd], [], [], min(timeout, self.max_wait))[0]
+        if not readable:
+            return False
+        return self.drain()
+
+    def drain(self):
+        """Read all pending inotify events, returns True if any concern a lease file."""
+        leases_changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return leases_changed
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if name.endswith(LeaseIndex.suffix.encode()):
+                    leases_changed = True
+
+    def stream(self, vm_macs, timeout=30):
+        """
+        Yield (vmname, ip) pairs as soon as each virtual machine is leased an
+        IP address, in the order the leases are written.
+        Options:
+            vm_macs   (dict): {vmname: [mac, ...]}
+            timeout    (int): seconds to wait for all leases, default is 30s
+        """
+        remaining = {vmname: list(macs) for vmname, macs in vm_macs.items()}
+        deadline = time.time() + timeout
+        while remaining:
+            # Check for leases, the index only re-parses files that have changed
+            leases = LeaseIndex.lookup_many([mac for macs in remaining.values() for mac in macs])
+            for vmname in list(remaining.keys()):
+                for mac in remaining[vmname]:
+                    if mac in leases:
+                        del remaining[vmname]
+                        yield vmname, leases[mac]
+                        break
+            if not remaining:
+                return
+            left = deadline - time.time()
+            if left <= 0:
+                return
+            self.wait(left)
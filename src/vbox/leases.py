@@ -0,0 +1,139 @@
+from pathlib import Path
+import xml.etree.ElementTree as ET
+import threading
+import sys
+import os
+
+def config_dir():
+    """Return the VirtualBox configuration directory for the current OS."""
+    if sys.platform == "darwin":
+        # Mac config location ~/Library/VirtualBox
+        return Path.home() / "Library" / "VirtualBox"
+    elif sys.platform == "linux":
+        # Linux config location ~/.config/VirtualBox
+        return Path.home() / ".config" / "VirtualBox"
+    raise Exception("OS not supported")
+
+def lease_path(netname):
+    """Return the path of the DHCP lease file for a host-only network."""
+    return config_dir() / ("HostInterfaceNetworking-" + netname + "-Dhcpd.leases")
+
+
+class LeaseIndex(object):
+    """
+    In-memory index of VirtualBox DHCP leases. A lease file is only re-parsed
+    when its mtime or size changes, lookups by MAC address are dict reads.
+    """
+    prefix = "HostInterfaceNetworking-"
+    suffix = "-Dhcpd.leases"
+    # {netname: (mtime_ns, size, {mac: ip})}
+    _files = {}
+    # {mac: ip} across all networks
+    _macs = {}
+    _lock = threading.RLock()
+
+    @staticmethod
+    def leases(netname):
+        """
+        Return the active leases of a host-only network.
+        Returns:
+            leases  (dict): {mac: ip}
+        """
+        with LeaseIndex._lock:
+            LeaseIndex.refresh(netname)
+            entry = LeaseIndex._files.get(netname)
+            return dict(entry[2]) if entry else {}
+
+    @staticmethod
+    def lookup(mac):
+        """Return the IP address leased to a MAC address, or None."""
+        with LeaseIndex._lock:
+            LeaseIndex.refresh_all()
+            return LeaseIndex._macs.get(mac)
+
+    @staticmethod
+    def lookup_many(macs):
+        """
+        Return the IP addresses leased to several MAC addresses.
+        Returns:
+            leases  (dict): {mac: ip} for each MAC with an active lease
+        """
+        with LeaseIndex._lock:
+            LeaseIndex.refresh_all()
+            return {mac: LeaseIndex._macs[mac] for mac in macs if mac in LeaseIndex._macs}
+
+    @staticmethod
+    def refresh(netname):
+        """
+        Re-parse a network's lease file if it has changed since it was last read.
+        Returns True if the index changed.
+        """
+        with LeaseIndex._lock:
+            entry = LeaseIndex._files.get(netname)
+            try:
+                st = os.stat(str(lease_path(netname)))
+            except FileNotFoundError:
+                if entry is None:
+                    return False
+                del LeaseIndex._files[netname]
+                LeaseIndex.rebuild()
+                return True
+            if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                return False
+            try:
+                leases = LeaseIndex.parse(str(lease_path(netname)))
+            except ET.ParseError:
+                # File caught mid-write by VirtualBox, keep the previous leases
+                return False
+            LeaseIndex._files[netname] = (st.st_mtime_ns, st.st_size, leases)
+            LeaseIndex.rebuild()
+            return True
+
+    @staticmethod
+    def refresh_all():
+        """Refresh every lease file in the VirtualBox config directory."""
+        with LeaseIndex._lock:
+            netnames = set(LeaseIndex._files.keys())
+            try:
+                for name in os.listdir(str(config_dir())):
+                    if name.startswith(LeaseIndex.prefix) and name.endswith(LeaseIndex.suffix):
+                        netnames.add(name[len(LeaseIndex.prefix):-len(LeaseIndex.suffix)])
+            except FileNotFoundError:
+                pass
+            changed = False
+            for netname in netnames:
+                changed = LeaseIndex.refresh(netname) or changed
+            return changed
+
+    @staticmethod
+    def forget(netname):
+        """Drop a network's leases from the index, e.g. once the network is destroyed."""
+        with LeaseIndex._lock:
+            if LeaseIndex._files.pop(netname, None) is not None:
+                LeaseIndex.rebuild()
+
+    @staticmethod
+    def rebuild():
+        """Rebuild the MAC address index from the per-network leases."""
+        macs = {}
+        for entry in LeaseIndex._files.values():
+            macs.update(entry[2])
+        LeaseIndex._macs = macs
+
+    @staticmethod
+    def parse(path):
+        """
+        Incrementally parse a VirtualBox lease file.
+        Returns:
+            leases  (dict): {mac: ip} for each lease not expired
+        """
+        leases = {}
+        for event, element in ET.iterparse(path, events=("end",)):
+            if element.tag != "Lease":
+                continue
+            if element.attrib.get("state") != "expired":
+                address = element.find("Address")
+                if address is not None and "mac" in element.attrib:
+                    leases[element.attrib["mac"]] = address.attrib["value"]
+            element.clear()
+        return leases
@@ -0,0 +1,234 @@
+import subprocess
+import threading
+import os
+import itertools
+import shutil
+import heapq
+import logging
+import time
+
+class VBoxResult(object):
+    """
+    Outcome of a single VBoxManage invocation.
+    """
+
+    def __init__(self, args, returncode, stdout, stderr, duration):
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+
+    @property
+    def ok(self):
+        """Return True if VBoxManage exited cleanly."""
+        return self.returncode == 0
+
+    @property
+    def output(self):
+        """Return the combined stdout and stderr, as subprocess.getoutput would."""
+        return (self.stdout + self.stderr).strip()
+
+    def __str__(self):
+        return self.output
+
+
+class LatencyStats(object):
+    """
+    Latency histogram for one VBoxManage subcommand.
+    """
+    # Upper bounds (seconds) of the histogram buckets, last bucket is unbounded
+    buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.wait = 0.0
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def record(self, duration, wait, ok):
+        """Add a single invocation to the histogram."""
+        self.count += 1
+        self.total += duration
+        self.wait += wait
+        if not ok:
+            self.errors += 1
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+        for i, bound in enumerate(self.buckets):
+            if duration <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def dict(self):
+        """Return a dictionary of the statistics for printing purposes."""
+        labels = ["<=" + str(bound) + "s" for bound in self.buckets] + [">" + str(self.buckets[-1]) + "s"]
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean": round(self.total / self.count, 3) if self.count else None,
+            "min": round(self.min, 3) if self.min is not None else None,
+            "max": round(self.max, 3) if self.max is not None else None,
+            "wait": round(self.wait / self.count, 3) if self.count else None,
+            "histogram": dict(zip(labels, self.counts)),
+        }
+
+
+class PrioritySlots(object):
+    """
+    Counting semaphore that hands free slots to the waiter with the lowest
+    priority value first, then in arrival order.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.waiting = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+
+    def acquire(self, priority):
+        """Block until a slot is free and no higher priority caller is waiting."""
+        with self.cond:
+            entry = (priority, next(self.seq))
+            heapq.heappush(self.waiting, entry)
+            while self.used >= self.limit or self.waiting[0] != entry:
+                self.cond.wait()
+            heapq.heappop(self.waiting)
+            self.used += 1
+            # The next waiter may also be able to take a slot
+            self.cond.notify_all()
+
+    def release(self):
+        """Return a slot."""
+        with self.cond:
+            self.used -= 1
+            self.cond.notify_all()
+
+    def resize(self, limit):
+        """Change the number of slots, running commands keep theirs."""
+        with self.cond:
+            self.limit = limit
+            self.cond.notify_all()
+
+
+class VBoxManage(object):
+    """
+    Central execution engine for all VirtualBox commands. VBoxManage is
+    executed directly (no shell), the number of concurrent invocations is
+    capped globally and per-subcommand latency is recorded.
+    """
+    binary = shutil.which("VBoxManage") or shutil.which("vboxmanage") or "VBoxManage"
+    limit = 4
+    # Priority used when the calling thread has not set one
+    default_priority = 5
+    _slots = PrioritySlots(limit)
+    _local = threading.local()
+    _stats = {}
+    _stats_lock = threading.Lock()
+
+    @staticmethod
+    def set_limit(limit):
+        """
+        Set the maximum number of VBoxManage processes allowed to run at once.
+        Options:
+            limit (int): number of concurrent invocations, must be at least 1
+        """
+        limit = int(limit)
+        if limit < 1:
+            raise Exception("VBoxManage concurrency limit must be at least 1")
+        VBoxManage.limit = limit
+        VBoxManage._slots.resize(limit)
+
+    @staticmethod
+    def after_fork():
+        """Free the slots in a forked child, commands running in the parent don't hold them."""
+        VBoxManage._slots = PrioritySlots(VBoxManage._slots.limit)
+        VBoxManage._stats_lock = threading.Lock()
+
+    @staticmethod
+    def set_priority(priority):
+        """
+        Set the priority of VBoxManage commands run by the calling thread.
+        Options:
+            priority (int): lower values are run first, None restores the default
+        """
+        VBoxManage._local.priority = priority
+
+    @staticmethod
+    def run(*args, timeout=None):
+        """
+        Run a VBoxManage command and return a VBoxResult.
+        Options:
+            args    (str): VBoxManage arguments, e.g. "list", "vms"
+            timeout (int): seconds before the command is abandoned, default None
+        """
+        args = [str(arg) for arg in args]
+        subcommand = args[0] if args else ""
+        # Wait for a free execution slot
+        priority = getattr(VBoxManage._local, "priority", None)
+        queued = time.time()
+        VBoxManage._slots.acquire(VBoxManage.default_priority if priority is None else priority)
+        try:
+            started = time.time()
+            try:
+                proc = subprocess.run([VBoxManage.binary] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                      universal_newlines=True, timeout=timeout)
+                result = VBoxResult(args, proc.returncode, proc.stdout, proc.stderr, time.time() - started)
+            except subprocess.TimeoutExpired as e:
+                result = VBoxResult(args, -1, e.stdout or "", "Timed out after {0}s".format(timeout), time.time() - started)
+            except OSError as e:
+                result = VBoxResult(args, -1, "", repr(e), time.time() - started)
+        finally:
+            VBoxManage._slots.release()
+        # Record latency for the subcommand
+        with VBoxManage._stats_lock:
+            if subcommand not in VBoxManage._stats:
+                VBoxManage._stats[subcommand] = LatencyStats()
+            VBoxManage._stats[subcommand].record(result.duration, started - queued, result.ok)
+        if not result.ok:
+            logging.warning("VBoxManage " + " ".join(args) + " failed (" + str(result.returncode) + "): " + result.stderr.strip())
+        return result
+
+    @staticmethod
+    def check(*args, timeout=None):
+        """
+        Run a VBoxManage command, raising an exception if it fails.
+        Returns the command's stdout.
+        """
+        result = VBoxManage.run(*args, timeout=timeout)
+        if not result.ok:
+            raise Exception("VBoxManage " + args[0] + " failed: " + (result.stderr.strip() or result.output))
+        return result.stdout
+
+    @staticmethod
+    def stats():
+        """
+        Return latency statistics per subcommand.
+        Returns:
+            stats (list): [{subcommand: , count: , errors: , mean: , min: , max: , wait: , histogram: }]
+        """
+        with VBoxManage._stats_lock:
+            data = []
+            for subcommand in sorted(VBoxManage._stats.keys()):
+                s = {"subcommand": subcommand}
+                s.update(VBoxManage._stats[subcommand].dict())
+                data.append(s)
+            return data
+
+    @staticmethod
+    def reset_stats():
+        """Clear all recorded latency statistics."""
+        with VBoxManage._stats_lock:
+            VBoxManage._stats = {}
+
+
+# Threads are not copied into a forked child, e.g. the REST API server process
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=VBoxManage.after_fork)
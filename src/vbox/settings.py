@@ -0,0 +1,64 @@
+from collections import OrderedDict
+
+from vbox.manage import VBoxManage
+
+class VMSettings(object):
+    """
+    Collects modifyvm options for a virtual machine so they can be applied
+    with a single VBoxManage invocation (and a single session lock).
+    """
+
+    def __init__(self, vmname):
+        """
+        Options:
+            vmname (str): name of the virtual machine the settings apply to
+        """
+        self.vmname = vmname
+        self.options = OrderedDict()
+
+    def set(self, option, value):
+        """
+        Queue a modifyvm option, replacing any previously queued value.
+        Options:
+            option (str): modifyvm option without the leading '--', e.g. "nic1"
+            value  (str): value of the option
+        """
+        self.options[option] = str(value)
+
+    def nic(self, adapter, nettype):
+        """Queue the network type of an adapter, e.g. 'hostonly', 'bridged' or 'nat'."""
+        self.set("nic" + str(adapter), nettype)
+
+    def hostonly_adapter(self, adapter, netname):
+        """Queue the host-only network an adapter is attached to."""
+        self.set("hostonlyadapter" + str(adapter), netname)
+
+    def bridge_adapter(self, adapter, iface):
+        """Queue the host interface a bridged adapter is attached to."""
+        self.set("bridgeadapter" + str(adapter), iface)
+
+    def pending(self):
+        """Return True if there are queued options not yet applied."""
+        return len(self.options) > 0
+
+    def args(self):
+        """Return the queued options as modifyvm arguments."""
+        args = []
+        for option, value in self.options.items():
+            args += ["--" + option, value]
+        return args
+
+    def flush(self):
+        """
+        Apply all queued options with one modifyvm call.
+        Returns:
+            applied (list): names of the options applied, empty if none were queued
+        """
+        if not self.pending():
+            return []
+        r = VBoxManage.run("modifyvm", self.vmname, *self.args())
+        if not r.ok:
+            raise Exception("Failed to configure virtual machine " + self.vmname + ": " + r.stderr.strip())
+        applied = list(self.options)
+        self.options.clear()
+        return applied
@@ -0,0 +1,148 @@
+import threading
+import os
+import logging
+import time
+
+from vbox.manage import VBoxManage
+from vbox.inventory import Inventory
+
+class StateWatcher(object):
+    """
+    Shared power state watcher for the virtual machines of a deployment.
+    While anyone is waiting, a single background thread lists the running
+    virtual machines once per tick and publishes state transitions, so any
+    number of callers can wait on a state without polling VirtualBox
+    themselves. The thread exits when there are no more waiters.
+    """
+    interval = 0.5
+    _watchers = {}
+    _lock = threading.Lock()
+
+    def __init__(self, name=None):
+        self.name = name
+        self.states = {}
+        self.listeners = []
+        self.waiters = 0
+        self.thread = None
+        # Number of polls started, and the poll the current states came from
+        self.started = 0
+        self.observed = 0
+        self.cond = threading.Condition()
+
+    @staticmethod
+    def for_deployment(deployment_id):
+        """Return the shared watcher for a deployment, creating it if needed."""
+        with StateWatcher._lock:
+            watcher = StateWatcher._watchers.get(deployment_id)
+            if watcher is None:
+                watcher = StateWatcher(deployment_id)
+                StateWatcher._watchers[deployment_id] = watcher
+            return watcher
+
+    @staticmethod
+    def forget(deployment_id):
+        """Drop the watcher of a destroyed deployment."""
+        with StateWatcher._lock:
+            StateWatcher._watchers.pop(deployment_id, None)
+
+    @staticmethod
+    def after_fork():
+        """Forget the watchers in a forked child, their poll threads were not copied."""
+        StateWatcher._watchers = {}
+        StateWatcher._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        """
+        Register a callback for state transitions.
+        Options:
+            callback (func): called as callback(vmname, old_state, new_state)
+        """
+        with self.cond:
+            self.listeners.append(callback)
+
+    def state(self, vmname):
+        """Return the last observed state of a virtual machine, None if not yet seen."""
+        with self.cond:
+            return self.states.get(vmname)
+
+    def wait_for(self, vmname, state, timeout=30):
+        """
+        Block until a virtual machine reaches a state.
+        Options:
+            vmname  (str): name of the virtual machine
+            state   (str): "running", "poweroff" or "absent", or a tuple of states
+            timeout (int): seconds to wait, default is 30s
+        Returns the state reached, None if none was reached before the timeout.
+        """
+        deadline = time.time() + timeout
+        states = (state,) if isinstance(state, str) else tuple(state)
+        with self.cond:
+            # Only trust polls started after this call, earlier ones may be stale
+            since = self.started
+            self.waiters += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            try:
+                while self.observed <= since or self.states.get(vmname, "absent") not in states:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        return None
+                    self.cond.wait(left)
+                return self.states.get(vmname, "absent")
+            finally:
+                self.waiters -= 1
+
+    def run(self):
+        """Poll loop, runs only while there are waiters."""
+        while True:
+            with self.cond:
+                if self.waiters == 0:
+                    self.thread = None
+                    return
+                self.started += 1
+                tick = self.started
+            try:
+                states = self.poll()
+            except Exception as e:
+                logging.warning("VM state poll failed: " + repr(e))
+                time.sleep(self.interval)
+                continue
+            self.publish(tick, states)
+            time.sleep(self.interval)
+
+    def poll(self):
+        """
+        List virtual machine states with a single pair of VBoxManage calls.
+        Returns:
+            states (dict): {vmname: "running" | "poweroff"}
+        """
+        r = VBoxManage.run("list", "runningvms")
+        if not r.ok:
+            raise Exception("Failed to list running virtual machines: " + r.stderr.strip())
+        running = Inventory.parse_vms(r.stdout)
+        return {vmname: ("running" if vmname in running else "poweroff") for vmname in Inventory.vms()}
+
+    def publish(self, tick, states):
+        """Store the states from a poll and notify waiters and listeners of changes."""
+        with self.cond:
+            changes = []
+            for vmname in set(self.states) | set(states):
+                old, new = self.states.get(vmname), states.get(vmname, "absent")
+                if old != new:
+                    changes.append((vmname, old, new))
+            self.states = dict(states)
+            self.observed = tick
+            listeners = list(self.listeners)
+            self.cond.notify_all()
+        for vmname, old, new in changes:
+            for callback in listeners:
+                try:
+                    callback(vmname, old, new)
+                except Exception:
+                    logging.exception("VM state listener failed")
+
+
+# Threads are not copied into a forked child, e.g. the REST API server process
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=StateWatcher.after_fork)
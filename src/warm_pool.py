@@ -0,0 +1,147 @@
+from pathlib import Path
+import threading
+import logging
+import uuid
+import os
+
+from vbox import VBoxManage, Inventory, BaseImage
+from scheduler import Scheduler
+
+class WarmPool(object):
+    """
+    Pool of unattached, already imported (or linked-cloned) virtual machines
+    per image. Builds claim a ready machine and rename it instead of
+    importing, the pool is then refilled in the background at LOW priority.
+    Pool machines live in the '/avn-pool' group and are found again by name
+    after a restart, only the pool sizes are held in memory.
+    """
+    prefix = "avn-pool-"
+    group = "/avn-pool"
+    # Target number of ready machines, {(image, linked): size}
+    sizes = {}
+    _filling = set()
+    _lock = threading.RLock()
+
+    @staticmethod
+    def key(image, linked):
+        """Return the name prefix shared by an image's pool machines."""
+        stem = BaseImage.name(image)[len(BaseImage.prefix):]
+        return WarmPool.prefix + ("linked-" if linked else "full-") + stem + "-"
+
+    @staticmethod
+    def ready(image, linked):
+        """Return the names of an image's pool machines ready to be claimed."""
+        key = WarmPool.key(image, linked)
+        with WarmPool._lock:
+            return sorted(name for name in Inventory.vms() if name.startswith(key) and name not in WarmPool._filling)
+
+    @staticmethod
+    def uses_base(base):
+        """Return True if any pool machine is a linked clone of a base vm."""
+        key = WarmPool.prefix + "linked-" + base[len(BaseImage.prefix):] + "-"
+        return any(name.startswith(key) for name in Inventory.vms())
+
+    @staticmethod
+    def set_size(image, size, linked=False):
+        """
+        Set the number of ready machines kept for an image and start filling
+        or draining the pool to match.
+        Options:
+            image   (str): name of the .ova image located in the images directory
+            size    (int): number of ready machines, 0 empties the pool
+            linked (bool): pool linked clones of the image's base vm (default is False)
+        """
+        size = int(size)
+        if size < 0:
+            raise Exception("Pool size must not be negative")
+        if not os.path.isfile(str(Path().home() / ".avn" / "images" / image)):
+            raise Exception("Virtual machine '.ova'. template not found")
+        with WarmPool._lock:
+            WarmPool.sizes[(image, linked)] = size
+        WarmPool.refill(image, linked)
+
+    @staticmethod
+    def refill(image, linked):
+        """Queue imports for missing pool machines and deletes for any excess."""
+        key = WarmPool.key(image, linked)
+        with WarmPool._lock:
+            size = WarmPool.sizes.get((image, linked), 0)
+            ready = WarmPool.ready(image, linked)
+            filling = [name for name in WarmPool._filling if name.startswith(key)]
+            names = [key + uuid.uuid4().hex[:8] for n in range(size - len(ready) - len(filling))]
+            WarmPool._filling.update(names)
+            excess = ready[size:]
+        for name in names:
+            Scheduler.submit("import", WarmPool.fill, image, name, linked, priority=Scheduler.LOW)
+        for name in excess:
+            Scheduler.submit("delete", WarmPool.discard, name, priority=Scheduler.LOW)
+
+    @staticmethod
+    def fill(image, name, linked):
+        """Create a single pool machine, run on the scheduler's import pool."""
+        try:
+            if linked:
+                BaseImage.clone(image, name, group=WarmPool.group)
+            else:
+                images_path = Path().home() / ".avn" / "images" / image
+                r = VBoxManage.run("import", str(images_path), "--vsys", "0", "--vmname", name, "--group", WarmPool.group)
+                if not r.ok:
+                    raise Exception("Failed to import image: " + r.stderr.strip())
+            logging.info("Added " + name + " to the warm pool")
+        except Exception:
+            logging.exception("Failed to fill warm pool machine " + name)
+        finally:
+            with WarmPool._lock:
+                Inventory.invalidate("vms")
+                WarmPool._filling.discard(name)
+
+    @staticmethod
+    def discard(name):
+        """Delete a pool machine."""
+        VBoxManage.run("unregistervm", "--delete", name)
+        Inventory.invalidate("vms")
+
+    @staticmethod
+    def claim(image, vmname, linked=False):
+        """
+        Take a ready machine from an image's pool and rename it.
+        Options:
+            image   (str): name of the .ova image
+            vmname  (str): new name of the machine
+            linked (bool): claim a linked clone of the image's base vm (default is False)
+        Returns True if a machine was claimed, False if none were ready.
+        """
+        claimed = False
+        # Claims are serialised so two builds never rename the same machine
+        with WarmPool._lock:
+            for name in WarmPool.ready(image, linked):
+                r = VBoxManage.run("modifyvm", name, "--name", vmname, "--groups", "/")
+                Inventory.invalidate("vms")
+                if r.ok:
+                    claimed = True
+                    break
+        if (image, linked) in WarmPool.sizes:
+            WarmPool.refill(image, linked)
+        return claimed
+
+    @staticmethod
+    def stats():
+        """
+        Return the size and contents of each configured pool.
+        Returns:
+            stats (list): [{"image": , "linked": , "size": , "ready": , "filling": , "machines": }]
+        """
+        stats = []
+        with WarmPool._lock:
+            for (image, linked), size in sorted(WarmPool.sizes.items()):
+                key = WarmPool.key(image, linked)
+                ready = WarmPool.ready(image, linked)
+                stats.append({
+                    "image": image,
+                    "linked": linked,
+                    "size": size,
+                    "ready": len(ready),
+                    "filling": len([name for name in WarmPool._filling if name.startswith(key)]),
+                    "machines": ready,
+                })
+        return stats
@@ -0,0 +1,5 @@
+import sys
+import os
+
+# Modules are imported from src, as when running avn
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
@@ -0,0 +1,109 @@
+import pytest
+
+# The constructor imports the database models and SSH helpers
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("paramiko")
+import constructor
+from constructor import Constructor
+
+class FakeDeployment(object):
+    id = 1
+
+class FakeNetwork(object):
+    def __init__(self, label, netname):
+        self.label = label
+        self.netname = netname
+
+class FakeHost(object):
+    def __init__(self, vmname, image, adapters):
+        self.vmname = vmname
+        self.image = image
+        self._adapters = adapters
+
+    def adapters(self):
+        return self._adapters
+
+TEMPLATE = {
+    "deployment": {"name": "lab"},
+    "networks": {
+        "net1": {"netaddr": "20.0.0.1", "dhcplower": "20.0.0.2", "dhcpupper": "20.0.0.254"},
+        "net2": {"netaddr": "30.0.0.1", "dhcplower": "30.0.0.2", "dhcpupper": "30.0.0.254"},
+    },
+    "hosts": {
+        "host1": {"image": "ubuntu.ova", "networks": ["net1"]},
+        "host2": {"image": "ubuntu.ova", "networks": ["net1", "net2"], "internet_adapter": "nat"},
+    },
+}
+
+def hostonly(*netnames, types=()):
+    """Return adapters attached to host-only networks, followed by adapters of other types."""
+    adapters = {adapter: {"type": "hostonly", "netname": netname} for adapter, netname in enumerate(netnames, start=1)}
+    for nettype in types:
+        adapters[len(adapters) + 1] = {"type": nettype, "netname": None}
+    return adapters
+
+@pytest.fixture
+def deployed(monkeypatch):
+    """Patch the database and VirtualBox lookups, returns the state to edit."""
+    state = {
+        "deployment": FakeDeployment(),
+        "networks": [FakeNetwork("net1", "vboxnet0"), FakeNetwork("net2", "vboxnet1")],
+        "hosts": [
+            FakeHost("host1", "ubuntu.ova", hostonly("vboxnet0")),
+            FakeHost("host2", "ubuntu.ova", hostonly("vboxnet0", "vboxnet1", types=["nat"])),
+        ],
+        "vms": {"host1": "1", "host2": "2"},
+        "hostonlyifs": {"vboxnet0": {}, "vboxnet1": {}},
+    }
+    monkeypatch.setattr(constructor.Deployments, "get_by_name", staticmethod(lambda name: state["deployment"]))
+    monkeypatch.setattr(constructor.Networks, "get_deployment", classmethod(lambda cls, id: list(state["networks"])))
+    monkeypatch.setattr(constructor.Hosts, "get_deployment", classmethod(lambda cls, id: list(state["hosts"])))
+    monkeypatch.setattr(constructor.Inventory, "vms", staticmethod(lambda: state["vms"]))
+    monkeypatch.setattr(constructor.Inventory, "hostonlyifs", staticmethod(lambda: state["hostonlyifs"]))
+    return state
+
+def plan(template=TEMPLATE):
+    builder = Constructor.__new__(Constructor)
+    builder.template = template
+    return builder.plan()
+
+def actions(result):
+    return [(action["action"], action["name"]) for action in result["actions"]]
+
+def test_plan_new_deployment_builds_everything(deployed):
+    deployed["deployment"] = None
+    result = plan()
+    assert result["exists"] is False
+    assert actions(result) == [("add_network", "net1"), ("add_network", "net2"), ("add_host", "host1"), ("add_host", "host2")]
+
+def test_plan_up_to_date(deployed):
+    result = plan()
+    assert result["exists"] is True
+    assert actions(result) == []
+
+def test_plan_removes_hosts_and_networks_not_in_template(deployed):
+    template = dict(TEMPLATE, networks={"net1": TEMPLATE["networks"]["net1"]}, hosts={"host1": TEMPLATE["hosts"]["host1"]})
+    assert actions(plan(template)) == [("remove_host", "host2"), ("remove_network", "net2")]
+
+def test_plan_rebuilds_missing_and_changed_hosts(deployed):
+    del deployed["vms"]["host1"]
+    deployed["hosts"][1].image = "centos.ova"
+    assert actions(plan()) == [
+        ("remove_host", "host1"), ("add_host", "host1"),
+        ("remove_host", "host2"), ("add_host", "host2"),
+    ]
+
+def test_plan_changes_nics(deployed):
+    deployed["hosts"][0]._adapters = hostonly("vboxnet1")
+    result = plan()
+    assert actions(result) == [("change_nics", "host1")]
+    assert result["actions"][0]["detail"] == "net2 -> net1"
+
+def test_plan_rebuilds_missing_network_and_reattaches_its_hosts(deployed):
+    del deployed["hostonlyifs"]["vboxnet1"]
+    assert actions(plan()) == [("remove_network", "net2"), ("add_network", "net2"), ("change_nics", "host2")]
+
+def test_describe_adapters_drops_trailing_disabled():
+    builder = Constructor.__new__(Constructor)
+    adapters = hostonly("vboxnet0", types=["nat", "none"])
+    assert builder.describe_adapters(adapters, {"vboxnet0": "net1"}) == ["net1", "nat"]
@@ -0,0 +1,18 @@
+from forwarding.gateway import Gateway
+
+def test_parse_connect():
+    name, preamble, error = Gateway.parse(b"CONNECT host1:22 HTTP/1.0\r\nHost: host1\r\n\r\nSSH-2.0", 22)
+    assert (name, preamble, error) == ("host1", b"SSH-2.0", None)
+
+def test_parse_connect_without_port():
+    assert Gateway.parse(b"connect host1 HTTP/1.1\r\n\r\n", 22) == ("host1", b"", None)
+
+def test_parse_rejects_other_port():
+    assert Gateway.parse(b"CONNECT host1:80 HTTP/1.0\r\n\r\n", 22) == ("host1", b"", Gateway.FORBIDDEN)
+
+def test_parse_rejects_other_method():
+    assert Gateway.parse(b"GET / HTTP/1.0\r\n\r\n", 22) == (None, b"", Gateway.NOT_ALLOWED)
+
+def test_parse_rejects_malformed_requests():
+    for request in [b"CONNECT host1:22\r\n\r\n", b"CONNECT :22 HTTP/1.0\r\n\r\n", b"\r\n\r\n", b"CONNECT a b c HTTP/1.0\r\n\r\n"]:
+        assert Gateway.parse(request, 22)[2] == Gateway.BAD_REQUEST
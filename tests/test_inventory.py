@@ -0,0 +1,35 @@
+from vbox.inventory import Inventory
+
+def test_parse_vms():
+    output = '"host1" {1111-aaaa}\n"avn pool vm" {2222-bbbb}\nnot a vm line\n'
+    assert Inventory.parse_vms(output) == {"host1": "1111-aaaa", "avn pool vm": "2222-bbbb"}
+
+def test_parse_hostonlyifs():
+    output = (
+        "Name:            vboxnet0\n"
+        "IPAddress:       192.168.56.1\n"
+        "NetworkName:     HostInterfaceNetworking-vboxnet0\n"
+        "\n"
+        "Name:            vboxnet1\n"
+        "IPAddress:       10.0.0.1\n"
+    )
+    ifs = Inventory.parse_hostonlyifs(output)
+    assert sorted(ifs) == ["vboxnet0", "vboxnet1"]
+    assert ifs["vboxnet0"]["IPAddress"] == "192.168.56.1"
+    assert ifs["vboxnet0"]["NetworkName"] == "HostInterfaceNetworking-vboxnet0"
+
+def test_parse_dhcpservers():
+    output = (
+        "NetworkName:    HostInterfaceNetworking-vboxnet0\n"
+        "Dhcpd IP:       20.0.0.1\n"
+        "Enabled:        Yes\n"
+        "\n\n"
+        "NetworkName:    HostInterfaceNetworking-vboxnet1\n"
+        "Enabled:        No\n"
+    )
+    servers = Inventory.parse_dhcpservers(output)
+    assert servers["vboxnet0"]["Dhcpd IP"] == "20.0.0.1"
+    assert servers["vboxnet1"]["Enabled"] == "No"
+
+def test_parse_blocks_keeps_colons_in_values():
+    assert Inventory.parse_blocks("Key: a:b\n") == [{"Key": "a:b"}]
@@ -0,0 +1,34 @@
+import base64
+import hashlib
+import hmac
+
+import pytest
+
+# The autossh package also provides the paramiko based SSH pool
+pytest.importorskip("paramiko")
+from autossh.known_hosts import KnownHosts
+
+def hashed(address, salt=b"0123456789abcdef0123"):
+    digest = hmac.new(salt, address.encode(), hashlib.sha1).digest()
+    return "|1|" + base64.b64encode(salt).decode() + "|" + base64.b64encode(digest).decode()
+
+def test_remove_plain_bracketed_and_hashed_entries(tmp_path):
+    path = tmp_path / "known_hosts"
+    path.write_text(
+        "20.0.0.2 ssh-ed25519 AAAA\n"
+        "[20.0.0.3]:2222 ssh-ed25519 AAAA\n"
+        + hashed("20.0.0.4") + " ssh-ed25519 AAAA\n"
+        "@cert-authority 20.0.0.5 ssh-ed25519 AAAA\n"
+        "# 20.0.0.2 comment kept\n"
+        "example.com,20.0.0.9 ssh-ed25519 AAAA\n"
+    )
+    removed = KnownHosts.remove(["20.0.0.2", "20.0.0.3", "20.0.0.4", "20.0.0.5", None], path=path)
+    assert removed == 4
+    assert path.read_text() == "# 20.0.0.2 comment kept\nexample.com,20.0.0.9 ssh-ed25519 AAAA\n"
+
+def test_remove_leaves_file_untouched_without_matches(tmp_path):
+    path = tmp_path / "known_hosts"
+    path.write_text("20.0.0.9 ssh-ed25519 AAAA\n")
+    assert KnownHosts.remove(["20.0.0.2"], path=path) == 0
+    assert KnownHosts.remove([], path=path) == 0
+    assert KnownHosts.remove(["20.0.0.2"], path=tmp_path / "missing") == 0
@@ -0,0 +1,18 @@
+from vbox.leases import LeaseIndex
+
+LEASES = """<?xml version="1.0"?>
+<Leases version="1.0">
+  <Lease mac="08:00:27:aa:aa:aa" id="01" state="acked">
+    <Address value="20.0.0.2"/>
+  </Lease>
+  <Lease mac="08:00:27:bb:bb:bb" id="01" state="expired">
+    <Address value="20.0.0.3"/>
+  </Lease>
+  <Lease mac="08:00:27:cc:cc:cc" state="offered"/>
+</Leases>
+"""
+
+def test_parse_skips_expired_leases(tmp_path):
+    path = tmp_path / "HostInterfaceNetworking-vboxnet0-Dhcpd.leases"
+    path.write_text(LEASES)
+    assert LeaseIndex.parse(str(path)) == {"08:00:27:aa:aa:aa": "20.0.0.2"}
@@ -0,0 +1,49 @@
+import pytest
+
+from forwarding.ports import PortAllocator
+
+@pytest.fixture(autouse=True)
+def port_range():
+    first, last = PortAllocator.first, PortAllocator.last
+    PortAllocator.set_range(3000, 3004)
+    PortAllocator.ensure_loaded(lambda: [])
+    yield
+    PortAllocator.set_range(first, last)
+
+def test_allocates_lowest_free_port():
+    assert PortAllocator.allocate(lambda port: None) == 3000
+    assert PortAllocator.allocate(lambda port: None) == 3001
+
+def test_loaded_ports_are_skipped():
+    PortAllocator.set_range(3000, 3004)
+    PortAllocator.ensure_loaded(lambda: [3000, 3002, None, 4000])
+    assert PortAllocator.allocate(lambda port: None) == 3001
+    assert PortAllocator.allocate(lambda port: None) == 3003
+
+def test_ensure_loaded_only_loads_once():
+    PortAllocator.ensure_loaded(lambda: [3000])
+    assert PortAllocator.allocate(lambda port: None) == 3000
+
+def test_ports_failing_to_bind_are_skipped_for_the_call():
+    def bind(port):
+        if port == 3000:
+            raise OSError("in use")
+    assert PortAllocator.allocate(bind) == 3001
+    # Not recorded as allocated, tried again on the next call
+    assert PortAllocator.allocate(lambda port: None) == 3000
+
+def test_release_frees_ports():
+    ports = [PortAllocator.allocate(lambda port: None) for _ in range(3)]
+    PortAllocator.release([ports[1], None, 9999])
+    assert PortAllocator.allocate(lambda port: None) == ports[1]
+    assert PortAllocator.stats()["allocated"] == 3
+
+def test_exhausted_range_raises():
+    for _ in range(5):
+        PortAllocator.allocate(lambda port: None)
+    with pytest.raises(Exception, match="No free port"):
+        PortAllocator.allocate(lambda port: None)
+
+def test_invalid_range_raises():
+    with pytest.raises(Exception, match="Invalid port range"):
+        PortAllocator.set_range(10, 5)
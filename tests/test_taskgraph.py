@@ -0,0 +1,55 @@
+import pytest
+
+from taskgraph import TaskGraph
+
+def noop():
+    pass
+
+def test_validate_accepts_dag():
+    graph = TaskGraph()
+    graph.add("network:a", noop)
+    graph.add("host:h", noop)
+    graph.add("nics:h", noop, depends=["host:h", "network:a"])
+    graph.validate()
+
+def test_validate_rejects_unknown_dependency():
+    graph = TaskGraph()
+    graph.add("nics:h", noop, depends=["host:h"])
+    with pytest.raises(Exception, match="unknown task host:h"):
+        graph.validate()
+
+def test_validate_rejects_cycle():
+    graph = TaskGraph()
+    graph.add("a", noop, depends=["c"])
+    graph.add("b", noop, depends=["a"])
+    graph.add("c", noop, depends=["b"])
+    graph.add("d", noop)
+    with pytest.raises(Exception, match="cycle"):
+        graph.validate()
+
+def test_add_rejects_duplicate():
+    graph = TaskGraph()
+    graph.add("a", noop)
+    with pytest.raises(Exception, match="already in graph"):
+        graph.add("a", noop)
+
+def test_run_respects_dependencies():
+    order = []
+    graph = TaskGraph()
+    graph.add("c", order.append, "c", depends=["a", "b"])
+    graph.add("b", order.append, "b", depends=["a"])
+    graph.add("a", order.append, "a")
+    timings = graph.run()
+    assert order == ["a", "b", "c"]
+    assert set(timings) == {"a", "b", "c"}
+
+def test_run_raises_first_error_and_skips_dependents():
+    ran = []
+    def fail():
+        raise ValueError("boom")
+    graph = TaskGraph()
+    graph.add("a", fail)
+    graph.add("b", ran.append, "b", depends=["a"])
+    with pytest.raises(ValueError, match="boom"):
+        graph.run()
+    assert ran == []